@@ -1,43 +1,99 @@
-import os
+import json
+from time import monotonic
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import (Flask, Blueprint, render_template, request, flash,
+                   redirect, session, g, jsonify, abort, current_app,
+                   Response, stream_with_context)
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
 
+from config import load_config
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message
+from fragments import fragment_cache
+from cache import (cache, load_user, load_users, forget_user, load_message,
+                   forget_message)
+from http_caching import (init_http_caching, no_store, page_etag,
+                          render_conditional)
+from json_api import (api_response, fieldset, is_api_request, message_json,
+                      page_json, user_json, MESSAGE_FIELDS, USER_CARD_FIELDS,
+                      USER_FIELDS)
+from live import live_updates
+from metrics import init_metrics
+from models import (db, connect_db, User, Message, Like, Follows,
+                    TimelineEntry, USER_CARD_COLUMNS)
+from passwords import hasher, PasswordHasherBusy
+from pagination import (paginate_request, encode_cursor, decode_cursor,
+                        InvalidCursor, MESSAGES_PER_PAGE, USERS_PER_PAGE)
+from query_budget import init_query_budget, query_budget
+from replicas import init_replicas
+from search import search_users, search_messages
+from snowflake import message_ids
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# the site's routes; `create_app` registers them on each app it builds
+views = Blueprint('views', __name__, cli_group=None)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+def create_app(config=None):
+    """Build a Warbler app.
 
-connect_db(app)
+    `config` is a profile name from config.py ('production', 'development'
+    or 'testing'), or a mapping of settings over the default profile. The
+    debug toolbar is only imported, and installed, when the profile has
+    DEBUG_TB_ENABLED (development does).
+    """
+
+    app = Flask(__name__)
+    app.config.update(load_config(config))
+
+    connect_db(app)
+    init_replicas(app)
+    cache.init_app(app)
+    live_updates.init_app(app)
+    hasher.init_app(app)
+    message_ids.init_app(app)
+    init_http_caching(app)
+    app.add_template_global(fragment_cache.render_message, 'render_message')
+
+    # registered before the views' add_user_to_g so its query counts too
+    init_query_budget(app)
+    init_metrics(app)
+    app.register_blueprint(views)
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    `g.user_id` is just the id from the session. `g.user` is loaded (from
+    the user cache, if possible) the first time it's used, so routes that
+    only need the id never touch the database for it.
+    """
 
-    else:
-        g.user = None
+    g.user_id = session.get(CURR_USER_KEY)
+    g.user = LocalProxy(current_user)
+
+
+def current_user():
+    """The logged-in User, or None; loaded once per request."""
+
+    if 'current_user' not in g:
+        g.current_user = load_user(g.user_id) if g.user_id else None
+
+    return g.current_user
 
 
 def do_login(user):
@@ -53,7 +109,43 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def load_viewer_relationships(messages=(), users=()):
+    """Prefetch the logged-in user's likes/follows for what's being shown.
+
+    Lets templates call `g.user.has_liked` / `g.user.is_following` per row
+    without a query (or a collection scan) each time.
+    """
+
+    if g.user:
+        g.user.load_relationships(messages=messages, users=users)
+
+
+def viewer_state(messages=(), users=()):
+    """What a page showing `messages`/`users` shows about the viewer.
+
+    For building page ETags; call `load_viewer_relationships` first.
+    """
+
+    if not g.user:
+        return None
+
+    return (g.user.id,
+            g.user.username,
+            g.user.image_url,
+            tuple(g.user.has_liked(message) for message in messages),
+            tuple(g.user.is_following(user) for user in users))
+
+
+def profile_state(user):
+    """The parts of `user` shown on their profile, for page ETags."""
+
+    return (user.id, user.username, user.image_url, user.header_image_url,
+            user.bio, user.location, user.messages_count,
+            user.following_count, user.followers_count, user.likes_count)
+
+
+@views.route('/signup', methods=["GET", "POST"])
+@no_store
 def signup():
     """Handle user signup.
 
@@ -89,7 +181,8 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
+@no_store
 def login():
     """Handle user login."""
 
@@ -100,6 +193,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -109,7 +204,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -122,108 +217,258 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@views.route('/users')
+@query_budget(6)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Lists users newest first, a page at a time by the `before` cursor. Can
+    take a 'q' param in querystring to search by username, bio or
+    location, and a 'page' param to page through the ranked results.
     """
 
     search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    has_more = False
+    next_cursor = None
 
     if not search:
-        users = User.query.all()
+        users, next_cursor = directory_page()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_more = search_users(search, page)
+
+    load_viewer_relationships(users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           search=search,
+                           page=page,
+                           has_more=has_more,
+                           next_cursor=next_cursor)
+
+
+def directory_page():
+    """Get a page of user cards, newest user first."""
 
-    return render_template('users/index.html', users=users)
+    return paginate_request(directory_query(),
+                            User.id,
+                            per_page=USERS_PER_PAGE)
 
 
-@app.route('/users/<int:user_id>')
+def directory_query():
+    """Query for every user's card (USER_CARD_COLUMNS)."""
+
+    return db.session.query(*USER_CARD_COLUMNS)
+
+
+def user_messages_query(user_id):
+    """Query for `user_id`'s messages."""
+
+    return Message.query.filter(Message.user_id == user_id)
+
+
+def user_messages_page(user_id):
+    """Get a page of `user_id`'s messages, newest first."""
+
+    # the author is the profile's user, already in the identity map, so
+    # `message.user` needs no eager load here
+    return paginate_request(user_messages_query(user_id), Message.id)
+
+
+@views.route('/users/<int:user_id>')
+@query_budget(7)
 def users_show(user_id):
     """Show user profile."""
 
+    user = load_user(user_id) or abort(404)
+    messages, next_cursor = user_messages_page(user_id)
+    load_viewer_relationships(messages=messages, users=[user])
+
+    # messages can't be edited, so their ids stand in for their content
+    etag = page_etag('users_show',
+                     profile_state(user),
+                     [message.id for message in messages],
+                     next_cursor,
+                     viewer_state(messages, [user]))
+
+    return render_conditional(etag,
+                              'users/show.html',
+                              user=user,
+                              messages=messages,
+                              next_cursor=next_cursor,
+                              feed_url=f"/users/{user_id}/timeline")
+
+
+@views.route('/users/<int:user_id>/timeline')
+@query_budget(7)
+def users_timeline(user_id):
+    """JSON page of a user's messages, for infinite scroll.
+
+    Returns rendered list items and the cursor for the next page (or null).
+    """
+
+    # keep a reference so the author stays in the identity map
     user = User.query.get_or_404(user_id)
+    messages, next_cursor = user_messages_page(user_id)
+    load_viewer_relationships(messages=messages)
+
+    return jsonify(html=render_template('messages/_list.html',
+                                        messages=messages),
+                   next=next_cursor)
+
+
+def user_likes_query(user_id):
+    """Query for `user_id`'s likes, with the liked messages."""
+
+    return (Like.query
+            .filter(Like.user_id == user_id)
+            .options(db.joinedload(Like.message)))
+
+
+def user_likes_page(user_id):
+    """Get a page of the messages `user_id` liked, most recently liked first.
+
+    Authors come from the user cache in one batch.
+    """
+
+    likes, next_cursor = paginate_request(user_likes_query(user_id),
+                                          Like.timestamp,
+                                          Like.message_id)
+
+    messages = [like.message for like in likes]
+    # puts the authors in the identity map, where `message.user` finds them
+    load_users({message.user_id for message in messages})
+    return messages, next_cursor
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
 
-@app.route('/users/<int:user_id>/likes')
+@views.route('/users/<int:user_id>/likes')
+@query_budget(6)
 def show_likes(user_id):
-    """show user's liked messages"""
+    """Show the messages a user liked, a page at a time."""
 
-    user = User.query.get_or_404(user_id)
-    messages = user.likes
+    user = load_user(user_id) or abort(404)
+    messages, next_cursor = user_likes_page(user_id)
+    load_viewer_relationships(messages=messages, users=[user])
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           next_cursor=next_cursor,
+                           feed_url=f"/users/{user_id}/likes/timeline")
+
+
+@views.route('/users/<int:user_id>/likes/timeline')
+@query_budget(6)
+def likes_timeline(user_id):
+    """JSON page of a user's liked messages, for infinite scroll."""
 
-    return render_template('users/show.html', user=user, messages=messages)
+    load_user(user_id) or abort(404)
+    messages, next_cursor = user_likes_page(user_id)
+    load_viewer_relationships(messages=messages)
 
+    return jsonify(html=render_template('messages/_list.html',
+                                        messages=messages),
+                   next=next_cursor)
 
-@app.route('/users/<int:user_id>/following')
+
+def follows_query(user_id, listed, other):
+    """Query for the cards of one side of `user_id`'s follows (see
+    `follows_page`)."""
+
+    return (db.session
+            .query(*USER_CARD_COLUMNS)
+            .join(Follows, listed == User.id)
+            .filter(other == user_id))
+
+
+def follows_page(user_id, listed, other):
+    """Get a page of cards for one side of `user_id`'s follows, by id.
+
+    `listed` is the Follows column of the users to list and `other` the
+    one that must be `user_id`; the pair is covered by an index, so a page
+    is a range read.
+    """
+
+    return paginate_request(follows_query(user_id, listed, other),
+                            listed,
+                            per_page=USERS_PER_PAGE,
+                            key=lambda card: [card.id])
+
+
+@views.route('/users/<int:user_id>/following')
+@query_budget(6)
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of the people this user is following."""
 
-    user = User.query.get_or_404(user_id)
+    user = load_user(user_id) or abort(404)
 
     if not g.user:
         flash(f"Please log in to see who {user.username} follows", "danger")
         return redirect(request.referrer if request.referrer else "/")
 
-    return render_template('users/following.html', user=user)
+    users, next_cursor = follows_page(user_id,
+                                      Follows.user_being_followed_id,
+                                      Follows.user_following_id)
+    load_viewer_relationships(users=[user, *users])
+    return render_template('users/following.html',
+                           user=user,
+                           users=users,
+                           next_cursor=next_cursor)
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
+@query_budget(6)
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of this user's followers."""
 
-    user = User.query.get_or_404(user_id)
+    user = load_user(user_id) or abort(404)
 
     if not g.user:
         flash(f"Please log in to see who follows {user.username}.", "danger")
         return redirect(request.referrer if request.referrer else "/")
 
-    return render_template('users/followers.html', user=user)
+    users, next_cursor = follows_page(user_id,
+                                      Follows.user_following_id,
+                                      Follows.user_being_followed_id)
+    load_viewer_relationships(users=[user, *users])
+    return render_template('users/followers.html',
+                           user=user,
+                           users=users,
+                           next_cursor=next_cursor)
 
 
-@app.route('/users/handlefollow/<int:follow_id>', methods=["POST"])
+@views.route('/users/handlefollow/<int:follow_id>', methods=["POST"])
 def toggle_follow(follow_id):
     """toggle follow"""
 
-    if not g.user:
+    if not g.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-
-    if g.user.is_following(followed_user):
-        g.user.following.remove(followed_user)
-        db.session.commit()
-        follow_count = len(g.user.following)
-        follower_count = len(followed_user.followers)
-        unfollow_html = '<button class="btn btn-outline-primary btn-sm">Follow</button>'
-        return jsonify(html=unfollow_html,
-                       follow_count=follow_count,
-                       follower_count=follower_count
-                       )
-    else:
-        g.user.following.append(followed_user)
-        db.session.commit()
-        follow_count = len(g.user.following)
-        follower_count = len(followed_user.followers)
-        follow_html = '<button class="btn btn-primary btn-sm">Unfollow</button>'
-        return jsonify(html=follow_html,
-                       follow_count=follow_count,
-                       follower_count=follower_count
-                       )
-
-
-@app.route('/users/profile', methods=["GET", "POST"])
+    try:
+        following, follow_count, follower_count = Follows.toggle(g.user_id,
+                                                                 follow_id)
+    except ValueError:
+        abort(400)
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+
+    db.session.commit()
+    forget_user(g.user_id, follow_id)
+
+    return jsonify(html=FOLLOW_BUTTONS[following],
+                   follow_count=follow_count,
+                   follower_count=follower_count)
+
+
+FOLLOW_BUTTONS = {
+    True: '<button class="btn btn-primary btn-sm">Unfollow</button>',
+    False: '<button class="btn btn-outline-primary btn-sm">Follow</button>',
+}
+
+
+@views.route('/users/profile', methods=["GET", "POST"])
+@no_store
 def profile():
     """Update profile for current user."""
 
@@ -241,8 +486,10 @@ def profile():
             g.user.header_image_url = form.header_image_url.data
             g.user.location = form.location.data
             g.user.bio = form.bio.data
+            g.user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            forget_user(g.user_id)
             flash("Successfully updated your profile!", "success")
 
             return redirect(f"/users/{g.user.id}")
@@ -253,7 +500,8 @@ def profile():
     return render_template("users/edit.html", form=form, user=g.user)
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/delete', methods=["POST"])
+@query_budget(4)
 def delete_user():
     """Delete user."""
 
@@ -263,8 +511,30 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # everyone whose counts include this user's follows, messages or likes,
+    # by id alone: there's no need to load those users
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == g.user_id))
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == g.user_id))
+    likers = (db.session
+              .query(Like.user_id)
+              .join(Message)
+              .filter(Message.user_id == g.user_id))
+    affected_ids = {user_id for (user_id,)
+                    in followed.union(followers, likers)}
+    affected_ids.discard(g.user_id)
+
+    # the database cascades the delete to the user's messages, likes,
+    # follows and timeline entries, so none of those are loaded either
+    (User.query
+     .filter(User.id == g.user_id)
+     .delete(synchronize_session=False))
+    User.reconcile_counts(affected_ids)
     db.session.commit()
+    forget_user(g.user_id, *affected_ids)
 
     return redirect("/signup")
 
@@ -272,7 +542,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -286,24 +556,59 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
+        post_message(form.text.data)
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+def post_message(text):
+    """Post a message as the logged-in user and announce it; returns it."""
+
+    message = Message.post(g.user_id, text)
+    message_id = message.id
+    db.session.commit()
+    forget_user(g.user_id)
+    live_updates.publish(g.user_id, message_id)
+    return message
+
+
+@views.route('/messages/search')
+@query_budget(6)
+def messages_search():
+    """Page of messages matching the 'q' param, best matches first."""
+
+    search = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+
+    messages, has_more = search_messages(search, page)
+    load_viewer_relationships(messages=messages)
+
+    return render_template('messages/search.html',
+                           messages=messages,
+                           search=search,
+                           page=page,
+                           has_more=has_more)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(6)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = load_message(message_id) or abort(404)
+    load_viewer_relationships(messages=[msg])
+
+    author = msg.user
+    etag = page_etag('messages_show',
+                     msg.id,
+                     (author.id, author.username, author.image_url),
+                     viewer_state([msg], [author]))
+
+    return render_conditional(etag, 'messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
     msg = Message.query.get_or_404(message_id)
@@ -313,89 +618,641 @@ def messages_destroy(message_id):
         return redirect("/")
 
     # TODO check if msg owner == g.user
+    liker_ids = [user_id for (user_id,) in
+                 db.session.query(Like.user_id).filter_by(message_id=msg.id)]
+    User.adjust_counts([msg.user_id], messages_count=-1)
+    User.adjust_counts(liker_ids, likes_count=-1)
+
+    # timeline entries and likes for this message go with the FK cascade
+    fragment_cache.forget_message(msg)
+    forget_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    forget_user(g.user_id, *liker_ids)
 
     return redirect(f"/users/{g.user.id}")
 
 
-@app.route('/messages/<int:message_id>/handle-like', methods=["POST"])
+@views.route('/messages/<int:message_id>/handle-like', methods=["POST"])
 def handle_like(message_id):
     """handle likes on a message"""
 
-    if not g.user:
+    if not g.user_id:
         flash("You must be logged in to like/unlike.", "danger")
-        return redirect(request.referrer)
+        return redirect(request.referrer or "/")
 
-    liked_msg = Message.query.get_or_404(message_id)
+    try:
+        liked, like_count = Like.toggle(g.user_id, message_id)
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
 
-    if g.user.has_liked(liked_msg):
-        g.user.likes.remove(liked_msg)
-        db.session.commit()
-        like_count = len(g.user.likes)
-    else:
-        g.user.likes.append(liked_msg)
-        db.session.commit()
-        like_count = len(g.user.likes)
+    db.session.commit()
+    forget_user(g.user_id)
+
+    return (jsonify(count=like_count, liked=liked)
+            if f'/users/{g.user_id}/' in (request.referrer or '')
+            else jsonify(success=True, liked=liked))
+
+
+##############################################################################
+# Bulk toggles
+#
+# scripts.js queues like/follow clicks and sends them here together, so a
+# burst of clicks costs one request rather than one each.
+
+MAX_BULK_TOGGLES = 100
+
+
+@views.route('/toggles', methods=["POST"])
+def bulk_toggle():
+    """Apply a batch of like/follow toggles for the logged-in user.
+
+    Takes JSON {"toggles": [{"type": "like" | "follow", "id": <id>}, ...]}
+    (ids as numbers or digit strings) and applies them in order, each in
+    its own savepoint so one bad id doesn't undo the rest. Responds with
+    one result per toggle, carrying the new state and counts (or an
+    "error").
+    """
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    toggles = (request.get_json(silent=True) or {}).get('toggles')
+
+    if not isinstance(toggles, list) or len(toggles) > MAX_BULK_TOGGLES:
+        abort(400)
+
+    results = []
+    followed_ids = set()
 
+    for toggle in toggles:
+        kind = toggle.get('type') if isinstance(toggle, dict) else None
+        target_id = toggle.get('id') if isinstance(toggle, dict) else None
+        result = {'type': kind, 'id': target_id}
+        results.append(result)
 
-    return (jsonify(count=like_count)
-            if (f'/users/{g.user.id}/' in request.referrer)
-            else jsonify(success=True))
+        # message ids are too big for JavaScript numbers, so come as strings
+        if isinstance(target_id, str) and target_id.isdigit():
+            target_id = int(target_id)
+
+        # JSON true and false are ints to Python, but no one's id
+        if (kind not in ('like', 'follow') or not isinstance(target_id, int)
+                or isinstance(target_id, bool)):
+            result['error'] = 'invalid'
+            continue
+
+        savepoint = db.session.begin_nested()
+        try:
+            if kind == 'like':
+                result['liked'], result['likes_count'] = Like.toggle(
+                    g.user_id, target_id)
+            else:
+                (result['following'], result['following_count'],
+                 result['followers_count']) = Follows.toggle(g.user_id,
+                                                             target_id)
+                followed_ids.add(target_id)
+            savepoint.commit()
+        except ValueError:
+            savepoint.rollback()
+            result['error'] = 'invalid'
+        except IntegrityError:
+            savepoint.rollback()
+            result['error'] = 'not found'
+
+    db.session.commit()
+    forget_user(g.user_id, *followed_ids)
+
+    return jsonify(results=results)
 
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+def home_timeline_query(user_id, authors=True):
+    """Query for the messages in `user_id`'s home timeline.
+
+    Messages come from the user's materialized timeline (see
+    `TimelineEntry`), so a page is one range read on its primary key.
+    Their authors are loaded with them unless `authors` is false.
+    """
+
+    query = (Message
+             .query
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.owner_id == user_id))
+
+    if authors:
+        query = query.options(db.joinedload(Message.user))
+
+    return query
+
+
+def home_timeline_page(authors=True):
+    """Get a page of the logged-in user's home timeline, newest first
+    (see `home_timeline_query`)."""
+
+    return paginate_request(home_timeline_query(g.user_id, authors),
+                            TimelineEntry.message_id,
+                            key=lambda message: [message.id])
+
+
+@views.route('/')
+@query_budget(6)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: the newest page of their home timeline (their own and
+      followed users' messages), with older pages by cursor
     """
 
     if g.user:
-        followed_ids = [f.id for f in g.user.following]
-        messages = (Message
-                    .query
-                    .filter((Message.user_id == g.user.id) |
-                            (Message.user_id.in_(followed_ids))
-                            )
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        messages, next_cursor = home_timeline_page()
+        load_viewer_relationships(messages=messages)
+
+        # only the newest page gets new messages added live
+        live_after = None
+        if not request.args.get('before'):
+            live_after = encode_cursor(messages[0].id if messages else 0)
+
+        return render_template('home.html',
+                               messages=messages,
+                               next_cursor=next_cursor,
+                               feed_url="/timeline",
+                               live_after=live_after)
 
     else:
         return render_template('home-anon.html')
 
 
+@views.route('/timeline')
+@query_budget(6)
+def home_timeline():
+    """JSON page of the home timeline, for infinite scroll."""
+
+    if not g.user:
+        return jsonify(error="You must be logged in."), 401
+
+    messages, next_cursor = home_timeline_page()
+    load_viewer_relationships(messages=messages)
+
+    return jsonify(html=render_template('messages/_list.html',
+                                        messages=messages),
+                   next=next_cursor)
+
+
+##############################################################################
+# Live timeline
+#
+# Open pages get new timeline messages from /timeline/stream (server-sent
+# events) or, where EventSource isn't available, by long polling
+# /timeline/poll. Either waits on a `live_updates` subscription to the
+# authors the viewer follows (as of connecting) and reads only timeline
+# entries newer than the client's cursor. Each open stream or poll holds
+# a worker thread, so serve with threaded workers (see Procfile), and at
+# most LIVE_MAX_STREAMS of them wait at once: past that, streams are
+# refused (clients fall back to polling) and polls answer straight away,
+# telling the client when to ask again.
+
+# seconds between comments that keep idle streams open through proxies
+LIVE_HEARTBEAT_SECONDS = 15
+# how long EventSource waits before reconnecting, in ms
+LIVE_RETRY_MS = 3000
+# how long a client waits to poll again after a poll that couldn't wait
+LIVE_SHORT_POLL_MS = 10000
+
+
+def live_after_id():
+    """Id of the newest message the client has; aborts with 400 if bad.
+
+    From Last-Event-ID when EventSource reconnects, else the `after` param.
+    """
+
+    token = request.headers.get('Last-Event-ID') or request.args.get('after')
+
+    try:
+        (after_id,) = decode_cursor(token or '')
+    except InvalidCursor:
+        abort(400)
+
+    return after_id
+
+
+def live_subscription(hub):
+    """Subscribe to new messages by the logged-in user and who they follow.
+
+    Called holding a slot claimed from `hub`, which is released if
+    subscribing fails.
+    """
+
+    try:
+        followed_ids = {id for (id,) in
+                        (db.session
+                         .query(Follows.user_being_followed_id)
+                         .filter(Follows.user_following_id == g.user_id))}
+        return hub.subscribe(followed_ids | {g.user_id})
+    except Exception:
+        hub.release()
+        raise
+
+
+def newer_timeline_messages(after_id):
+    """Render the logged-in user's timeline messages after `after_id`.
+
+    Returns (list items, newest id), or None if there are none; at most
+    the newest page. Releases the database connection afterwards, as the
+    caller is about to wait.
+    """
+
+    messages = (Message
+                .query
+                .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                .filter(TimelineEntry.owner_id == g.user_id,
+                        TimelineEntry.message_id > after_id)
+                .options(db.joinedload(Message.user))
+                .order_by(TimelineEntry.message_id.desc())
+                .limit(MESSAGES_PER_PAGE)
+                .all())
+
+    newer = None
+    if messages:
+        load_viewer_relationships(messages=messages)
+        newer = (render_template('messages/_list.html', messages=messages),
+                 messages[0].id)
+
+    db.session.close()
+    return newer
+
+
+@views.route('/timeline/stream')
+@no_store
+def timeline_stream():
+    """Server-sent events carrying new home timeline messages.
+
+    Each `messages` event's data is {"html": <list items>} and its id the
+    cursor to resume after. The stream ends after LIVE_STREAM_SECONDS;
+    EventSource then reconnects, picking up any new follows. Refused with
+    a 503 when LIVE_MAX_STREAMS requests are already waiting.
+    """
+
+    if not g.user_id:
+        return jsonify(error="You must be logged in."), 401
+
+    after_id = live_after_id()
+    # a notice can arrive before a replica has the message
+    g.db_read_bind = None
+
+    hub = live_updates.current()
+    if not hub.claim(current_app.config['LIVE_MAX_STREAMS']):
+        return (jsonify(error="Too many live timelines open; poll instead."),
+                503, {'Retry-After': str(LIVE_SHORT_POLL_MS // 1000)})
+    subscription = live_subscription(hub)
+
+    def events(after_id):
+        yield f"retry: {LIVE_RETRY_MS}\n\n"
+        deadline = monotonic() + current_app.config['LIVE_STREAM_SECONDS']
+        woken = True
+
+        while monotonic() < deadline:
+            if woken:
+                newer = newer_timeline_messages(after_id)
+                if newer:
+                    html, after_id = newer
+                    yield (f"event: messages\n"
+                           f"id: {encode_cursor(after_id)}\n"
+                           f"data: {json.dumps({'html': html})}\n\n")
+            else:
+                yield ": keepalive\n\n"
+
+            remaining = deadline - monotonic()
+            woken = subscription.wait(
+                max(0, min(LIVE_HEARTBEAT_SECONDS, remaining)))
+
+    response = Response(stream_with_context(events(after_id)),
+                        content_type='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    # runs even if the client goes before the body is started, perhaps
+    # outside the app context, so with this app's hub in hand
+    @response.call_on_close
+    def close():
+        hub.unsubscribe(subscription)
+        hub.release()
+
+    return response
+
+
+@views.route('/timeline/poll')
+@no_store
+def timeline_poll():
+    """Long-poll fallback for /timeline/stream.
+
+    Responds as soon as there are timeline messages after the `after`
+    cursor, or after LIVE_POLL_SECONDS without any, with JSON
+    {"html": <list items> or null, "after": <cursor for the next poll>}.
+
+    When LIVE_MAX_STREAMS requests are already waiting, it answers at
+    once, adding "retry": the ms to wait before polling again.
+    """
+
+    if not g.user_id:
+        return jsonify(error="You must be logged in."), 401
+
+    after_id = live_after_id()
+    g.db_read_bind = None
+
+    hub = live_updates.current()
+    if not hub.claim(current_app.config['LIVE_MAX_STREAMS']):
+        html, after_id = newer_timeline_messages(after_id) or (None, after_id)
+        return jsonify(html=html, after=encode_cursor(after_id),
+                       retry=LIVE_SHORT_POLL_MS)
+
+    subscription = live_subscription(hub)
+    try:
+        newer = newer_timeline_messages(after_id)
+        timeout = current_app.config['LIVE_POLL_SECONDS']
+        if not newer and subscription.wait(timeout):
+            newer = newer_timeline_messages(after_id)
+    finally:
+        hub.unsubscribe(subscription)
+        hub.release()
+
+    html, after_id = newer or (None, after_id)
+    return jsonify(html=html, after=encode_cursor(after_id))
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# JSON API (v1)
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# The site's timelines, users, messages, likes and follows as data, for
+# mobile and other clients, without rendering templates. Serialization,
+# sparse fieldsets and the response shapes are in json_api.py. Clients
+# log in as the site does (the session cookie), so writes must be JSON:
+# other sites' pages can't send that to us without our say-so.
+
+
+def api_user_id(write=False):
+    """The logged-in user's id; aborts with 401 if there isn't one.
+
+    For a `write`, also aborts with 415 unless the body is JSON.
+    """
+
+    if not g.user_id:
+        abort(401)
+    if write and not request.is_json:
+        abort(415)
+
+    return g.user_id
+
+
+def messages_data(messages):
+    """`messages` in the requested fieldsets, ready for `api_response`."""
+
+    fields = fieldset('message', MESSAGE_FIELDS)
+    user_fields = fieldset('user', USER_FIELDS)
+
+    if 'liked' in fields or ('user' in fields and 'following' in user_fields):
+        load_viewer_relationships(messages=messages)
+
+    return [message_json(message, fields, user_fields)
+            for message in messages]
+
+
+def users_data(users, available=USER_CARD_FIELDS):
+    """`users` in the requested fieldset, of the `available` fields."""
+
+    fields = fieldset('user', available)
+
+    if 'following' in fields:
+        load_viewer_relationships(users=users)
+
+    return [user_json(user, fields) for user in users]
+
+
+@views.route('/api/v1/timeline')
+@query_budget(4)
+def api_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    api_user_id()
+    fields = fieldset('message', MESSAGE_FIELDS)
+    messages, next_cursor = home_timeline_page(authors='user' in fields)
+
+    return api_response(page_json(messages_data(messages), next_cursor))
+
+
+@views.route('/api/v1/users')
+@query_budget(3)
+def api_users():
+    """Users, newest first."""
+
+    users, next_cursor = directory_page()
+    return api_response(page_json(users_data(users), next_cursor))
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+@views.route('/api/v1/users/<int:user_id>')
+@query_budget(3)
+def api_user(user_id):
+    """One user's profile."""
+
+    user = load_user(user_id) or abort(404)
+    return api_response({'data': users_data([user], USER_FIELDS)[0]})
+
+
+@views.route('/api/v1/users/<int:user_id>/messages')
+@query_budget(5)
+def api_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    # keep a reference so the author stays in the identity map
+    user = load_user(user_id) or abort(404)
+    messages, next_cursor = user_messages_page(user.id)
+
+    return api_response(page_json(messages_data(messages), next_cursor))
+
+
+@views.route('/api/v1/users/<int:user_id>/likes')
+@query_budget(6)
+def api_user_likes(user_id):
+    """The messages a user liked, most recently liked first."""
+
+    load_user(user_id) or abort(404)
+    messages, next_cursor = user_likes_page(user_id)
+
+    return api_response(page_json(messages_data(messages), next_cursor))
+
+
+@views.route('/api/v1/users/<int:user_id>/following')
+@query_budget(4)
+def api_following(user_id):
+    """The users a user follows, by user id, highest (newest user) first."""
+
+    api_user_id()
+    load_user(user_id) or abort(404)
+    users, next_cursor = follows_page(user_id,
+                                      Follows.user_being_followed_id,
+                                      Follows.user_following_id)
+
+    return api_response(page_json(users_data(users), next_cursor))
+
+
+@views.route('/api/v1/users/<int:user_id>/followers')
+@query_budget(4)
+def api_followers(user_id):
+    """A user's followers, by user id, highest (newest user) first."""
+
+    api_user_id()
+    load_user(user_id) or abort(404)
+    users, next_cursor = follows_page(user_id,
+                                      Follows.user_following_id,
+                                      Follows.user_being_followed_id)
+
+    return api_response(page_json(users_data(users), next_cursor))
+
+
+@views.route('/api/v1/users/<int:user_id>/follow', methods=["POST"])
+def api_toggle_follow(user_id):
+    """Follow the user if the logged-in user doesn't yet, else unfollow."""
+
+    follower_id = api_user_id(write=True)
+
+    try:
+        following, following_count, followers_count = Follows.toggle(
+            follower_id, user_id)
+    except ValueError:
+        abort(400, "You can't follow yourself.")
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+
+    db.session.commit()
+    forget_user(follower_id, user_id)
+
+    return api_response({'data': {'following': following,
+                                  'following_count': following_count,
+                                  'followers_count': followers_count}})
+
+
+@views.route('/api/v1/messages', methods=["POST"])
+def api_messages_add():
+    """Post a message: {"text": <up to 140 characters>}."""
+
+    api_user_id(write=True)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "Expected a JSON object.")
+
+    form = MessageForm(formdata=None, data=data, meta={'csrf': False})
+    if not form.validate():
+        return api_response({'error': "Invalid message.",
+                             'fields': form.errors},
+                            400)
+
+    message = post_message(form.text.data)
+    return api_response({'data': messages_data([message])[0]}, 201)
+
+
+@views.route('/api/v1/messages/<int:message_id>')
+@query_budget(5)
+def api_message(message_id):
+    """One message."""
+
+    message = load_message(message_id) or abort(404)
+    return api_response({'data': messages_data([message])[0]})
+
+
+@views.route('/api/v1/messages/<int:message_id>/like', methods=["POST"])
+def api_toggle_like(message_id):
+    """Like the message if the logged-in user hasn't yet, else unlike it."""
+
+    user_id = api_user_id(write=True)
+
+    try:
+        liked, likes_count = Like.toggle(user_id, message_id)
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+
+    db.session.commit()
+    forget_user(user_id)
+
+    return api_response({'data': {'liked': liked,
+                                  'likes_count': likes_count}})
 
 
 #############################################################################
-# 404 page
+# Error pages
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def page_not_found(e):
     """catchall for 404"""
 
+    if is_api_request():
+        return http_error(e)
+
     return render_template("/errors/404.html"), 404
+
+
+@views.app_errorhandler(HTTPException)
+def http_error(e):
+    """JSON errors for the API; the usual error pages elsewhere."""
+
+    if is_api_request():
+        return api_response({'error': e.description}, e.code)
+
+    return e
+
+
+@views.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Shed load when too many requests are waiting to check passwords."""
+
+    return (render_template("/errors/503.html"),
+            503,
+            {"Retry-After": "5"})
+
+
+#############################################################################
+# Maintenance commands
+
+@views.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Repair drift in the users' denormalized message/follow/like counts."""
+
+    fixed = User.reconcile_counts()
+    db.session.commit()
+    print(f"Reconciled counts for {fixed} user(s).")
+
+
+@views.cli.command('trim-timelines')
+def trim_timelines():
+    """Remove home timeline entries too old to be shown (run periodically)."""
+
+    removed = TimelineEntry.trim()
+    db.session.commit()
+    print(f"Removed {removed} old timeline entries.")
+
+
+@views.cli.command('migrate')
+@click.option('--list', 'list_only', is_flag=True,
+              help="Show applied and pending migrations without applying.")
+def migrate_schema(list_only):
+    """Apply pending schema migrations (see migrate.py)."""
+
+    import migrate
+
+    if list_only:
+        done = migrate.applied(db.engine)
+        for name in migrate.available():
+            print(f"[{'x' if name in done else ' '}] {name}")
+        return
+
+    migrate.upgrade(db.engine)
+    print("Schema is up to date.")
+
+
+# the app gunicorn (app:app), the flask command and the tests use
+app = create_app()
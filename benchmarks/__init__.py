@@ -0,0 +1,8 @@
+"""Performance benchmarks for Warbler.
+
+Run these from the repository root as modules, e.g.
+
+    python -m benchmarks.search_bench --database-url postgresql:///warbler-bench
+
+Each one builds its own dataset, so point them at a scratch database.
+"""
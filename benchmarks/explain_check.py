@@ -0,0 +1,314 @@
+"""Fail if any of the app's hot queries would scan a whole table.
+
+EXPLAINs the queries behind the main pages, searches and write paths
+(pages and searches built by the app's own functions, write paths the
+way models.py builds them) and lists every sequential scan in their
+plans, and every index scan that doesn't narrow the index's leading
+column (i.e. reads all of it), exiting non-zero if there are any:
+
+    python -m benchmarks.explain_check --database-url postgresql:///warbler-bench
+
+Run it against a benchmark-scale database to see the plans production
+would get. On a small database the planner rightly prefers reading tiny
+tables whole, so pass --force-index (seq scans, hash and merge joins
+off): a query that still reads a whole table has no index it could use.
+The tests run it that way, with --analyze (fresh planner statistics).
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import datetime
+
+FORCE_INDEX_SETTINGS = ('enable_seqscan', 'enable_hashjoin', 'enable_mergejoin')
+
+HOT_TABLES = ('users', 'messages', 'follows', 'likes', 'timeline_entries')
+
+# plan nodes that read all of their input before returning a row
+BLOCKING_NODES = {'Sort', 'Incremental Sort', 'Aggregate', 'Hash', 'SetOp',
+                  'WindowAgg', 'Materialize'}
+
+
+def hot_queries(user_id=1, other_id=2, message_id=1, term='hello'):
+    """Map description -> SQLAlchemy query, for the app's hot queries.
+
+    The pages' and searches' queries are built by the same functions the
+    routes use, reading the page after a cursor at `message_id` or
+    `other_id`.
+    """
+
+    from app import (directory_query, follows_query, home_timeline_query,
+                     user_likes_query, user_messages_query)
+    from models import db, User, Message, Follows, Like, TimelineEntry
+    from pagination import encode_cursor, page_query, USERS_PER_PAGE
+    from search import (message_search_query, SEARCH_RESULTS_PER_PAGE,
+                        trigram_installed, user_search_query)
+
+    before_message = encode_cursor(message_id)
+    before_like = encode_cursor(datetime(2020, 1, 1), message_id)
+    before_user = encode_cursor(other_id)
+    some_ids = [user_id, other_id]
+
+    queries = {
+        'users_show: profile messages page': page_query(
+            user_messages_query(user_id),
+            Message.id,
+            before=before_message),
+        'homepage: timeline page': page_query(
+            home_timeline_query(user_id),
+            TimelineEntry.message_id,
+            before=before_message),
+        'show_likes: liked messages page': page_query(
+            user_likes_query(user_id),
+            Like.timestamp, Like.message_id,
+            before=before_like),
+        'show_following: followed users page': page_query(
+            follows_query(user_id,
+                          Follows.user_being_followed_id,
+                          Follows.user_following_id),
+            Follows.user_being_followed_id,
+            before=before_user,
+            per_page=USERS_PER_PAGE),
+        'users_followers: followers page': page_query(
+            follows_query(user_id,
+                          Follows.user_following_id,
+                          Follows.user_being_followed_id),
+            Follows.user_following_id,
+            before=before_user,
+            per_page=USERS_PER_PAGE),
+        'list_users: directory page': page_query(
+            directory_query(),
+            User.id,
+            before=before_user,
+            per_page=USERS_PER_PAGE),
+        'messages_search: results page': (
+            message_search_query(term)
+            .limit(SEARCH_RESULTS_PER_PAGE + 1)),
+        'load_relationships: liked': (
+            db.session.query(Like.message_id)
+            .filter(Like.user_id == user_id,
+                    Like.message_id.in_([message_id]))),
+        'load_relationships: follows both ways': (
+            db.session.query(Follows.user_following_id,
+                             Follows.user_being_followed_id)
+            .filter(db.or_(
+                db.and_(Follows.user_following_id == user_id,
+                        Follows.user_being_followed_id.in_(some_ids)),
+                db.and_(Follows.user_being_followed_id == user_id,
+                        Follows.user_following_id.in_(some_ids))))),
+        'messages_destroy: likers': (
+            db.session.query(Like.user_id)
+            .filter(Like.message_id == message_id)),
+        'delete_user: likers of own messages': (
+            db.session.query(Like.user_id)
+            .join(Message)
+            .filter(Message.user_id == user_id)
+            .distinct()),
+        'fan_out: followers': (
+            db.session.query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id)),
+        'backfill: recent messages': (
+            db.session.query(Message.id)
+            .filter(Message.user_id == other_id)
+            .order_by(Message.id.desc())
+            .limit(TimelineEntry.BACKFILL_LIMIT)),
+        'prune: followed user\'s timeline entries': (
+            TimelineEntry.query
+            .filter_by(owner_id=user_id, author_id=other_id)),
+        'timeline cascade: message deleted': (
+            TimelineEntry.query.filter_by(message_id=message_id)),
+        'reconcile_counts: true counts': (
+            db.session.query(*User.true_counts().values())
+            .filter(User.id.in_(some_ids))),
+    }
+
+    # without pg_trgm, user search can only scan (see search.py)
+    if trigram_installed():
+        queries['list_users: user search page'] = (
+            user_search_query(term).limit(SEARCH_RESULTS_PER_PAGE + 1))
+
+    return queries
+
+
+def typical_ids():
+    """Ids of a user, another user and a message of middling popularity.
+
+    The plans for the most followed users or liked messages can rightly
+    differ (reading most of a table is faster without an index).
+    """
+
+    from models import db, User, Message
+
+    middle_users = (db.session.query(User.id)
+                    .order_by(User.followers_count, User.id)
+                    .offset(User.query.count() // 2)
+                    .limit(2)
+                    .all())
+    message_id = (db.session.query(Message.id)
+                  .order_by(Message.id)
+                  .offset(Message.query.count() // 2)
+                  .limit(1)
+                  .scalar())
+    db.session.rollback()
+
+    if len(middle_users) < 2 or message_id is None:
+        return {}
+
+    (user_id,), (other_id,) = middle_users
+    return {'user_id': user_id, 'other_id': other_id,
+            'message_id': message_id}
+
+
+def full_scans(plan, leading_columns, primary_keys=(), limited=False):
+    """Descriptions of the whole-table or whole-index reads in `plan`.
+
+    An index scan counts as a full scan unless its condition constrains the
+    index's leading column (`leading_columns` maps index name -> column),
+    or it walks a primary key (one of `primary_keys`) in order under a
+    LIMIT, which stops it after a page of rows. `limited` says whether
+    `plan` is read that way, i.e. it's the outer side of everything up to
+    a Limit node.
+    """
+
+    problems = []
+    node = plan.get('Node Type')
+    index = plan.get('Index Name')
+
+    if node == 'Limit':
+        limited = True
+    elif node in BLOCKING_NODES:
+        limited = False
+
+    if node == 'Seq Scan':
+        problems.append(f"seq scan on {plan['Relation Name']}")
+    elif (index and not (limited and index in primary_keys)
+          and not constrains(plan.get('Index Cond', ''),
+                             leading_columns.get(index))):
+        problems.append(f"full scan of index {index}")
+
+    for number, child in enumerate(plan.get('Plans', [])):
+        # only the outer side of a join is read just until the limit;
+        # the inner side is read again for each outer row
+        problems.extend(full_scans(child, leading_columns, primary_keys,
+                                   limited and number == 0))
+
+    return problems
+
+
+def constrains(condition, column):
+    """Does an EXPLAIN index condition restrict `column`?
+
+    `column` is None for an index on an expression (e.g. the text search
+    vector), which is only ever used through a condition on it.
+    """
+
+    if column is None:
+        return bool(condition)
+
+    # comparisons, LIKEs (~~, ~~*) and text search matches (@@), on the
+    # column or on a cast of it, e.g. ((username)::text ~~* '%a%'::text)
+    return bool(re.search(
+        rf'(^|[(\s."]){column}"?(\)::[\w ]+)? (=|<|>|~~|@@)', condition))
+
+
+def leading_columns():
+    """Map index name -> its first column, for the current database."""
+
+    from models import db
+
+    rows = db.session.execute(
+        "SELECT index_class.relname, attname "
+        "FROM pg_index "
+        "JOIN pg_class index_class ON index_class.oid = indexrelid "
+        "JOIN pg_attribute ON attrelid = indrelid AND attnum = indkey[0]")
+    return dict(rows.fetchall())
+
+
+def primary_key_indexes():
+    """Names of the primary key indexes in the current database."""
+
+    from models import db
+
+    rows = db.session.execute(
+        "SELECT relname FROM pg_index JOIN pg_class ON oid = indexrelid "
+        "WHERE indisprimary")
+    return {name for (name,) in rows}
+
+
+def analyze():
+    """Update the planner's statistics for the hot queries' tables."""
+
+    from models import db
+
+    for table in HOT_TABLES:
+        db.session.execute(f"ANALYZE {table}")
+    # the new statistics are rolled back with the transaction otherwise
+    db.session.commit()
+
+
+def explain(query):
+    """The JSON EXPLAIN plan for a SQLAlchemy query (not executed)."""
+
+    from models import db
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    result = db.session.connection().execute(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+    return result.scalar()[0]['Plan']
+
+
+def check(force_index=False, analyze_first=False, **ids):
+    """Map each hot query that reads a whole table or index to how it does.
+
+    `analyze_first` refreshes the tables' statistics first, so plans
+    don't depend on whatever the last autovacuum saw.
+    """
+
+    from models import db
+
+    if analyze_first:
+        analyze()
+
+    if force_index:
+        # without these, tiny tables are read whole (correctly, at that
+        # size) as the cheap side of hash and merge joins
+        for setting in FORCE_INDEX_SETTINGS:
+            db.session.execute(f"SET LOCAL {setting} = off")
+
+    columns = leading_columns()
+    primary_keys = primary_key_indexes()
+    problems = {}
+    for name, query in hot_queries(**ids).items():
+        scans = full_scans(explain(query), columns, primary_keys)
+        if scans:
+            problems[name] = scans
+
+    db.session.rollback()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--force-index', action='store_true',
+                        help="disable seq scans, to check a small database")
+    parser.add_argument('--analyze', action='store_true',
+                        help="ANALYZE the tables first")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+
+    with app.app_context():
+        problems = check(force_index=args.force_index,
+                         analyze_first=args.analyze, **typical_ids())
+
+    print(json.dumps({'full_scans': problems}, indent=2))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
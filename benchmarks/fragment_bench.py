@@ -0,0 +1,91 @@
+"""Measure what the message fragment cache saves on timeline pages.
+
+Builds a small dataset in a scratch database, renders a 100-message
+profile timeline for several viewers with the fragment cache cleared
+before every page (cold) and left warm, and prints JSON with the cache's
+hit rate and the render time per page:
+
+    python -m benchmarks.fragment_bench --database-url postgresql:///warbler-bench
+
+The database's tables are dropped and recreated.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+
+def populate(db, User, Message, num_viewers):
+    """Recreate the schema with one author (100 messages) and viewers."""
+
+    db.drop_all()
+    db.create_all()
+
+    author = User(username="author", email="author@example.com",
+                  password="not-a-real-hash")
+    viewers = [User(username=f"viewer{i}", email=f"viewer{i}@example.com",
+                    password="not-a-real-hash")
+               for i in range(num_viewers)]
+    db.session.add_all([author, *viewers])
+    db.session.add_all([Message(text=f"Message number {i}", user=author)
+                        for i in range(100)])
+    db.session.commit()
+
+    return author.id, [viewer.id for viewer in viewers]
+
+
+def time_pages(client, CURR_USER_KEY, url, viewer_ids, rounds, before_page):
+    """Milliseconds per page for `url` across viewers and rounds."""
+
+    samples = []
+
+    for _ in range(rounds):
+        for viewer_id in viewer_ids:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer_id
+
+            before_page()
+            start = time.perf_counter()
+            client.get(url)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    return round(statistics.median(samples), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--viewers', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app, CURR_USER_KEY
+    from fragments import fragment_cache
+    from models import db, User, Message
+
+    with app.app_context():
+        author_id, viewer_ids = populate(db, User, Message, args.viewers)
+
+    client = app.test_client()
+    url = f"/users/{author_id}"
+
+    cold_ms = time_pages(client, CURR_USER_KEY, url, viewer_ids, args.rounds,
+                         fragment_cache.clear)
+
+    fragment_cache.clear()
+    warm_ms = time_pages(client, CURR_USER_KEY, url, viewer_ids, args.rounds,
+                         lambda: None)
+
+    print(json.dumps({
+        'cold_page_ms': cold_ms,
+        'warm_page_ms': warm_ms,
+        'fragment_cache': fragment_cache.stats(),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""Load-test Warbler with concurrent scripted user sessions.
+
+Generates and loads a dataset of the requested size (with
+generator/create_csvs.py and seed.py), logs a number of users in, and has
+each one browse and click through a weighted mix of the main routes for a
+fixed time, all at once. Requests go to the app in-process (Flask's test
+client) or to a gunicorn it starts locally. Prints JSON with throughput
+and latency percentiles per route:
+
+    python -m benchmarks.load_bench --database-url postgresql:///warbler-bench \
+        --users 10000 --messages 100000 --sessions 16 --seconds 30
+
+    python -m benchmarks.load_bench --database-url postgresql:///warbler-bench \
+        --skip-populate --gunicorn --workers 4 --output after.json \
+        --compare before.json
+
+--compare prints each route's change against an earlier report. The
+database's tables are dropped and recreated unless --skip-populate is given.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks.stats import percentile
+
+# route name -> relative weight in each session's mix
+ROUTE_MIX = {
+    'homepage': 40,
+    'users_show': 25,
+    'list_users': 10,
+    'handle_like': 15,
+    'toggle_follow': 10,
+}
+
+# generator/create_csvs.py gives every user this password
+PASSWORD = 'password'
+
+# how many message ids sessions pick the ones they like from
+MESSAGE_SAMPLE = 10_000
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class TestClientSession:
+    """A logged-in user's requests, sent to the app in-process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        response = self.client.open(path, method=method, data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPSession:
+    """A logged-in user's requests, over one keep-alive HTTP connection."""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        text = response.read().decode('UTF-8')
+
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';')[0]
+
+        return response.status, text
+
+
+def log_in(session, username):
+    """Log `session` in through the login form (CSRF token and all)."""
+
+    _, page = session.request('GET', '/login')
+    match = CSRF_TOKEN.search(page)
+    form = {'username': username, 'password': PASSWORD}
+    if match:
+        form['csrf_token'] = match.group(1)
+
+    status, _ = session.request('POST', '/login', form)
+    if status != 302:
+        raise RuntimeError(f"couldn't log in as {username} ({status})")
+
+
+def next_request(rng, user_id, num_users, message_ids):
+    """(route name, method, path) for a session's next click."""
+
+    route = rng.choices(list(ROUTE_MIX), weights=list(ROUTE_MIX.values()))[0]
+    other_id = rng.randint(1, num_users)
+    while other_id == user_id and num_users > 1:
+        other_id = rng.randint(1, num_users)
+
+    return route, *{
+        'homepage': ('GET', '/'),
+        'users_show': ('GET', f'/users/{other_id}'),
+        'list_users': ('GET', '/users'),
+        'handle_like': ('POST',
+                        f'/messages/{rng.choice(message_ids)}/handle-like'),
+        'toggle_follow': ('POST', f'/users/handlefollow/{other_id}'),
+    }[route]
+
+
+def run_session(session, user_id, args, message_ids, deadline, samples,
+                errors, seed):
+    """Click through the route mix as `user_id` until `deadline`."""
+
+    rng = random.Random(seed)
+
+    while time.perf_counter() < deadline:
+        route, method, path = next_request(rng, user_id, args.users,
+                                           message_ids)
+        start = time.perf_counter()
+        try:
+            status, _ = session.request(method, path)
+        except (OSError, http.client.HTTPException):
+            status = None
+        elapsed = time.perf_counter() - start
+
+        samples[route].append(elapsed * 1000)
+        if status is None or status >= 500:
+            errors[route] += 1
+
+
+def populate(args):
+    """Generate and load a dataset of the requested size."""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--users', str(args.users),
+                        '--messages', str(args.messages),
+                        '--seed', str(args.seed),
+                        '--out-dir', data_dir], check=True)
+        subprocess.run([sys.executable, 'seed.py', '--drop',
+                        '--database-url', args.database_url,
+                        '--data-dir', data_dir], check=True)
+
+
+def start_gunicorn(args):
+    """Start gunicorn on args.port; returns the process once it answers."""
+
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    process = subprocess.Popen(
+        ['gunicorn', 'app:app', '--workers', str(args.workers),
+         '--bind', f'127.0.0.1:{args.port}'],
+        env=env)
+
+    for _ in range(100):
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', args.port)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def summarize(samples, errors, seconds):
+    """Per-route count, errors, requests/sec and latency percentiles."""
+
+    report = {}
+
+    for route, times in sorted(samples.items()):
+        if not times:
+            continue
+        report[route] = {
+            'requests': len(times),
+            'errors': errors[route],
+            'requests_per_sec': round(len(times) / seconds, 1),
+            'p50_ms': round(percentile(times, 50), 2),
+            'p95_ms': round(percentile(times, 95), 2),
+            'p99_ms': round(percentile(times, 99), 2),
+        }
+
+    return report
+
+
+def compare(report, earlier):
+    """Print each route's change in throughput and latency vs `earlier`."""
+
+    for route, now in report['routes'].items():
+        before = earlier.get('routes', {}).get(route)
+        if not before:
+            continue
+
+        changes = []
+        for key in ('requests_per_sec', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if before[key]:
+                change = (now[key] - before[key]) / before[key] * 100
+                changes.append(f"{key} {change:+.0f}%")
+
+        print(f"{route}: {', '.join(changes)}", file=sys.stderr)
+
+
+def git_revision():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--sessions', type=int, default=8,
+                        help="concurrent logged-in users")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-populate', action='store_true',
+                        help="reuse data from an earlier run")
+    parser.add_argument('--gunicorn', action='store_true',
+                        help="serve with a local gunicorn, not in-process")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help="also write the JSON report here")
+    parser.add_argument('--compare', help="earlier JSON report to diff with")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    if not args.skip_populate:
+        populate(args)
+
+    from app import app
+    from models import db, User, Message
+
+    with app.app_context():
+        users = (db.session.query(User.id, User.username)
+                 .order_by(User.id)
+                 .limit(args.sessions)
+                 .all())
+        # ids are snowflakes, so can't be guessed; pick from a sample
+        message_ids = [id for id, in (db.session.query(Message.id)
+                                      .order_by(db.func.random())
+                                      .limit(MESSAGE_SAMPLE))]
+        db.session.remove()
+
+    if args.gunicorn:
+        server = start_gunicorn(args)
+        make_session = lambda: HTTPSession('127.0.0.1', args.port)
+    else:
+        server = None
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['DEBUG_TB_ENABLED'] = False
+        make_session = lambda: TestClientSession(app)
+
+    try:
+        # logging in (bcrypt) isn't part of what's measured
+        sessions = []
+        for user_id, username in users:
+            session = make_session()
+            log_in(session, username)
+            sessions.append((session, user_id))
+
+        samples = {route: [] for route in ROUTE_MIX}
+        errors = {route: 0 for route in ROUTE_MIX}
+        start = time.perf_counter()
+        deadline = start + args.seconds
+
+        threads = [threading.Thread(target=run_session,
+                                    args=(session, user_id, args,
+                                          message_ids, deadline, samples,
+                                          errors, args.seed + i))
+                   for i, (session, user_id) in enumerate(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    seconds = time.perf_counter() - start
+    routes = summarize(samples, errors, seconds)
+
+    report = {
+        'revision': git_revision(),
+        'mode': 'gunicorn' if args.gunicorn else 'in-process',
+        'users': args.users,
+        'messages': args.messages,
+        'sessions': len(users),
+        'seconds': round(seconds, 1),
+        'requests_per_sec': round(sum(r['requests'] for r in routes.values())
+                                  / seconds, 1),
+        'routes': routes,
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark user and message search latency at scale.
+
+Fills a scratch Postgres database with synthetic users (1M by default) and
+messages using generate_series, builds the search indexes, then times
+search_users / search_messages for a mix of queries and prints JSON:
+
+    python -m benchmarks.search_bench \
+        --database-url postgresql:///warbler-bench --users 1000000
+
+The database's tables are dropped and recreated.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+from benchmarks.stats import percentile
+
+WORDS = ['owl', 'sparrow', 'finch', 'heron', 'robin', 'wren', 'crow', 'hawk',
+         'dawn', 'dusk', 'river', 'forest', 'meadow', 'song', 'nest', 'flight']
+
+USER_QUERIES = ['owl', 'sparrow42', 'robin9', 'forest', 'Oakland', 'zzz']
+MESSAGE_QUERIES = ['owl', 'heron song', 'dawn flight', 'nest', 'zzz']
+
+
+def random_word_sql(seed_column, offset):
+    """SQL picking a pseudo-random word from WORDS based on a column."""
+
+    words = ','.join(f"'{word}'" for word in WORDS)
+    return (f"(ARRAY[{words}])"
+            f"[1 + (({seed_column} * {offset}) % {len(WORDS)})]")
+
+
+def populate(db, num_users, num_messages):
+    """Recreate the schema and bulk fill it with generate_series."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(f"""
+        INSERT INTO users (email, username, password, bio, location)
+        SELECT 'user' || i || '@example.com',
+               {random_word_sql('i', 7)} || i,
+               'not-a-real-hash',
+               'I like ' || {random_word_sql('i', 13)} || ' and '
+                   || {random_word_sql('i', 31)},
+               (ARRAY['Oakland', 'Reno', 'Boston', 'Austin'])[1 + i % 4]
+        FROM generate_series(1, {num_users}) AS i
+    """)
+
+    db.session.execute(f"""
+        INSERT INTO messages (id, text, timestamp, user_id)
+        SELECT i,
+               {random_word_sql('i', 3)} || ' ' || {random_word_sql('i', 11)}
+                   || ' at ' || {random_word_sql('i', 17)},
+               now() - (({num_messages} - i) || ' seconds')::interval,
+               1 + (i::bigint * 7919) % {num_users}
+        FROM generate_series(1, {num_messages}) AS i
+    """)
+
+    db.session.commit()
+    db.session.execute("ANALYZE users")
+    db.session.execute("ANALYZE messages")
+    db.session.commit()
+
+
+def time_queries(search, queries, repeat):
+    """Time `search(query)` `repeat` times per query; return stats in ms."""
+
+    results = {}
+
+    for query in queries:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            search(query)
+            samples.append((time.perf_counter() - start) * 1000)
+
+        results[query] = {
+            'p50_ms': round(statistics.median(samples), 2),
+            'p95_ms': round(percentile(samples, 95), 2),
+            'max_ms': round(max(samples), 2),
+        }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--skip-populate', action='store_true',
+                        help="reuse data from an earlier run")
+    args = parser.parse_args()
+
+    # like the tests, choose the database before the app connects to one
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db
+    from search import search_users, search_messages, trigram_installed
+
+    with app.app_context():
+        if not args.skip_populate:
+            start = time.perf_counter()
+            populate(db, args.users, args.messages)
+            populate_secs = round(time.perf_counter() - start, 1)
+        else:
+            populate_secs = None
+
+        report = {
+            'users': args.users,
+            'messages': args.messages,
+            'populate_seconds': populate_secs,
+            'pg_trgm': trigram_installed(),
+            'search_users': time_queries(search_users, USER_QUERIES,
+                                         args.repeat),
+            'search_messages': time_queries(search_messages, MESSAGE_QUERIES,
+                                            args.repeat),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
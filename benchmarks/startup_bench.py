@@ -0,0 +1,106 @@
+"""Measure how long a fresh process takes to import and build the app.
+
+That's what every gunicorn worker pays at boot without --preload (and the
+master pays once with it). Starts a new interpreter per run and profile,
+times `import app` (which builds the default app) and then another
+`create_app()`, and prints JSON with the medians, p95s and the modules
+slowest to import:
+
+    python -m benchmarks.startup_bench --runs 20
+
+No database is needed: building the app doesn't connect to one.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.stats import percentile
+
+PROFILES = ['production', 'development', 'testing']
+
+# run in each fresh interpreter
+CHILD = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+built = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'create_app_ms': (built - imported) * 1000}))
+"""
+
+
+def summary(samples):
+    return {'median': round(statistics.median(samples), 1),
+            'p95': round(percentile(samples, 95), 1)}
+
+
+def child_env(profile):
+    return {**os.environ, 'WARBLER_PROFILE': profile, 'FLASK_ENV': ''}
+
+
+def time_profile(profile, runs):
+    """Process, import and build times (ms) for `runs` fresh processes."""
+
+    times = {'process_ms': [], 'import_ms': [], 'create_app_ms': []}
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', CHILD],
+                                env=child_env(profile), check=True,
+                                capture_output=True, text=True).stdout
+        times['process_ms'].append((time.perf_counter() - start) * 1000)
+
+        for name, value in json.loads(output.splitlines()[-1]).items():
+            times[name].append(value)
+
+    return {name: summary(samples) for name, samples in times.items()}
+
+
+def slowest_imports(profile, count):
+    """The `count` modules with the most import time of their own (ms)."""
+
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import app'],
+                            env=child_env(profile), check=True,
+                            capture_output=True, text=True).stderr
+
+    modules = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(own) / 1000, int(cumulative) / 1000,
+                        name.strip()))
+
+    modules.sort(reverse=True)
+    return [{'module': name, 'self_ms': round(own, 1),
+             'cumulative_ms': round(cumulative, 1)}
+            for own, cumulative, name in modules[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES,
+                        default=PROFILES)
+    parser.add_argument('--top', type=int, default=15,
+                        help="how many of the slowest imports to list")
+    args = parser.parse_args()
+
+    report = {profile: time_profile(profile, args.runs)
+              for profile in args.profiles}
+    report['slowest_imports'] = slowest_imports(args.profiles[0], args.top)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""Summary statistics shared by the benchmarks."""
+
+
+def percentile(samples, pct):
+    """The `pct`th percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = max(0, round(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
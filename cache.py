@@ -0,0 +1,569 @@
+"""Caching for Warbler.
+
+`cache` is the current app's cache (see extensions.py). It stores values
+under namespaced keys in a pluggable backend, chosen by the CACHE_URL
+config:
+
+- memory:// (default): an in-process LRU, one per worker
+- redis://host:port/db: anything speaking the Redis protocol, shared by
+  all workers; `StandInServer` is a tiny local one for tests and dev
+
+Rows cached for the read routes (users, messages) are stored as column
+dicts and come back as instances attached to the session without a query.
+Write paths must call the matching `forget_*` function.
+"""
+
+import logging
+import pickle
+import socket
+import socketserver
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic
+from urllib.parse import urlparse
+
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from extensions import AppExtension
+from metrics import CACHE_ERRORS
+from models import db, User, Message
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """A thread-safe, size-bounded cache with optional per-entry expiry.
+
+    When full, the least recently used entry is evicted. Entries older than
+    their TTL (in seconds) are treated as missing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Value for `key`, or `default` if it's missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or (entry[1] is not None
+                                 and entry[1] <= monotonic()):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store `value` for `key`, expiring after `ttl` (or the default)."""
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`, if it's cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+##############################################################################
+# Backends
+
+
+class CacheBackend(ABC):
+    """Interface for cache storage. Values are any picklable object.
+
+    Backends raise OSError (e.g. ConnectionError, socket.timeout) when
+    their storage can't be reached.
+    """
+
+    @abstractmethod
+    def get_many(self, keys):
+        """Map of key -> value for those of `keys` that are cached."""
+
+    @abstractmethod
+    def set_many(self, mapping, ttl=None):
+        """Store every key -> value in `mapping` for `ttl` seconds."""
+
+    @abstractmethod
+    def delete_many(self, keys):
+        """Forget all of `keys`."""
+
+    @abstractmethod
+    def clear(self):
+        """Forget everything."""
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process backend on an `LRUCache`."""
+
+    def __init__(self, maxsize=10000):
+        self.entries = LRUCache(maxsize=maxsize)
+
+    def get_many(self, keys):
+        missing = object()
+        found = {key: self.entries.get(key, missing) for key in keys}
+        return {key: value for key, value in found.items()
+                if value is not missing}
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.entries.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class RESPError(Exception):
+    """The server answered a command with an error."""
+
+
+class RedisBackend(CacheBackend):
+    """Backend speaking the Redis protocol (RESP) over one socket."""
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=1.0):
+        self.address = (host, port)
+        self.db = db
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = Lock()
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        return cls(parsed.hostname or 'localhost', parsed.port or 6379, db)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        values = self.execute('MGET', *keys)
+        return {key: pickle.loads(value)
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping, ttl=None):
+        commands = []
+        for key, value in mapping.items():
+            command = ['SET', key, pickle.dumps(value)]
+            if ttl:
+                command += ['PX', int(ttl * 1000)]
+            commands.append(command)
+
+        self.pipeline(commands)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if keys:
+            self.execute('DEL', *keys)
+
+    def clear(self):
+        self.execute('FLUSHDB')
+
+    def execute(self, *command):
+        """Send one command and return its reply."""
+
+        return self.pipeline([command])[0]
+
+    def pipeline(self, commands):
+        """Send `commands` in one round trip; return their replies."""
+
+        payload = b''.join(encode_command(command) for command in commands)
+
+        with self._lock:
+            try:
+                self._connect()
+                self._sock.sendall(payload)
+                replies = [read_reply(self._file) for _ in commands]
+            except OSError:
+                self._disconnect()
+                raise
+
+        for reply in replies:
+            if isinstance(reply, RESPError):
+                raise reply
+        return replies
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address, self.timeout)
+            self._file = self._sock.makefile('rb')
+            if self.db:
+                self._sock.sendall(encode_command(['SELECT', self.db]))
+                read_reply(self._file)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+
+def encode_command(command):
+    """RESP encoding of a command: an array of bulk strings."""
+
+    parts = [b'*%d\r\n' % len(command)]
+    for arg in command:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('UTF-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(file):
+    """Read one RESP reply from `file`."""
+
+    line = file.readline()
+    if not line:
+        raise ConnectionError("cache server closed the connection")
+
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode('UTF-8')
+    if kind == b'-':
+        return RESPError(rest.decode('UTF-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length == -1:
+            return None
+        data = file.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length == -1:
+            return None
+        return [read_reply(file) for _ in range(length)]
+
+    raise ConnectionError(f"unexpected reply from cache server: {line!r}")
+
+
+##############################################################################
+# Stand-in server
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """In-memory server for the Redis commands `RedisBackend` uses.
+
+    For tests and local dev only: start one with `StandInServer.start()`
+    and point CACHE_URL at `server.url`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, StandInHandler)
+        self.data = {}
+        self.expires = {}
+        self.lock = Lock()
+
+    @classmethod
+    def start(cls, address=('127.0.0.1', 0)):
+        """Start a server on a background thread and return it."""
+
+        server = cls(address)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def lookup(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def run(self, name, args):
+        """Run one command; return its reply (or a RESPError)."""
+
+        with self.lock:
+            if name == 'PING':
+                return 'PONG'
+            if name in ('SELECT', 'FLUSHDB'):
+                if name == 'FLUSHDB':
+                    self.data.clear()
+                    self.expires.clear()
+                return 'OK'
+            if name == 'GET':
+                return self.lookup(args[0])
+            if name == 'MGET':
+                return [self.lookup(key) for key in args]
+            if name == 'SET':
+                key, value = args[0], args[1]
+                self.data[key] = value
+                self.expires.pop(key, None)
+                if len(args) == 4 and args[2].upper() == b'PX':
+                    self.expires[key] = monotonic() + int(args[3]) / 1000
+                return 'OK'
+            if name == 'DEL':
+                found = [key for key in args if self.lookup(key) is not None]
+                for key in found:
+                    self.data.pop(key, None)
+                    self.expires.pop(key, None)
+                return len(found)
+
+        return RESPError(f"ERR unknown command '{name}'")
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    """Reads commands from one connection and writes their replies."""
+
+    def handle(self):
+        while True:
+            try:
+                command = read_reply(self.rfile)
+            except ConnectionError:
+                return
+
+            name, args = command[0].decode('UTF-8').upper(), command[1:]
+            self.wfile.write(encode_reply(self.server.run(name, args)))
+
+
+def encode_reply(reply):
+    """RESP encoding of a reply."""
+
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, RESPError):
+        return b'-%s\r\n' % str(reply).encode('UTF-8')
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('UTF-8')
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return (b'*%d\r\n' % len(reply)
+            + b''.join(encode_reply(item) for item in reply))
+
+
+##############################################################################
+# Namespaced keys
+
+
+class Cache:
+    """The app's cache: namespaced keys over a backend.
+
+    Keys look like `warbler:users:42`. Each value is forgotten by its
+    writer (`delete`) or ages out with its TTL; there is no namespace-wide
+    flush, which would cost a round trip on every read to look up.
+
+    The cache is an optimization, so a backend that can't be reached
+    (OSError) is logged and counted, not raised: reads miss, and the
+    caller goes to the database instead; writes are skipped.
+    """
+
+    def __init__(self, backend=None, prefix='warbler', ttl=300):
+        self.backend = backend or MemoryBackend()
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def make_key(self, namespace, key):
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def get(self, namespace, key, default=None):
+        return self.get_many(namespace, [key]).get(key, default)
+
+    def get_many(self, namespace, keys):
+        """Map of key -> value for those of `keys` cached in `namespace`."""
+
+        try:
+            full_keys = {self.make_key(namespace, key): key
+                         for key in keys}
+            found = self.backend.get_many(full_keys)
+        except OSError:
+            self.backend_failed('get')
+            return {}
+
+        return {full_keys[full_key]: value
+                for full_key, value in found.items()}
+
+    def set(self, namespace, key, value, ttl=None):
+        self.set_many(namespace, {key: value}, ttl)
+
+    def set_many(self, namespace, mapping, ttl=None):
+        try:
+            self.backend.set_many(
+                {self.make_key(namespace, key): value
+                 for key, value in mapping.items()},
+                self.ttl if ttl is None else ttl)
+        except OSError:
+            self.backend_failed('set')
+
+    def delete(self, namespace, *keys):
+        try:
+            self.backend.delete_many(
+                [self.make_key(namespace, key) for key in keys])
+        except OSError:
+            # what was cached stays until its TTL runs out
+            self.backend_failed('delete')
+
+    def backend_failed(self, operation):
+        """Log and count a backend error while handling one."""
+
+        logger.warning("Cache %s failed; carrying on without the cache",
+                       operation, exc_info=True)
+        CACHE_ERRORS.inc(operation)
+
+
+def app_cache(app):
+    """A Cache for `app`, on the backend CACHE_URL picks (memory:// by
+    default); without an app, an in-memory one."""
+
+    if app is None:
+        return Cache()
+
+    url = app.config.get('CACHE_URL') or 'memory://'
+    backend = (RedisBackend.from_url(url) if url.startswith('redis://')
+               else MemoryBackend())
+    return Cache(backend, ttl=app.config.get('CACHE_DEFAULT_TTL', 300))
+
+
+cache = AppExtension('cache', app_cache)
+
+
+##############################################################################
+# Cached rows for the read routes
+#
+# Users are cached with the columns needed to render them (not the password
+# hash). Anything that changes those columns must call `forget_user`; the
+# TTL bounds staleness from paths that can't, e.g. counts changed by
+# another user's action. Messages can't be edited, only deleted; with the
+# per-process memory backend, `forget_message` only reaches the deleting
+# process, so other workers can show a deleted message until its TTL.
+
+USER_CACHE_COLUMNS = ('id', 'email', 'username', 'image_url',
+                      'header_image_url', 'bio', 'location',
+                      'messages_count', 'following_count', 'followers_count',
+                      'likes_count', 'profile_version')
+
+USER_CACHE_TTL = 30
+
+MESSAGE_CACHE_COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+
+MESSAGE_CACHE_TTL = 30
+
+
+def attach(model, columns):
+    """An instance of `model` built from cached `columns`, in the session.
+
+    No query is issued; columns that weren't cached load on first access.
+    """
+
+    instance = model(**columns)
+    make_transient_to_detached(instance)
+    return db.session.merge(instance, load=False)
+
+
+def load_users(user_ids):
+    """Map of id -> User for those of `user_ids` that exist, via the cache."""
+
+    user_ids = list(user_ids)
+    cached = cache.get_many('users', user_ids)
+    users = {id: attach(User, columns) for id, columns in cached.items()}
+
+    missing = [id for id in user_ids if id not in cached]
+    if missing:
+        fetched = User.query.filter(User.id.in_(missing)).all()
+        cache.set_many('users',
+                       {user.id: {column: getattr(user, column)
+                                  for column in USER_CACHE_COLUMNS}
+                        for user in fetched},
+                       USER_CACHE_TTL)
+        users.update((user.id, user) for user in fetched)
+
+    return users
+
+
+def load_user(user_id):
+    """Get the User with `user_id` (or None), from the cache if possible."""
+
+    return load_users([user_id]).get(user_id)
+
+
+def forget_user(*user_ids):
+    """Drop the cached copies of these users."""
+
+    cache.delete('users', *user_ids)
+
+
+def load_message(message_id):
+    """Get the Message with `message_id` and its author (or None), cached."""
+
+    columns = cache.get('messages', message_id)
+
+    if columns is None:
+        message = Message.query.get(message_id)
+        if message is None:
+            return None
+
+        cache.set('messages', message_id,
+                  {column: getattr(message, column)
+                   for column in MESSAGE_CACHE_COLUMNS},
+                  MESSAGE_CACHE_TTL)
+    else:
+        message = attach(Message, columns)
+
+    author = load_user(message.user_id)
+    if author is None:
+        # the author was deleted, taking the message with them
+        forget_message(message_id)
+        return None
+
+    # attach the author from the cache too, so there's no lazy load
+    set_committed_value(message, 'user', author)
+    return message
+
+
+def forget_message(message_id):
+    """Drop the cached copy of a message."""
+
+    cache.delete('messages', message_id)
@@ -0,0 +1,119 @@
+"""Configuration profiles for `create_app`.
+
+Every profile starts from the settings read from the environment
+(DATABASE_URL, CACHE_URL and so on), then adjusts them:
+
+- production (the default): no debug toolbar or other development aids
+- development: debug mode and the debug toolbar
+- testing: no CSRF, strict query budgets and cheap, in-process password
+  hashing, on the warbler-test database unless DATABASE_URL says otherwise
+
+WARBLER_PROFILE picks the profile of the app `app.py` builds at import;
+without it, FLASK_ENV=development picks development.
+"""
+
+import os
+from collections.abc import Mapping
+
+PROFILES = {
+    'production': {},
+    'development': {
+        'DEBUG': True,
+        'DEBUG_TB_ENABLED': True,
+        'DEBUG_TB_INTERCEPT_REDIRECTS': False,
+    },
+    'testing': {
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'QUERY_BUDGET_STRICT': True,
+        'BCRYPT_LOG_ROUNDS': 4,
+        'PASSWORD_HASH_WORKERS': 0,
+    },
+}
+
+# the database of each profile when DATABASE_URL isn't set
+DEFAULT_DATABASE_URLS = {
+    'testing': "postgresql:///warbler-test",
+}
+
+
+def environment_config(profile='production'):
+    """Settings from the environment, shared by every profile."""
+
+    env = os.environ
+
+    return {
+        # Get DB_URI from environ variable (useful for production/testing)
+        # or, if not set there, use the profile's local db.
+        'SQLALCHEMY_DATABASE_URI': env.get(
+            'DATABASE_URL',
+            DEFAULT_DATABASE_URLS.get(profile, 'postgres:///warbler')),
+        # read replicas, as a comma-separated list of database URLs
+        'DATABASE_REPLICA_URLS': [
+            url for url in env.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url],
+        'DATABASE_STICKY_SECONDS': float(
+            env.get('DATABASE_STICKY_SECONDS', 10)),
+        'DATABASE_POOL_SIZE': int(env.get('DATABASE_POOL_SIZE', 5)),
+        'DATABASE_MAX_OVERFLOW': int(env.get('DATABASE_MAX_OVERFLOW', 10)),
+        'DATABASE_POOL_TIMEOUT': int(env.get('DATABASE_POOL_TIMEOUT', 30)),
+        'DATABASE_POOL_RECYCLE': int(
+            env.get('DATABASE_POOL_RECYCLE', 30 * 60)),
+        'DATABASE_POOL_PRE_PING': env.get('DATABASE_POOL_PRE_PING',
+                                          '1') != '0',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_ECHO': False,
+        'DEBUG_TB_ENABLED': False,
+        'SECRET_KEY': env.get('SECRET_KEY', "it's a secret"),
+        'CACHE_URL': env.get('CACHE_URL', 'memory://'),
+        # where new-message notices go: memory:// (one process) or Postgres
+        'LIVE_URL': env.get('LIVE_URL', 'memory://'),
+        # the first of the worker ids this host's processes lease for
+        # message ids, and how many (see snowflake.py); without it, any
+        # free id is leased
+        'SNOWFLAKE_WORKER_ID': (int(env['SNOWFLAKE_WORKER_ID'])
+                                if env.get('SNOWFLAKE_WORKER_ID') else None),
+        'SNOWFLAKE_WORKER_IDS': int(env.get('SNOWFLAKE_WORKER_IDS', 16)),
+        'LIVE_STREAM_SECONDS': 55,
+        'LIVE_POLL_SECONDS': 25,
+        # most streams and long polls waiting at once in a process, each
+        # holding a thread; keep it well under the worker's threads
+        'LIVE_MAX_STREAMS': int(env.get('LIVE_MAX_STREAMS', 16)),
+        # static files not linked through `static_url` (e.g. images in CSS)
+        'SEND_FILE_MAX_AGE_DEFAULT': 60 * 60,
+        'QUERY_BUDGET_STRICT': bool(env.get('QUERY_BUDGET_STRICT')),
+        'BCRYPT_LOG_ROUNDS': int(env.get('BCRYPT_LOG_ROUNDS', 12)),
+        'PASSWORD_HASH_WORKERS': int(env.get('PASSWORD_HASH_WORKERS', 2)),
+    }
+
+
+def default_profile():
+    if os.environ.get('WARBLER_PROFILE'):
+        return os.environ['WARBLER_PROFILE']
+
+    if os.environ.get('FLASK_ENV') == 'development':
+        return 'development'
+
+    return 'production'
+
+
+def load_config(config=None):
+    """The settings for `config`.
+
+    That's a profile name, or a mapping of settings to apply over the
+    default profile. Raises ValueError for an unknown profile.
+    """
+
+    overrides = {}
+    if config is None or isinstance(config, Mapping):
+        overrides = dict(config or {})
+        config = default_profile()
+
+    if config not in PROFILES:
+        raise ValueError(f"Unknown profile {config!r}; expected one of "
+                         f"{', '.join(PROFILES)}")
+
+    return {**environment_config(config),
+            'PROFILE': config,
+            **PROFILES[config],
+            **overrides}
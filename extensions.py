@@ -0,0 +1,46 @@
+"""Per-app state for Warbler's shared extensions.
+
+As with Flask's own extensions, each app `create_app` builds keeps its own
+cache backend, live updates hub and password hasher in `app.extensions`,
+so building a second app (in the tests, say) doesn't re-point the first.
+The module-level names (`cache.cache`, `live.live_updates`,
+`passwords.hasher`) are `AppExtension`s that stand for the current app's
+instance; outside an app context they stand for a default one.
+"""
+
+from flask import current_app, has_app_context
+
+
+class AppExtension:
+    """Stands for the current app's instance of an extension.
+
+    `factory(app)` builds the instance `init_app` stores for `app`;
+    `factory(None)` builds the default, used outside an app context and
+    by apps that never called `init_app`. Attributes are looked up on the
+    current instance.
+    """
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._default = factory(None)
+
+    def init_app(self, app):
+        app.extensions[self._name] = self._factory(app)
+
+    def current(self):
+        """The instance for the current app, or the default one.
+
+        Keep this, rather than the extension, for use after the request
+        (e.g. in `call_on_close`), when there may be no app context.
+        """
+
+        if has_app_context():
+            return current_app.extensions.get(self._name, self._default)
+        return self._default
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __repr__(self):
+        return f"<AppExtension {self._name!r}: {self.current()!r}>"
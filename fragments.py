@@ -0,0 +1,110 @@
+"""Cache of rendered message list items.
+
+A message's `<li>` is the same for every viewer except for the like star,
+so it's rendered once, cached (keyed by message id and the author's
+profile_version) and the viewer's like button is spliced in per request.
+"""
+
+from threading import Lock
+from time import perf_counter
+
+from flask import g, render_template
+from markupsafe import Markup
+
+from cache import LRUCache
+
+LIKE_SLOT = '<!-- like-slot -->'
+
+LIKE_BUTTON = (
+    '<p>'
+    '<form method="#" class="like-form" data-message-id="{id}">'
+    '<button class="like"><i class="{style} fa-star"></i></button>'
+    '</form>'
+    '</p>'
+)
+
+
+def like_button(message):
+    """The viewer's like button for `message` (none on their own)."""
+
+    if g.user and g.user.id == message.user_id:
+        return ''
+
+    style = 'fas' if g.user and g.user.has_liked(message) else 'far'
+    return LIKE_BUTTON.format(id=message.id, style=style)
+
+
+class FragmentCache:
+    """LRU cache of rendered messages, with hit/render-time stats.
+
+    Thread safe; the stats are exported at /metrics (see metrics.py).
+    """
+
+    def __init__(self, maxsize=10000):
+        self.fragments = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+        self._lock = Lock()
+
+    @staticmethod
+    def key(message):
+        return (message.id, message.user.profile_version)
+
+    def render_message(self, message):
+        """`message`'s list item for the current viewer."""
+
+        key = self.key(message)
+        parts = self.fragments.get(key)
+
+        if parts is None:
+            start = perf_counter()
+            html = render_template('messages/_message.html',
+                                   message=message,
+                                   like_slot=Markup(LIKE_SLOT))
+            parts = tuple(html.split(LIKE_SLOT))
+            self.fragments.set(key, parts)
+            with self._lock:
+                self.render_seconds += perf_counter() - start
+                self.misses += 1
+        else:
+            with self._lock:
+                self.hits += 1
+
+        return Markup(like_button(message).join(parts))
+
+    def forget_message(self, message):
+        """Drop `message`'s fragment (e.g. once it's deleted)."""
+
+        self.fragments.delete(self.key(message))
+
+    def clear(self):
+        """Forget every fragment and reset the stats."""
+
+        self.fragments.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.render_seconds = 0.0
+
+    def stats(self):
+        """Hit rate and estimated render time saved by cache hits."""
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            render_seconds = self.render_seconds
+
+        lookups = hits + misses
+        average_render = render_seconds / misses if misses else 0
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'render_seconds': render_seconds,
+            'saved_seconds': hits * average_render,
+            'size': len(self.fragments),
+        }
+
+
+fragment_cache = FragmentCache()
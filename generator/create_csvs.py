@@ -2,76 +2,272 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a production-sized
+dataset for benchmarking:
+
+    python generator/create_csvs.py --users 1000000 --messages 100000000 \
+        --out-dir /data/warbler --processes 8
+
+Runs offline, and the same arguments (--seed and --shard-size in
+particular) always give the same files, whatever --processes is. Rows are
+written as they're made, one shard per task; shards are then joined into
+users.csv, messages.csv, follows.csv and likes.csv for seed.py to load.
+
+Popularity follows power laws: a few users have most of the followers and
+write most of the messages, a few messages get most of the likes, and how
+many users each user follows (or messages they like) is heavy tailed too.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from time import perf_counter
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from helpers import (shard_rng, zipf_rank, scatter, heavy_tailed_count,
+                     snowflake)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'timestamp']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
 
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+WORDS = LoremProvider.word_list
+FAKER_POOL_SIZE = 1000
+
+# power-law exponents: how concentrated followers, authorship and likes are
+FOLLOWED_EXPONENT = 1.1
+AUTHOR_EXPONENT = 1.2
+LIKED_EXPONENT = 1.1
+# Pareto shape for how many users/messages each user follows/likes
+DEGREE_ALPHA = 1.8
+
+# mean time from a message being posted to someone liking it
+LIKE_DELAY = timedelta(days=2)
+
+# salts giving each popularity distribution its own rank -> id mapping
+FOLLOWED_SALT, AUTHOR_SALT, LIKED_SALT = 0, 1, 2
+
+
+def users_shard(args, shard, start, stop, writer):
+    """Users start..stop-1. Usernames end in the id, so they're unique."""
+
+    # Faker is slow per call, so draw from a pool of its names and places
+    fake = Faker()
+    fake.seed_instance(f"{args.seed}:users:{shard}")
+    names = [fake.user_name() for _ in range(FAKER_POOL_SIZE)]
+    domains = [fake.free_email_domain() for _ in range(FAKER_POOL_SIZE)]
+    cities = [fake.city() for _ in range(FAKER_POOL_SIZE)]
+    rng = shard_rng(args.seed, 'users', shard)
+
+    for user_id in range(start, stop):
+        username = f"{rng.choice(names)}_{user_id}"
+        writer.writerow([
+            user_id,
+            f"{username}@{rng.choice(domains)}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, 4, 12),
+            HEADER_IMAGE_URL,
+            rng.choice(cities),
+        ])
+
+
+def messages_shard(args, shard, start, stop, writer):
+    """Messages start..stop-1, spread evenly (in order) over the period."""
+
+    rng = shard_rng(args.seed, 'messages', shard)
+
+    for number in range(start, stop):
+        author = scatter(zipf_rank(rng, args.users, AUTHOR_EXPONENT),
+                         args.users, AUTHOR_SALT)
+        timestamp = message_timestamp(args, number)
+        writer.writerow([
+            snowflake(timestamp, number),
+            sentence(rng, 3, 25)[:MAX_WARBLER_LENGTH].rstrip(),
+            timestamp,
+            author,
+        ])
+
+
+def follows_shard(args, shard, start, stop, writer):
+    """Who users start..stop-1 follow, favouring popular users."""
+
+    rng = shard_rng(args.seed, 'follows', shard)
+    cap = args.users - 1
+
+    for follower in range(start, stop):
+        wanted = heavy_tailed_count(rng, args.follows_per_user, DEGREE_ALPHA,
+                                    cap)
+        for followed in distinct_draws(rng, wanted, args.users,
+                                       FOLLOWED_EXPONENT, FOLLOWED_SALT,
+                                       exclude=follower):
+            writer.writerow([followed, follower])
+
+
+def likes_shard(args, shard, start, stop, writer):
+    """Which messages users start..stop-1 like, favouring popular messages."""
+
+    rng = shard_rng(args.seed, 'likes', shard)
+    end = datetime.fromisoformat(args.end_date)
+
+    for user_id in range(start, stop):
+        wanted = heavy_tailed_count(rng, args.likes_per_user, DEGREE_ALPHA,
+                                    args.messages)
+        for number in distinct_draws(rng, wanted, args.messages,
+                                     LIKED_EXPONENT, LIKED_SALT):
+            posted = message_timestamp(args, number)
+            liked = min(end, posted + LIKE_DELAY * rng.expovariate(1))
+            writer.writerow([user_id, snowflake(posted, number), liked])
+
+
+def message_timestamp(args, number):
+    """When message `number` (1..args.messages) was posted.
+
+    A function of the number alone, so likes can work out a message's id
+    (a snowflake, made from its timestamp) without the messages shard.
+    """
+
+    end = datetime.fromisoformat(args.end_date)
+    period = timedelta(days=365 * args.years)
+    timestamp = end - period + period / args.messages * number
+
+    # to the millisecond, like the ids
+    return timestamp - timedelta(microseconds=timestamp.microsecond % 1000)
+
+
+def sentence(rng, min_words, max_words):
+    """A random sentence of lorem words."""
+
+    words = ' '.join(rng.choices(WORDS, k=rng.randint(min_words, max_words)))
+    return words.capitalize() + '.'
+
+
+def distinct_draws(rng, wanted, n, exponent, salt, exclude=None):
+    """Up to `wanted` distinct ids in 1..n, drawn by power-law popularity.
+
+    Gives up after a bounded number of draws, so a huge `wanted` against a
+    small, concentrated population can come up short.
+    """
+
+    chosen = set()
+
+    for _ in range(wanted * 20):
+        if len(chosen) == wanted:
+            break
+        drawn = scatter(zipf_rank(rng, n, exponent), n, salt)
+        if drawn != exclude:
+            chosen.add(drawn)
+
+    return sorted(chosen)
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, users_shard, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, messages_shard, 'messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, follows_shard, 'users'),
+    'likes': (LIKES_CSV_HEADERS, likes_shard, 'users'),
+}
+
+
+def part_path(args, table, shard):
+    return os.path.join(args.out_dir, '.parts', f"{table}-{shard:05}.csv")
+
+
+def write_shard(task):
+    """Write one shard of a table to its part file. Returns its row count."""
+
+    args, table, shard, start, stop = task
+    make_rows = TABLES[table][1]
+
+    with open(part_path(args, table, shard), 'w', newline='') as file:
+        writer = csv.writer(file)
+        make_rows(args, shard, start, stop, writer)
+
+    # ids covered (e.g. users, for follows), for progress reports
+    return stop - start
+
+
+def shard_tasks(args, table):
+    """(args, table, shard, start, stop) for each shard of `table`."""
+
+    total = getattr(args, TABLES[table][2])
+    return [(args, table, shard, start, min(start + args.shard_size, total + 1))
+            for shard, start in enumerate(range(1, total + 1, args.shard_size))]
+
+
+def join_parts(args, table, tasks):
+    """Concatenate `table`'s part files, in order, under a header row."""
+
+    path = os.path.join(args.out_dir, f"{table}.csv")
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(TABLES[table][0])
+
+    with open(path, 'ab') as out:
+        for _, _, shard, _, _ in tasks:
+            part = part_path(args, table, shard)
+            with open(part, 'rb') as rows:
+                shutil.copyfileobj(rows, out)
+            os.remove(part)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows-per-user', type=float, default=16)
+    parser.add_argument('--likes-per-user', type=float, default=5)
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--end-date', default='2020-02-01',
+                        help="newest message timestamp (YYYY-MM-DD)")
+    parser.add_argument('--years', type=float, default=2,
+                        help="period messages are spread over")
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--shard-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.out_dir, '.parts'), exist_ok=True)
+
+    with Pool(args.processes) as pool:
+        for table in TABLES:
+            tasks = shard_tasks(args, table)
+            driver = TABLES[table][2]
+            total = getattr(args, driver)
+            start = perf_counter()
+            done = 0
+
+            for count in pool.imap_unordered(write_shard, tasks):
+                done += count
+                print(f"\r{table}: {done:,} of {total:,} {driver} "
+                      f"({done / (perf_counter() - start):,.0f}/sec)",
+                      end='', file=sys.stderr, flush=True)
+
+            join_parts(args, table, tasks)
+            print(f"\r{table}.csv written in {perf_counter() - start:.1f}s")
+
+    os.rmdir(os.path.join(args.out_dir, '.parts'))
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
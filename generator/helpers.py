@@ -1,14 +1,80 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
+from datetime import datetime, timedelta
+from random import Random
 
+# large prime used to scatter popularity ranks across ids
+SCATTER_PRIME = 2654435761
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# message id layout; must match snowflake.py
+SNOWFLAKE_EPOCH = datetime(2000, 1, 1)
+SNOWFLAKE_TIMESTAMP_SHIFT = 22
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def shard_rng(seed, table, shard):
+    """The random number generator for one shard of one table.
+
+    Seeded from all three, so a shard's rows don't depend on which process
+    makes them or in what order.
+    """
+
+    return Random(f"{seed}:{table}:{shard}")
+
+
+def zipf_rank(rng, n, exponent):
+    """A rank in 1..n, drawn with P(rank) roughly proportional to rank^-exponent.
+
+    Uses the inverse CDF of the continuous approximation, so it's O(1) in
+    time and memory however large `n` is.
+    """
+
+    u = rng.random()
+
+    if exponent == 1:
+        x = math.exp(u * math.log(n + 1))
+    else:
+        power = 1 - exponent
+        x = (((n + 1) ** power - 1) * u + 1) ** (1 / power)
+
+    return min(n, max(1, int(x)))
+
+
+def scatter(rank, n, salt=0):
+    """Map rank 1..n onto id 1..n, one to one, without sorting by rank.
+
+    Keeps the most popular users from simply being the lowest ids; `salt`
+    gives each distribution its own mapping.
+    """
+
+    multiplier = SCATTER_PRIME + 2 * salt
+    while math.gcd(multiplier, n) != 1:
+        multiplier += 2
+
+    return (rank - 1 + salt) * multiplier % n + 1
+
+
+def heavy_tailed_count(rng, mean, alpha, cap):
+    """A count from a Pareto distribution with about this `mean`, at most `cap`.
+
+    Most draws are small and a few are very large, like follow and like
+    counts on real social networks. `alpha` must be > 1.
+    """
+
+    scale = mean * (alpha - 1) / alpha
+    return min(cap, int(scale * rng.paretovariate(alpha)))
+
+
+def snowflake(timestamp, low_bits):
+    """A message id for `timestamp`, as snowflake.py would make it.
+
+    `low_bits` stands in for the worker id and sequence number, and must
+    differ between messages in the same millisecond.
+    """
+
+    milliseconds = (timestamp - SNOWFLAKE_EPOCH) // timedelta(milliseconds=1)
+    if milliseconds < 0:
+        raise ValueError(f"{timestamp} is before {SNOWFLAKE_EPOCH}")
+
+    low_mask = (1 << SNOWFLAKE_TIMESTAMP_SHIFT) - 1
+    return (milliseconds << SNOWFLAKE_TIMESTAMP_SHIFT) | (low_bits & low_mask)
@@ -0,0 +1,117 @@
+"""HTTP caching policy for Warbler.
+
+- Static files linked through `static_url` carry a content hash (`?v=...`)
+  and are served as immutable for a year; other static requests get a
+  short max-age plus the ETag/Last-Modified Flask's file serving adds.
+- Pages can short-circuit rendering with `page_etag`/`not_modified`,
+  answering 304 when the client already has the current version.
+- Everything else is `private, no-cache` (revalidate before reuse);
+  views whose responses must never be stored use `@no_store`.
+"""
+
+import os
+from hashlib import sha1
+
+from flask import (request, session, send_from_directory, make_response,
+                   render_template)
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_fingerprints = {}
+
+
+def no_store(view):
+    """Mark a view whose responses browsers must not keep at all."""
+
+    view.no_store = True
+    return view
+
+
+def fingerprint(static_folder, filename):
+    """Short content hash of a static file, recomputed if it changes."""
+
+    path = os.path.join(static_folder, filename)
+    mtime = os.path.getmtime(path)
+    cached = _fingerprints.get(path)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as file:
+            cached = (mtime, sha1(file.read()).hexdigest()[:12])
+        _fingerprints[path] = cached
+
+    return cached[1]
+
+
+def page_etag(*parts):
+    """ETag for a page whose content is fully determined by `parts`.
+
+    `parts` must cover everything the page shows, including the viewer's
+    own state (who they are, what they like and follow).
+    """
+
+    return sha1(repr(parts).encode('UTF-8')).hexdigest()
+
+
+def not_modified(etag):
+    """Does the client already hold the page with `etag`?
+
+    Never true while flash messages are waiting to be shown, since the
+    cached copy wouldn't include them.
+    """
+
+    return ('_flashes' not in session
+            and request.if_none_match.contains(etag))
+
+
+def render_conditional(etag, template_name, **context):
+    """Render a page tagged with `etag`, or 304 if the client has it."""
+
+    if not_modified(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template(template_name, **context))
+
+    response.set_etag(etag)
+    return response
+
+
+def init_http_caching(app):
+    """Install static fingerprinting and the cache policy on `app`."""
+
+    @app.template_global()
+    def static_url(filename):
+        """URL for a static file that changes whenever its content does."""
+
+        version = fingerprint(app.static_folder, filename)
+        return f"{app.static_url_path}/{filename}?v={version}"
+
+    def static(filename):
+        """Serve a static file; fingerprinted URLs are cached for good."""
+
+        response = send_from_directory(app.static_folder, filename)
+        version = request.args.get('v')
+
+        if version and version == fingerprint(app.static_folder, filename):
+            response.headers['Cache-Control'] = (
+                f"public, max-age={IMMUTABLE_MAX_AGE}, immutable")
+
+        return response
+
+    app.view_functions['static'] = static
+
+    @app.after_request
+    def add_cache_headers(response):
+        """Default caching for everything that isn't a static file."""
+
+        if request.endpoint == 'static':
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+
+        if getattr(view, 'no_store', False) or request.method != 'GET':
+            response.headers['Cache-Control'] = 'no-store'
+        elif 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+
+        response.vary.add('Cookie')
+        return response
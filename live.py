@@ -0,0 +1,216 @@
+"""Notices of new messages, for live timelines.
+
+`live_updates` is the current app's small publish/subscribe hub.
+`messages_add` publishes a notice (author and message id) once a message
+is committed; each open timeline stream or long poll holds a
+`Subscription` for the authors its viewer follows, and is woken when one
+of them posts. The woken request then reads just the newer entries of
+its timeline.
+
+Notices reach other processes through a backend, chosen by LIVE_URL:
+
+- memory:// (default): this process only; fine for one worker
+- postgresql://...: Postgres LISTEN/NOTIFY, so every worker (on any
+  host) using that database hears every notice
+
+Notices are hints, not data: one that's lost (say, while a listener
+reconnects) only delays an update until the next notice or reconnect.
+"""
+
+import json
+import logging
+import os
+import select
+from threading import Event, Lock, Thread
+from time import sleep
+
+from extensions import AppExtension
+
+# Postgres NOTIFY channel
+CHANNEL = 'warbler_messages'
+
+# seconds between a lost listener connection and retrying it
+RECONNECT_DELAY = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A waiting request's interest in new messages by some authors."""
+
+    def __init__(self, author_ids):
+        self.author_ids = set(author_ids)
+        self.event = Event()
+
+    def notify(self, notice):
+        if notice['author_id'] in self.author_ids:
+            self.event.set()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a notice; True if one came.
+
+        Notices that arrived since the last wait count, so none are missed
+        between reading the timeline and waiting again.
+        """
+
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return woken
+
+
+class MemoryBackend:
+    """Delivers notices within this process only."""
+
+    def __init__(self):
+        self.deliver = None
+
+    def listen(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, notice):
+        if self.deliver:
+            self.deliver(notice)
+
+
+class PostgresBackend:
+    """Sends notices with NOTIFY; a thread per process LISTENs for them."""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.pid = None
+
+    def listen(self, deliver):
+        self.deliver = deliver
+
+        # threads don't survive a fork, so each worker starts its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                Thread(target=self.receive, daemon=True).start()
+
+    def publish(self, notice):
+        payload = json.dumps(notice)
+
+        with self.lock:
+            # a connection made before a fork belongs to the parent
+            if (self.connection is None or self.connection.closed
+                    or self.connection_pid != os.getpid()):
+                self.connection = self.connect()
+                self.connection_pid = os.getpid()
+
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)",
+                                   (CHANNEL, payload))
+            except Exception:
+                self.connection = None
+                raise
+
+    def connect(self):
+        import psycopg2
+
+        connection = psycopg2.connect(self.url)
+        connection.autocommit = True
+        return connection
+
+    def receive(self):
+        while True:
+            connection = None
+            try:
+                connection = self.connect()
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+
+                while True:
+                    select.select([connection], [], [], 60)
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        self.deliver(json.loads(notify.payload))
+            except Exception:
+                logger.warning("Lost the live updates listener; reconnecting",
+                               exc_info=True)
+                if connection is not None:
+                    connection.close()
+                sleep(RECONNECT_DELAY)
+
+
+class LiveUpdates:
+    """Publishes new-message notices and wakes the subscribers they match."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.lock = Lock()
+        self.subscriptions = set()
+        self.waiting = 0
+
+    def claim(self, limit):
+        """Claim a slot for a request about to wait for notices.
+
+        Each waiting request holds a server thread, so at most `limit`
+        may wait at once. Returns False when they all are; otherwise the
+        caller must `release` the slot when it's done waiting.
+        """
+
+        with self.lock:
+            if self.waiting >= limit:
+                return False
+            self.waiting += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def publish(self, author_id, message_id):
+        """Announce a committed message.
+
+        A notice that can't be sent is logged, not raised: the message is
+        saved, and timelines catch up on their next read.
+        """
+
+        try:
+            self.backend.publish({'author_id': author_id,
+                                  'message_id': message_id})
+        except Exception:
+            logger.warning("Couldn't announce message %s", message_id,
+                           exc_info=True)
+
+    def subscribe(self, author_ids):
+        """Start collecting notices of messages by `author_ids`."""
+
+        # listening starts on first use, so processes that never serve a
+        # live timeline (CLI commands, tests) don't
+        self.backend.listen(self.deliver)
+
+        subscription = Subscription(author_ids)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def deliver(self, notice):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+
+        for subscription in subscriptions:
+            subscription.notify(notice)
+
+
+def app_live_updates(app):
+    """A hub for `app`, on the backend LIVE_URL picks (memory:// by
+    default); without an app, an in-memory one."""
+
+    url = (app and app.config.get('LIVE_URL')) or 'memory://'
+    return LiveUpdates(PostgresBackend(url)
+                       if url.startswith(('postgres://', 'postgresql://'))
+                       else MemoryBackend())
+
+
+live_updates = AppExtension('live_updates', app_live_updates)
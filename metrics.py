@@ -0,0 +1,300 @@
+"""Prometheus metrics for Warbler, served at /metrics.
+
+Per endpoint: request counts (by method and status), a latency histogram,
+and how many SQL statements ran and how long they took. Also template
+render times, cache backend errors, fragment cache hits and misses, the
+password hasher's bcrypt time and queue, and (from replicas.py) how full
+the database connection pools are.
+
+Metrics live in the process that records them, so under gunicorn each
+worker reports its own; have Prometheus scrape them individually or sum
+over the `instance`. Recording is a dict update under a lock, and a
+scrape just formats what's been gathered.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import (g, has_app_context, request, Response,
+                   before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus client libraries' default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    pairs = (f'{name}="{escape_label(value)}"'
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape_label(value):
+    return (str(value).replace('\\', r'\\')
+            .replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+class Metric:
+    """A named metric, with one value per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+
+class Counter(Metric):
+    """A labelled, only-increasing total."""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+
+        for labels, value in values:
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram(Metric):
+    """Labelled observations counted into cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # per-bucket counts, then the +Inf bucket, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts))
+                      for labels, counts in self.values.items()]
+
+        names = (*self.labels, 'le')
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                yield (f"{self.name}_bucket",
+                       format_labels(names, (*labels, bound)), total)
+
+            label_text = format_labels(self.labels, labels)
+            yield f"{self.name}_sum", label_text, counts[-1]
+            yield f"{self.name}_count", label_text, total
+
+
+class Registry:
+    """The metrics to expose, plus callbacks that report live values."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register `func`, which yields (name, kind, description, value).
+
+        `value` can instead be a list of (labels dict, value) pairs.
+        """
+
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        """Everything, in Prometheus' text exposition format."""
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}"
+                         for name, labels, value in metric.samples())
+
+        for collect in self.collectors:
+            for name, kind, description, value in collect():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                samples = value if isinstance(value, list) else [({}, value)]
+                lines.extend(
+                    f"{name}{format_labels(labels, labels.values())} {value}"
+                    for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'warbler_http_requests_total', "HTTP requests handled.",
+    ['endpoint', 'method', 'status']))
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'warbler_http_request_duration_seconds',
+    "Time to handle a request, in seconds.", ['endpoint']))
+
+SQL_STATEMENTS = registry.register(Counter(
+    'warbler_sql_statements_total', "SQL statements run by requests.",
+    ['endpoint']))
+
+SQL_SECONDS = registry.register(Counter(
+    'warbler_sql_duration_seconds_total',
+    "Time requests spent running SQL statements, in seconds.", ['endpoint']))
+
+CACHE_ERRORS = registry.register(Counter(
+    'warbler_cache_errors_total',
+    "Cache backend calls that failed (the app went without the cache).",
+    ['operation']))
+
+TEMPLATE_SECONDS = registry.register(Histogram(
+    'warbler_template_render_duration_seconds',
+    "Time to render a template (including templates it includes), "
+    "in seconds.", ['template']))
+
+
+@registry.collector
+def password_hasher_metrics():
+    from passwords import hasher
+
+    stats = hasher.stats()
+    yield ('warbler_password_hash_seconds_total', 'counter',
+           "Time spent hashing and checking passwords (bcrypt), in seconds.",
+           stats['seconds_total'])
+    yield ('warbler_password_hash_operations_total', 'counter',
+           "Password hashes and checks completed.", stats['completed'])
+    yield ('warbler_password_hash_rejected_total', 'counter',
+           "Password hashes refused because the queue was full.",
+           stats['rejected'])
+    yield ('warbler_password_hash_queue_depth', 'gauge',
+           "Requests hashing or waiting to hash a password.",
+           stats['queue_depth'])
+
+
+@registry.collector
+def fragment_cache_metrics():
+    from fragments import fragment_cache
+
+    stats = fragment_cache.stats()
+    yield ('warbler_fragment_cache_hits_total', 'counter',
+           "Rendered messages served from the fragment cache.",
+           stats['hits'])
+    yield ('warbler_fragment_cache_misses_total', 'counter',
+           "Messages rendered because they weren't in the fragment cache.",
+           stats['misses'])
+    yield ('warbler_fragment_render_seconds_total', 'counter',
+           "Time spent rendering messages for the fragment cache, "
+           "in seconds.", stats['render_seconds'])
+    yield ('warbler_fragment_cache_entries', 'gauge',
+           "Rendered messages in the fragment cache.", stats['size'])
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    """Engine hook: note when a statement started."""
+
+    conn.info.setdefault('metrics_started', []).append(perf_counter())
+
+
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """Engine hook: add a statement's time to the current request's."""
+
+    elapsed = perf_counter() - conn.info['metrics_started'].pop()
+
+    if has_app_context() and 'sql_seconds' in g:
+        g.sql_seconds += elapsed
+
+
+def forget_failed_statement(context):
+    """Engine hook: a statement failed, so `finish_statement` won't run."""
+
+    started = context.connection.info.get('metrics_started')
+    if started:
+        started.pop()
+
+
+def start_template(sender, template, context, **extra):
+    if has_app_context():
+        g.setdefault('template_starts', []).append(perf_counter())
+
+
+def finish_template(sender, template, context, **extra):
+    if has_app_context() and g.get('template_starts'):
+        TEMPLATE_SECONDS.observe(perf_counter() - g.template_starts.pop(),
+                                 template.name)
+
+
+def init_metrics(app):
+    """Record request, SQL and template metrics for `app`; add /metrics.
+
+    SQL statement counts come from query_budget's per-request count, so
+    `init_query_budget` must be set up on the app too.
+    """
+
+    hooks = [('before_cursor_execute', start_statement),
+             ('after_cursor_execute', finish_statement),
+             ('handle_error', forget_failed_statement)]
+
+    for name, hook in hooks:
+        if not event.contains(Engine, name, hook):
+            event.listen(Engine, name, hook)
+
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(finish_template, app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_started = perf_counter()
+        g.sql_seconds = 0.0
+
+    @app.after_request
+    def note_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request_metrics(exc):
+        if 'request_started' not in g:
+            return
+
+        endpoint = request.endpoint or 'none'
+        REQUESTS.inc(endpoint, request.method, g.get('response_status', 500))
+        REQUEST_SECONDS.observe(perf_counter() - g.request_started, endpoint)
+        SQL_STATEMENTS.inc(endpoint, amount=g.get('query_count', 0))
+        SQL_SECONDS.inc(endpoint, amount=g.sql_seconds)
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus scrape endpoint."""
+
+        return Response(registry.render(), content_type=CONTENT_TYPE)
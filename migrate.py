@@ -0,0 +1,101 @@
+"""Schema migrations for Warbler.
+
+Migrations are modules in the migrations/ package, named with a zero-padded
+number and a description (0002_performance_indexes.py) and applied in
+order. Each has an `upgrade(connection)` function; the versions applied
+are recorded in the schema_migrations table. Run them with
+
+    flask migrate           # apply whatever's pending
+    flask migrate --list    # show what's applied and what's pending
+
+A migration runs in a transaction unless it sets `TRANSACTIONAL = False`,
+which Postgres requires for CREATE INDEX CONCURRENTLY. Such a migration
+should be safe to re-run, in case it fails halfway through (see
+`create_index`).
+"""
+
+import importlib
+import pkgutil
+
+from sqlalchemy import text
+
+import migrations
+
+VERSIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version VARCHAR PRIMARY KEY,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def available():
+    """Names of all the migration modules, in the order they apply."""
+
+    return sorted(name for _, name, _ in pkgutil.iter_modules(migrations.__path__))
+
+
+def applied(engine):
+    """Names of the migrations already applied to `engine`'s database."""
+
+    with engine.begin() as connection:
+        connection.execute(VERSIONS_DDL)
+        return {row.version for row
+                in connection.execute("SELECT version FROM schema_migrations")}
+
+
+def pending(engine):
+    done = applied(engine)
+    return [name for name in available() if name not in done]
+
+
+def upgrade(engine, log=print):
+    """Apply every pending migration to `engine`'s database, in order."""
+
+    for name in pending(engine):
+        module = importlib.import_module(f"migrations.{name}")
+        log(f"Applying {name}")
+
+        if getattr(module, 'TRANSACTIONAL', True):
+            with engine.begin() as connection:
+                module.upgrade(connection)
+                record(connection, name)
+        else:
+            with engine.connect() as connection:
+                module.upgrade(
+                    connection.execution_options(isolation_level='AUTOCOMMIT'))
+                record(connection, name)
+
+
+def record(connection, name):
+    connection.execute(
+        text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+        version=name)
+
+
+def create_index(connection, name, table, columns, using=None):
+    """Create an index if it's missing; concurrently on Postgres.
+
+    `connection` must be in autocommit mode on Postgres. A concurrent build
+    that failed leaves an invalid index behind, which is dropped and built
+    again rather than being mistaken for a finished one. `using` names a
+    Postgres index method (e.g. 'gin'); other databases ignore it.
+    """
+
+    column_list = ', '.join(columns)
+
+    if connection.dialect.name != 'postgresql':
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column_list})")
+        return
+
+    invalid = connection.execute(
+        text("SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+             "WHERE relname = :name AND NOT indisvalid"),
+        name=name).first()
+    if invalid:
+        connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    method = f"USING {using} " if using else ""
+    connection.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                       f"ON {table} {method}({column_list})")
@@ -0,0 +1,13 @@
+"""Create any missing tables.
+
+Databases made before migrations existed (with `db.create_all()`) already
+have them, so this only does anything for a new database. There it builds
+the current schema, indexes included, so later migrations find their work
+already done.
+"""
+
+
+def upgrade(connection):
+    from models import db
+
+    db.metadata.create_all(connection)
@@ -0,0 +1,24 @@
+"""Indexes for the queries and cascades that were scanning whole tables.
+
+- messages(user_id, timestamp, id): a user's messages, newest first
+- follows(user_following_id, user_being_followed_id): who a user follows
+- likes(message_id, user_id): who liked a message
+- timeline_entries(message_id): removing a deleted message from timelines
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_messages_user_timestamp', 'messages', ['user_id', 'timestamp', 'id']),
+    ('ix_follows_following', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_message', 'likes', ['message_id', 'user_id']),
+    ('ix_timeline_message', 'timeline_entries', ['message_id']),
+]
+
+
+def upgrade(connection):
+    for name, table, columns in INDEXES:
+        create_index(connection, name, table, columns)
@@ -0,0 +1,41 @@
+"""Make message ids 64-bit snowflakes, ordered by creation time.
+
+- messages.id, and the columns referring to it, become BIGINT; the app
+  now makes the ids (see snowflake.py), so the serial sequence goes
+- timeline_entries.timestamp goes: timelines are ordered by message id,
+  on the primary key (its index went with it)
+- messages(user_id, id) replaces messages(user_id, timestamp, id)
+
+Existing messages keep their small ids, which sort before every new one.
+Changing a column's type rewrites its table under an exclusive lock, so
+run this when writes can wait for it.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+BIGINT_COLUMNS = [
+    ('messages', 'id'),
+    ('likes', 'message_id'),
+    ('timeline_entries', 'message_id'),
+]
+
+
+def upgrade(connection):
+    postgres = connection.dialect.name == 'postgresql'
+
+    if postgres:
+        for table, column in BIGINT_COLUMNS:
+            connection.execute(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT")
+        connection.execute("ALTER TABLE messages ALTER COLUMN id DROP DEFAULT")
+        connection.execute("DROP SEQUENCE IF EXISTS messages_id_seq")
+        connection.execute(
+            "ALTER TABLE timeline_entries DROP COLUMN IF EXISTS timestamp")
+
+    create_index(connection, 'ix_messages_user_id', 'messages',
+                 ['user_id', 'id'])
+
+    drop = "DROP INDEX CONCURRENTLY" if postgres else "DROP INDEX"
+    connection.execute(f"{drop} IF EXISTS ix_messages_user_timestamp")
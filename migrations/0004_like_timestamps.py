@@ -0,0 +1,24 @@
+"""Record when each like was made, for the likes page's order.
+
+- likes.timestamp: existing likes get the time of the migration
+- likes(user_id, timestamp, message_id): a user's likes, newest first
+
+Adding a column with a default is instant on Postgres 11 and later.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            "ALTER TABLE likes ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP "
+            "NOT NULL DEFAULT (now() AT TIME ZONE 'utc')")
+        # new likes get their time from the app, like messages do
+        connection.execute(
+            "ALTER TABLE likes ALTER COLUMN timestamp DROP DEFAULT")
+
+    create_index(connection, 'ix_likes_user_timestamp', 'likes',
+                 ['user_id', 'timestamp', 'message_id'])
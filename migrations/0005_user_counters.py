@@ -0,0 +1,39 @@
+"""Add the users' denormalized counts and profile version, and fill the
+home timelines, for databases made before them.
+
+- users.messages_count, following_count, followers_count, likes_count:
+  added as 0, then set from the source tables (`User.reconcile_counts`)
+- users.profile_version: starts at 0
+- timeline_entries: an empty table (as 0001_baseline makes it here) is
+  filled from the messages and follows tables (`TimelineEntry.rebuild`)
+
+Databases 0001_baseline created already have all of this, so only the
+missing columns are added. Filling the counts and timelines reads every
+message and follow; run this when the database can spare that.
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+COLUMNS = ['messages_count', 'following_count', 'followers_count',
+           'likes_count', 'profile_version']
+
+
+def upgrade(connection):
+    from models import TimelineEntry, User
+
+    existing = {column['name']
+                for column in inspect(connection).get_columns('users')}
+    for column in COLUMNS:
+        if column not in existing:
+            connection.execute(f"ALTER TABLE users ADD COLUMN {column} "
+                               f"INTEGER NOT NULL DEFAULT 0")
+
+    session = Session(bind=connection)
+    try:
+        User.reconcile_counts(session=session)
+
+        if session.query(TimelineEntry).first() is None:
+            TimelineEntry.rebuild(session=session)
+    finally:
+        session.close()
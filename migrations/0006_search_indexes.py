@@ -0,0 +1,40 @@
+"""Search indexes (see search.py), for databases made before them.
+
+- Postgres: trigram GIN indexes on users' username, bio and location
+  (where the server has pg_trgm) and a GIN index on the messages' text
+  search vector, built concurrently
+- SQLite: the FTS5 tables and the triggers keeping them in sync, filled
+  from the existing rows
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+TRIGRAM_INDEXES = [
+    ('ix_users_username_trgm', 'users', ['username gin_trgm_ops']),
+    ('ix_users_bio_trgm', 'users', ['bio gin_trgm_ops']),
+    ('ix_users_location_trgm', 'users', ['location gin_trgm_ops']),
+]
+
+
+def upgrade(connection):
+    from models import install_trigram, SQLITE_SEARCH_DDL
+
+    if connection.dialect.name == 'sqlite':
+        for table, statements in SQLITE_SEARCH_DDL.items():
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(
+                f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+        return
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    if install_trigram(connection):
+        for name, table, columns in TRIGRAM_INDEXES:
+            create_index(connection, name, table, columns, using='gin')
+
+    create_index(connection, 'ix_messages_text_tsv', 'messages',
+                 ["to_tsvector('english', text)"], using='gin')
@@ -1,12 +1,15 @@
 """SQLAlchemy models for Warbler."""
 
+import sqlite3
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Engine
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+from snowflake import message_ids, timestamp_of
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,6 +29,52 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with user_being_followed_id; this one serves
+    # "who does this user follow" (and covers it, for index-only scans)
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def toggle(cls, follower_id, followed_id):
+        """Follow `followed_id` if `follower_id` doesn't yet, else unfollow.
+
+        Returns (now_following, follower's following_count, followed
+        user's followers_count). Neither user's collections are loaded,
+        and the follower's timeline is backfilled or pruned to match.
+        Raises ValueError for a self-follow and IntegrityError if
+        `followed_id` doesn't exist.
+        """
+
+        if follower_id == followed_id:
+            raise ValueError("users can't follow themselves")
+
+        params = {'follower': follower_id, 'followed': followed_id}
+
+        if dialect_is_postgres():
+            following, following_count, followers_count = db.session.execute(
+                TOGGLE_FOLLOW_SQL, params).first()
+        else:
+            following = toggle_row(cls.__table__,
+                                   user_being_followed_id=followed_id,
+                                   user_following_id=follower_id)
+            delta = 1 if following else -1
+            User.adjust_counts([follower_id], following_count=delta)
+            User.adjust_counts([followed_id], followers_count=delta)
+            following_count, followers_count = (
+                db.session.query(User.following_count).filter_by(
+                    id=follower_id).scalar(),
+                db.session.query(User.followers_count).filter_by(
+                    id=followed_id).scalar())
+
+        if following:
+            TimelineEntry.backfill(follower_id, followed_id)
+        else:
+            TimelineEntry.prune(follower_id, followed_id)
+
+        return following, following_count, followers_count
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,6 +121,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept current by the write paths in app.py so
+    # pages can show them without loading the related rows. Repair drift
+    # with `flask reconcile-counts`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped whenever the user's profile changes, so anything cached
+    # from it (like rendered messages) can be keyed by it
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all, delete-orphan")
 
     followers = db.relationship(
@@ -93,24 +183,162 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def load_relationships(self, messages=(), users=()):
+        """Prefetch this user's relationships to what's about to be shown.
+
+        Fetches, in one query each, which of `messages` this user has liked
+        and which of `users` (plus the authors of `messages`) they follow or
+        are followed by. Until the end of the request, `has_liked`,
+        `is_following` and `is_followed_by` answer from these sets, so
+        each is a set lookup.
+        """
+
+        message_ids = {message.id for message in messages}
+        user_ids = ({user.id for user in users}
+                    | {message.user_id for message in messages})
+
+        liked_ids = set()
+        if message_ids:
+            liked_ids = {message_id for (message_id,) in
+                         (db.session
+                          .query(Like.message_id)
+                          .filter(Like.user_id == self.id,
+                                  Like.message_id.in_(message_ids)))}
+
+        following_ids = set()
+        follower_ids = set()
+        if user_ids:
+            follows = (db.session
+                       .query(Follows.user_following_id,
+                              Follows.user_being_followed_id)
+                       .filter(db.or_(
+                           db.and_(Follows.user_following_id == self.id,
+                                   Follows.user_being_followed_id.in_(
+                                       user_ids)),
+                           db.and_(Follows.user_being_followed_id == self.id,
+                                   Follows.user_following_id.in_(user_ids)))))
+
+            for follower_id, followed_id in follows:
+                if follower_id == self.id:
+                    following_ids.add(followed_id)
+                if followed_id == self.id:
+                    follower_ids.add(follower_id)
+
+        self._relationships = {
+            'liked': {id: id in liked_ids for id in message_ids},
+            'following': {id: id in following_ids for id in user_ids},
+            'followers': {id: id in follower_ids for id in user_ids},
+        }
+
+    def forget_relationships(self):
+        """Drop relationships prefetched by `load_relationships`."""
+
+        self._relationships = None
+
+    def _prefetched(self, kind, id):
+        """Prefetched answer for `id` in `kind`, or None if not prefetched."""
+
+        relationships = getattr(self, '_relationships', None)
+        if relationships is None:
+            return None
+        return relationships[kind].get(id)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        found = self._prefetched('followers', other_user.id)
+        if found is not None:
+            return found
+
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=self.id,
+                       user_following_id=other_user.id)
+            .exists()).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        found = self._prefetched('following', other_user.id)
+        if found is not None:
+            return found
+
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=other_user.id,
+                       user_following_id=self.id)
+            .exists()).scalar()
 
     def has_liked(self, message):
         """Does this user like this message?"""
 
-        liked_message_list = [m for m in self.likes if m == message]
-        return len(liked_message_list) == 1
+        found = self._prefetched('liked', message.id)
+        if found is not None:
+            return found
 
+        return db.session.query(
+            Like.query
+            .filter_by(user_id=self.id, message_id=message.id)
+            .exists()).scalar()
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counter columns of the users in `user_ids`.
+
+        e.g. User.adjust_counts([5], likes_count=1)
+
+        Done in SQL (count = count + delta) so concurrent requests can't
+        lose each other's updates.
+        """
+
+        if not user_ids:
+            return
+
+        values = {getattr(cls, column): getattr(cls, column) + delta
+                  for column, delta in deltas.items()}
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def true_counts(cls):
+        """Map counter column name -> SQL subquery computing its real value."""
+
+        def count_where(criterion):
+            return (db.select([db.func.count()])
+                    .where(criterion)
+                    .as_scalar())
+
+        return {
+            'messages_count': count_where(Message.user_id == cls.id),
+            'following_count': count_where(Follows.user_following_id == cls.id),
+            'followers_count': count_where(
+                Follows.user_being_followed_id == cls.id),
+            'likes_count': count_where(Like.user_id == cls.id),
+        }
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None, session=None):
+        """Recompute counter columns from the source tables.
+
+        Only touches users whose counts have drifted (all users, or just
+        those in `user_ids`). Returns how many users were fixed. Runs in
+        `session` if given (a migration's), else `db.session`.
+        """
+
+        true_counts = cls.true_counts()
+        drifted = db.or_(*[getattr(cls, column) != true_count
+                           for column, true_count in true_counts.items()])
+
+        query = (session or db.session).query(cls).filter(drifted)
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        return query.update(
+            {getattr(cls, column): true_count
+             for column, true_count in true_counts.items()},
+            synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -119,7 +347,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -140,26 +368,49 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with a different work factor than is now
+        configured, it's replaced with a fresh one; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+# what a user card (directory, follows pages, search) shows; not whole
+# users, password hashes and all
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+
+def message_timestamp(context):
+    """Column default: when the message's id says it was made."""
+
+    return timestamp_of(context.get_current_parameters()['id'])
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are snowflakes (see snowflake.py), made in-process and ordered by
+    creation time, so newest first is descending id order.
+    """
 
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=message_ids.next_id,
     )
 
     text = db.Column(
@@ -170,7 +421,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=message_timestamp,
     )
 
     user_id = db.Column(
@@ -181,6 +432,199 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # a user's messages, newest first (profile pages, timeline backfill)
+    __table_args__ = (
+        db.Index('ix_messages_user_id', 'user_id', 'id'),
+    )
+
+    @classmethod
+    def post(cls, user_id, text):
+        """Add a message by `user_id`, and to its readers' timelines.
+
+        Also counts it on the author, without loading their messages.
+        Returns the message (flushed, so it has its id).
+        """
+
+        message = cls(text=text, user_id=user_id)
+        db.session.add(message)
+        db.session.flush()
+        TimelineEntry.fan_out(message)
+        User.adjust_counts([user_id], messages_count=1)
+        return message
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write) so that
+    reading a home page is a single range read on the primary key,
+    (owner_id, message_id): message ids are in time order.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    message = db.relationship('Message')
+
+    __table_args__ = (
+        db.Index('ix_timeline_owner_author', 'owner_id', 'author_id'),
+        # for the cascade when a message is deleted
+        db.Index('ix_timeline_message', 'message_id'),
+    )
+
+    # how many of a newly-followed user's messages to copy into a timeline
+    BACKFILL_LIMIT = 100
+
+    # how many entries a timeline keeps (ten home pages); `trim` removes
+    # older ones, and `rebuild` never writes them
+    TIMELINE_LIMIT = 1000
+
+    @classmethod
+    def fan_out(cls, message):
+        """Copy `message` into its author's timeline and their followers'.
+
+        Must be called after the message has been flushed (so it has an id).
+        """
+
+        followers = (db.session
+                     .query(Follows.user_following_id.label('owner_id'),
+                            db.literal(message.id).label('message_id'),
+                            db.literal(message.user_id).label('author_id'))
+                     .filter(Follows.user_being_followed_id == message.user_id,
+                             Follows.user_following_id != message.user_id))
+
+        db.session.add(cls(owner_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id))
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['owner_id', 'message_id', 'author_id'], followers))
+
+    @classmethod
+    def backfill(cls, owner_id, author_id):
+        """Copy `author_id`'s most recent messages into `owner_id`'s timeline."""
+
+        if owner_id == author_id:
+            return
+
+        recent = (db.session
+                  .query(db.literal(owner_id).label('owner_id'),
+                         Message.id,
+                         Message.user_id)
+                  .filter(Message.user_id == author_id)
+                  .order_by(Message.id.desc())
+                  .limit(cls.BACKFILL_LIMIT))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['owner_id', 'message_id', 'author_id'], recent))
+
+    @classmethod
+    def prune(cls, owner_id, author_id):
+        """Remove `author_id`'s messages from `owner_id`'s timeline."""
+
+        if owner_id == author_id:
+            return
+
+        (cls.query
+         .filter_by(owner_id=owner_id, author_id=author_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, session=None):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Each timeline gets its owner's and followed users' newest
+        `TIMELINE_LIMIT` messages. Used after bulk loads, which bypass the
+        fan-out in `messages_add`. Runs in `session` if given (a
+        migration's), else `db.session`.
+        """
+
+        session = session or db.session
+        session.query(cls).delete(synchronize_session=False)
+
+        own = session.query(Message.user_id.label('owner_id'),
+                            Message.id.label('message_id'),
+                            Message.user_id.label('author_id'))
+
+        followed = (session
+                    .query(Follows.user_following_id.label('owner_id'),
+                           Message.id.label('message_id'),
+                           Message.user_id.label('author_id'))
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id
+                            != Follows.user_being_followed_id))
+
+        entries = db.union_all(own.statement, followed.statement).alias()
+        newest = cls._newest_first(session, entries.c).subquery()
+        kept = (session
+                .query(newest.c.owner_id,
+                       newest.c.message_id,
+                       newest.c.author_id)
+                .filter(newest.c.rank <= cls.TIMELINE_LIMIT))
+
+        session.execute(cls.__table__.insert().from_select(
+            ['owner_id', 'message_id', 'author_id'], kept))
+
+    @classmethod
+    def trim(cls, owner_ids=None, session=None):
+        """Remove entries beyond each timeline's newest `TIMELINE_LIMIT`.
+
+        Fan-out only ever adds entries, so this is run periodically
+        (`flask trim-timelines`) to keep timelines bounded. Trims every
+        timeline, or just those in `owner_ids`. Returns how many entries
+        were removed.
+        """
+
+        session = session or db.session
+
+        entries = session.query(cls.owner_id, cls.message_id, cls.author_id)
+        if owner_ids is not None:
+            entries = entries.filter(cls.owner_id.in_(owner_ids))
+        entries = entries.subquery()
+
+        newest = cls._newest_first(session, entries.c).subquery()
+        stale = (session
+                 .query(newest.c.owner_id, newest.c.message_id)
+                 .filter(newest.c.rank > cls.TIMELINE_LIMIT))
+
+        return (session
+                .query(cls)
+                .filter(db.tuple_(cls.owner_id, cls.message_id).in_(stale))
+                .delete(synchronize_session=False))
+
+    @staticmethod
+    def _newest_first(session, columns):
+        """Query timeline `columns`, ranking each owner's entries from 1."""
+
+        rank = (db.func.row_number()
+                .over(partition_by=columns.owner_id,
+                      order_by=columns.message_id.desc())
+                .label('rank'))
+
+        return session.query(columns.owner_id,
+                             columns.message_id,
+                             columns.author_id,
+                             rank)
+
 
 class Like(db.Model):
     """Connect of a user and their liked warble(s)"""
@@ -193,17 +637,261 @@ class Like(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete="cascade"),
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    message = db.relationship('Message')
+
+    __table_args__ = (
+        # who liked a message (deleting it, and its cascade)
+        db.Index('ix_likes_message', 'message_id', 'user_id'),
+        # a user's likes, newest first (the likes page)
+        db.Index('ix_likes_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` if `user_id` hasn't yet, else unlike it.
+
+        Returns (now_liked, user's likes_count) without loading the
+        user's likes. Raises IntegrityError if the message doesn't exist.
+        """
+
+        params = {'user': user_id, 'message': message_id,
+                  'now': datetime.utcnow()}
+
+        if dialect_is_postgres():
+            return tuple(db.session.execute(TOGGLE_LIKE_SQL, params).first())
+
+        liked = toggle_row(cls.__table__, user_id=user_id,
+                           message_id=message_id)
+        User.adjust_counts([user_id], likes_count=1 if liked else -1)
+        likes_count = (db.session.query(User.likes_count)
+                       .filter_by(id=user_id)
+                       .scalar())
+        return liked, likes_count
+
+
+##############################################################################
+# Toggles (used by Follows.toggle and Like.toggle)
+#
+# On Postgres each toggle is one statement: delete the row if it's there,
+# otherwise insert it, and move the counters by the difference. Data-
+# modifying CTEs all see the same snapshot, so `inserted` checks `deleted`
+# rather than the table.
+
+TOGGLE_LIKE_SQL = db.text("""
+    WITH deleted AS (
+        DELETE FROM likes
+        WHERE user_id = :user AND message_id = :message
+        RETURNING 1
+    ), inserted AS (
+        INSERT INTO likes (user_id, message_id, timestamp)
+        SELECT :user, :message, :now
+        WHERE NOT EXISTS (SELECT 1 FROM deleted)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    UPDATE users
+    SET likes_count = likes_count
+        + (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted)
+    WHERE id = :user
+    RETURNING EXISTS (SELECT 1 FROM inserted), likes_count
+""")
+
+TOGGLE_FOLLOW_SQL = db.text("""
+    WITH deleted AS (
+        DELETE FROM follows
+        WHERE user_following_id = :follower
+          AND user_being_followed_id = :followed
+        RETURNING 1
+    ), inserted AS (
+        INSERT INTO follows (user_following_id, user_being_followed_id)
+        SELECT :follower, :followed
+        WHERE NOT EXISTS (SELECT 1 FROM deleted)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), delta AS (
+        SELECT (SELECT count(*) FROM inserted)
+             - (SELECT count(*) FROM deleted) AS n
+    ), follower AS (
+        UPDATE users SET following_count = following_count + delta.n
+        FROM delta
+        WHERE id = :follower
+        RETURNING following_count
+    ), followed AS (
+        UPDATE users SET followers_count = followers_count + delta.n
+        FROM delta
+        WHERE id = :followed
+        RETURNING followers_count
+    )
+    SELECT EXISTS (SELECT 1 FROM inserted),
+           (SELECT following_count FROM follower),
+           (SELECT followers_count FROM followed)
+""")
+
+
+def dialect_is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def toggle_row(table, **key):
+    """Delete the row of `table` matching `key`, or insert it if absent.
+
+    The portable (two statement) version of the toggles above. Returns
+    True if the row now exists.
+    """
+
+    criteria = [table.c[column] == value for column, value in key.items()]
+    deleted = db.session.execute(table.delete().where(db.and_(*criteria)))
+
+    if deleted.rowcount:
+        return False
+
+    db.session.execute(table.insert().values(**key))
+    return True
+
+
+##############################################################################
+# Search indexes (queried by search.py)
+#
+# Postgres: trigram GIN indexes for username/bio/location substring and
+# prefix matches, and a GIN index over the messages' text search vector.
+# SQLite (local dev): external-content FTS5 tables kept in sync by triggers.
+
+POSTGRES_SEARCH_DDL = {
+    'users': [
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (username gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_users_bio_trgm "
+        "ON users USING gin (bio gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_users_location_trgm "
+        "ON users USING gin (location gin_trgm_ops)",
+    ],
+    'messages': [
+        "CREATE INDEX IF NOT EXISTS ix_messages_text_tsv "
+        "ON messages USING gin (to_tsvector('english', text))",
+    ],
+}
+
+SQLITE_SEARCH_DDL = {
+    'users': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "username, bio, location, content='users', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+        "INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+    ],
+    'messages': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "text, content='messages', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages "
+        "BEGIN INSERT INTO messages_fts(rowid, text) "
+        "VALUES (new.id, new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages "
+        "BEGIN INSERT INTO messages_fts(messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); END",
+    ],
+}
+
+
+def create_postgres_search_indexes(table, connection, **kw):
+    """Create `table`'s search indexes, if `connection` is to Postgres.
+
+    The trigram indexes need the pg_trgm extension; where the server
+    doesn't ship it, they're skipped and search.py ranks without it.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    trigram = install_trigram(connection)
+
+    for statement in POSTGRES_SEARCH_DDL[table.name]:
+        if trigram or 'gin_trgm_ops' not in statement:
+            connection.execute(statement)
+
+
+def drop_postgres_search_indexes(table, connection):
+    """Drop `table`'s search indexes (e.g. to rebuild them after a load)."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for statement in POSTGRES_SEARCH_DDL[table.name]:
+        # "CREATE INDEX IF NOT EXISTS <name> ON ..."
+        connection.execute(f"DROP INDEX IF EXISTS {statement.split()[5]}")
+
+
+def install_trigram(connection):
+    """Install pg_trgm if the server has it. Returns whether it's there."""
+
+    available = connection.execute(
+        "SELECT installed_version FROM pg_available_extensions "
+        "WHERE name = 'pg_trgm'").first()
+
+    if available is None:
+        return False
+
+    if available.installed_version is None:
+        connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    return True
+
+
+for model in (User, Message):
+    table = model.__table__
+
+    db.event.listen(table, 'after_create', create_postgres_search_indexes)
+
+    for statement in SQLITE_SEARCH_DDL[table.name]:
+        db.event.listen(table, 'after_create',
+                        db.DDL(statement).execute_if(dialect='sqlite'))
+
+    db.event.listen(
+        table, 'before_drop',
+        db.DDL(f"DROP TABLE IF EXISTS {table.name}_fts")
+        .execute_if(dialect='sqlite'))
+
+
+@db.event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Have SQLite enforce foreign keys, and their ON DELETE CASCADEs.
+
+    It doesn't by default, so the toggles could insert rows for users and
+    messages that don't exist rather than raising IntegrityError.
+    """
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. The first app connected also
+    serves queries made outside any app context (scripts, the tests).
     """
 
-    db.app = app
+    if db.app is None:
+        db.app = app
     db.init_app(app)
@@ -0,0 +1,112 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Pages are addressed by an opaque `before` token holding the sort key of
+the last row already seen, so fetching any page is a range read on an
+index rather than an OFFSET scan over everything before it. Message ids
+are in time order (see snowflake.py), so the id alone orders messages
+newest first; other lists sort on a timestamp, then an id to break ties.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+
+from flask import abort, request
+
+from models import db
+
+MESSAGES_PER_PAGE = 100
+# a multiple of the three cards a row shows
+USERS_PER_PAGE = 60
+
+
+class InvalidCursor(ValueError):
+    """Raised when a `before` token can't be decoded."""
+
+
+def encode_cursor(*values):
+    """Make an opaque cursor for the row with sort key `values`."""
+
+    raw = '|'.join(value.isoformat() if isinstance(value, datetime)
+                   else str(value)
+                   for value in values)
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, types=(int,)):
+    """Turn a cursor from `encode_cursor` back into its values.
+
+    `types` are the values' types (int or datetime), in order.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('UTF-8')
+        parts = raw.split('|')
+        if len(parts) != len(types):
+            raise ValueError(f"expected {len(types)} values")
+
+        return tuple(datetime.fromisoformat(part) if kind is datetime
+                     else kind(part)
+                     for kind, part in zip(types, parts))
+    except (BinasciiError, UnicodeError, ValueError) as exc:
+        raise InvalidCursor(token) from exc
+
+
+def page_query(query, *columns, before=None, per_page=MESSAGES_PER_PAGE):
+    """`query` narrowed to one page: rows before the `before` cursor,
+    highest `columns` first, with one extra row to show there are more.
+
+    Raises InvalidCursor if `before` can't be decoded.
+    """
+
+    if before:
+        values = decode_cursor(before,
+                               [column.type.python_type for column in columns])
+        query = query.filter(db.tuple_(*columns) < db.tuple_(*values)
+                             if len(columns) > 1 else columns[0] < values[0])
+
+    return (query
+            .order_by(*(column.desc() for column in columns))
+            .limit(per_page + 1))
+
+
+def paginate(query, *columns, before=None, per_page=MESSAGES_PER_PAGE,
+             key=None):
+    """Get one page of `query`, highest `columns` (newest) first.
+
+    `columns` is the sort key, most significant first; together they must
+    be unique, and end an index whose other columns the query pins to one
+    value, for this to be a range read. `key(item)` gives an item's values
+    for them; by default, its attributes named like the columns. Returns
+    (items, next_cursor); next_cursor is None on the last page.
+    """
+
+    items = page_query(query, *columns, before=before,
+                       per_page=per_page).all()
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    if key is None:
+        values = [getattr(items[-1], column.key) for column in columns]
+    else:
+        values = key(items[-1])
+
+    return items, encode_cursor(*values)
+
+
+def paginate_request(query, *columns, per_page=MESSAGES_PER_PAGE, key=None):
+    """`paginate`, from the `before` cursor in the request's querystring.
+
+    Aborts with 400 if it's not a cursor we issued.
+    """
+
+    try:
+        return paginate(query, *columns,
+                        before=request.args.get('before'),
+                        per_page=per_page,
+                        key=key)
+    except InvalidCursor:
+        abort(400)
@@ -0,0 +1,178 @@
+"""Password hashing for Warbler, run off the request thread.
+
+bcrypt is deliberately slow (~250ms at the default cost), so a burst of
+logins can pin every web worker. `PasswordHasher` runs the work in a small
+process pool and bounds how many requests may wait on it; past that bound
+it raises `PasswordHasherBusy` rather than queueing without limit.
+
+`hasher` is the current app's (see extensions.py). Config (read when
+`hasher.init_app` builds it):
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes (default 12)
+- PASSWORD_HASH_WORKERS: pool processes; 0 hashes inline (default 2)
+- PASSWORD_HASH_MAX_QUEUE: most requests waiting on the pool (default 32)
+- PASSWORD_HASH_QUEUE_TIMEOUT: seconds to wait for a slot (default 5)
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+import bcrypt
+
+from extensions import AppExtension
+
+
+class PasswordHasherBusy(Exception):
+    """Too many requests are already waiting to hash a password."""
+
+
+def hash_password(password, rounds):
+    """bcrypt hash of `password` at work factor `rounds`, as text."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('UTF-8'), salt).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    try:
+        return bcrypt.checkpw(password.encode('UTF-8'),
+                              hashed.encode('UTF-8'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+def hash_rounds(hashed):
+    """The work factor a bcrypt hash was made with, or None."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded process pool."""
+
+    def __init__(self, rounds=12, workers=2, max_queue=32, queue_timeout=5):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.queue_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.seconds_total = 0.0
+
+        self._pool = None
+        self._slots = BoundedSemaphore(max_queue)
+        self._lock = Lock()
+
+    def hash(self, password):
+        """Hash `password` at the configured work factor."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        """Counters describing the hasher's load so far."""
+
+        return {
+            'queue_depth': self.queue_depth,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'seconds_total': self.seconds_total,
+        }
+
+    def shutdown(self):
+        """Stop the pool; a new one starts on next use (e.g. after fork)."""
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _run(self, func, *args):
+        """Run `func(*args)` on the pool (or inline), keeping the stats."""
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+
+        with self._lock:
+            self.queue_depth += 1
+
+        start = perf_counter()
+        try:
+            if self.workers:
+                return self._submit(func, *args)
+            return func(*args)
+
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+                self.completed += 1
+                self.seconds_total += perf_counter() - start
+            self._slots.release()
+
+    def _submit(self, func, *args):
+        """Run `func(*args)` on the pool, replacing it (once) if it's broken,
+        e.g. because one of its processes was killed."""
+
+        pool = self._get_pool()
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            return self._get_pool().submit(func, *args).result()
+
+    def _discard_pool(self, pool):
+        """Stop using `pool`, unless another thread already replaced it."""
+
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # forking a threaded worker can copy locks other threads
+                # hold; forkserver starts processes from a clean one
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'))
+            return self._pool
+
+
+def app_hasher(app):
+    """A PasswordHasher configured from `app.config`; without an app, one
+    with the defaults."""
+
+    if app is None:
+        return PasswordHasher()
+
+    config = app.config
+    return PasswordHasher(
+        rounds=int(config.get('BCRYPT_LOG_ROUNDS', 12)),
+        workers=int(config.get('PASSWORD_HASH_WORKERS', 2)),
+        max_queue=int(config.get('PASSWORD_HASH_MAX_QUEUE', 32)),
+        queue_timeout=float(config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5)))
+
+
+hasher = AppExtension('password_hasher', app_hasher)
@@ -0,0 +1,61 @@
+"""Per-request SQL statement counting with declared per-route budgets.
+
+Decorate a view with `@query_budget(n)` to declare that it should run at
+most `n` SQL statements. After each request the count is checked; going
+over budget logs a warning, or raises `QueryBudgetExceeded` when the app's
+QUERY_BUDGET_STRICT config is set (as the tests do).
+"""
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL statements than its route allows."""
+
+
+def query_budget(max_queries):
+    """Declare the most SQL statements the decorated view may run."""
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Engine hook: count a statement against the current request."""
+
+    if has_app_context() and 'query_count' in g:
+        g.query_count += 1
+
+
+def init_query_budget(app):
+    """Count SQL statements per request for `app` and enforce budgets."""
+
+    app.config.setdefault('QUERY_BUDGET_STRICT', False)
+
+    if not event.contains(Engine, 'before_cursor_execute', count_query):
+        event.listen(Engine, 'before_cursor_execute', count_query)
+
+    @app.before_request
+    def start_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        count = g.get('query_count', 0)
+
+        if budget is not None and count > budget:
+            problem = (f"{request.endpoint} ran {count} SQL statements; "
+                       f"its budget is {budget}")
+
+            if app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(problem)
+            app.logger.warning(problem)
+
+        return response
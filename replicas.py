@@ -0,0 +1,184 @@
+"""Read-replica routing and connection pool settings.
+
+Give the app DATABASE_REPLICA_URLS and the reads of GET (and HEAD)
+requests -- timelines, profiles, search -- go to one of the replicas,
+picked per request. Writes, and every statement of other requests, go to
+the primary. After a POST (or other write) the client sticks to the
+primary for DATABASE_STICKY_SECONDS, noted in its session cookie, so
+people see their own changes even when the replicas lag behind.
+
+Other people's changes can show up a little late, and a user or message
+read from a lagging replica can be cached (see cache.py) until its
+timeout, just as if it had been read a moment earlier.
+
+Pool settings (DATABASE_POOL_SIZE and friends) apply to the primary and
+each replica alike, per process; /metrics reports how full each pool is.
+
+Pools aren't shared across a fork (as with gunicorn --preload, even if
+the master used the database while loading the app): the forking
+process closes its idle connections first, and the child starts with
+empty pools, so no two processes ever talk over one connection.
+"""
+
+import os
+import random
+from time import time
+from weakref import WeakSet
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+from metrics import registry
+
+# replicas are Flask-SQLAlchemy binds named replica0, replica1, ...
+REPLICA_BIND_PREFIX = 'replica'
+
+# session key: time until which reads go to the primary
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+# apps set up by `init_replicas`: whose pools to empty around forks and
+# report in /metrics
+_apps = WeakSet()
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends the current request's reads to its replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = self.read_bind(clause)
+        if bind:
+            return get_state(self.app).db.get_engine(self.app, bind=bind)
+
+        return super().get_bind(mapper, clause)
+
+    def read_bind(self, clause):
+        """The replica bind to read from, or None for the primary."""
+
+        if (self._flushing or isinstance(clause, UpdateBase)
+                or not has_request_context()):
+            return None
+
+        return g.get('db_read_bind')
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_binds(app):
+    return sorted(bind for bind in app.config.get('SQLALCHEMY_BINDS') or {}
+                  if bind.startswith(REPLICA_BIND_PREFIX))
+
+
+def engines(app):
+    """(bind name, engine) for each of `app`'s engines made so far."""
+
+    connectors = list(get_state(app).connectors.items())
+    return [(bind or 'primary', connector._engine)
+            for bind, connector in connectors
+            if connector._engine is not None]
+
+
+def dispose_pools():
+    """Close the idle connections of every app's engines.
+
+    Run on both sides of a fork. Connections in use when the process
+    forks are left to their owner: the child never checks them in.
+    """
+
+    for app in list(_apps):
+        for bind, engine in engines(app):
+            engine.dispose()
+
+
+os.register_at_fork(before=dispose_pools, after_in_child=dispose_pools)
+
+
+def pool_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the DATABASE_POOL_* settings."""
+
+    # SQLite's pools don't take sizes (or need them)
+    if make_url(config['SQLALCHEMY_DATABASE_URI']).drivername == 'sqlite':
+        return {}
+
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+
+def init_replicas(app):
+    """Set up the database pools and replicas for `app`, and route reads.
+
+    Call before the first database use, so the engines get the settings.
+    """
+
+    app.config.setdefault('DATABASE_REPLICA_URLS', [])
+    app.config.setdefault('DATABASE_STICKY_SECONDS', 10)
+    app.config.setdefault('DATABASE_POOL_SIZE', 5)
+    app.config.setdefault('DATABASE_MAX_OVERFLOW', 10)
+    app.config.setdefault('DATABASE_POOL_TIMEOUT', 30)
+    app.config.setdefault('DATABASE_POOL_RECYCLE', 30 * 60)
+    app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.update(pool_options(app.config))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for i, url in enumerate(app.config['DATABASE_REPLICA_URLS']):
+        binds[f'{REPLICA_BIND_PREFIX}{i}'] = url
+    app.config['SQLALCHEMY_BINDS'] = binds
+    _apps.add(app)
+
+    @app.before_request
+    def route_reads():
+        binds = replica_binds(app)
+        sticky = session.get(PRIMARY_UNTIL_KEY, 0) > time()
+
+        if binds and request.method in READ_METHODS and not sticky:
+            g.db_read_bind = random.choice(binds)
+        else:
+            g.db_read_bind = None
+
+    @app.after_request
+    def stick_to_primary(response):
+        if replica_binds(app) and request.method not in (*READ_METHODS,
+                                                         'OPTIONS'):
+            session[PRIMARY_UNTIL_KEY] = (
+                time() + app.config['DATABASE_STICKY_SECONDS'])
+        return response
+
+
+@registry.collector
+def pool_metrics():
+    # only engines already made; a scrape shouldn't open connections
+    pools = [(bind, engine.pool)
+             for app in list(_apps)
+             for bind, engine in engines(app)
+             if hasattr(engine.pool, 'checkedout')]
+
+    def per_pool(stat):
+        return [({'bind': bind}, getattr(pool, stat)())
+                for bind, pool in pools]
+
+    yield ('warbler_db_pool_size', 'gauge',
+           "Connections each pool keeps open.", per_pool('size'))
+    yield ('warbler_db_pool_checked_out', 'gauge',
+           "Connections in use.", per_pool('checkedout'))
+    yield ('warbler_db_pool_idle', 'gauge',
+           "Open connections waiting in the pool.", per_pool('checkedin'))
+    yield ('warbler_db_pool_overflow', 'gauge',
+           "Connections open beyond the pool's size (negative while "
+           "the pool isn't full).", per_pool('overflow'))
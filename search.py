@@ -0,0 +1,151 @@
+"""Ranked, paginated search over users and messages.
+
+On Postgres, user search matches username/bio/location by substring using
+the pg_trgm GIN indexes, ranking username prefix matches first and then by
+trigram similarity (servers without pg_trgm still work, but scan). Message
+search uses the full-text GIN index ranked by ts_rank. On SQLite (local
+dev) both go through the FTS5 tables. The indexes themselves are declared
+in models.py.
+
+Ranked results can't be keyset-paginated, so pages are numbered, but the
+page number is capped so a search can never turn into a deep OFFSET scan.
+"""
+
+from models import db, User, Message, USER_CARD_COLUMNS
+
+SEARCH_RESULTS_PER_PAGE = 24
+MAX_SEARCH_PAGE = 40
+
+
+def escape_like(term):
+    """Escape LIKE wildcards so `term` matches literally."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def fts5_query(term):
+    """Turn free text into an FTS5 query of prefix-matched words."""
+
+    words = [word.replace('"', '""') for word in term.split()]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def dialect_name():
+    """Name of the database dialect the session is bound to."""
+
+    return db.session.get_bind().dialect.name
+
+
+_trigram_installed = {}
+
+
+def trigram_installed():
+    """Is pg_trgm installed in the database? (Checked once per engine.)"""
+
+    engine = db.session.get_bind()
+
+    if engine.url not in _trigram_installed:
+        _trigram_installed[engine.url] = bool(db.session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first())
+
+    return _trigram_installed[engine.url]
+
+
+def page_bounds(page, per_page):
+    """(offset, limit) for 1-based `page`, clamped to MAX_SEARCH_PAGE."""
+
+    page = min(max(page, 1), MAX_SEARCH_PAGE)
+    return (page - 1) * per_page, per_page + 1
+
+
+def split_page(rows, per_page):
+    """(rows on this page, whether there's another page)."""
+
+    return rows[:per_page], len(rows) > per_page
+
+
+def user_search_query(term):
+    """Query for the cards (USER_CARD_COLUMNS) of users matching `term`,
+    best matches first."""
+
+    if dialect_name() == 'sqlite':
+        fts = db.table('users_fts', db.column('rowid'), db.column('rank'))
+        return (db.session.query(*USER_CARD_COLUMNS)
+                .join(fts, fts.c.rowid == User.id)
+                .filter(db.text("users_fts MATCH :match"))
+                .params(match=fts5_query(term))
+                .order_by(fts.c.rank, User.id))
+
+    pattern = f"%{escape_like(term)}%"
+    prefix = f"{escape_like(term)}%"
+
+    # without pg_trgm, shorter usernames are the closer matches
+    closeness = (db.func.similarity(User.username, term).desc()
+                 if trigram_installed()
+                 else db.func.length(User.username))
+
+    return (db.session.query(*USER_CARD_COLUMNS)
+            .filter(db.or_(User.username.ilike(pattern),
+                           User.bio.ilike(pattern),
+                           User.location.ilike(pattern)))
+            .order_by(User.username.ilike(prefix).desc(),
+                      closeness,
+                      User.id))
+
+
+def search_users(term, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+    """Find users whose username, bio or location match `term`.
+
+    Returns (users, has_more); the users are USER_CARD_COLUMNS rows.
+    """
+
+    term = term.strip()
+    if not term:
+        return [], False
+
+    offset, limit = page_bounds(page, per_page)
+    users = user_search_query(term).offset(offset).limit(limit).all()
+    return split_page(users, per_page)
+
+
+def message_search_query(term):
+    """Query for the messages matching `term`, best matches first, with
+    their authors."""
+
+    if dialect_name() == 'sqlite':
+        fts = db.table('messages_fts', db.column('rowid'), db.column('rank'))
+        query = (Message.query
+                 .join(fts, fts.c.rowid == Message.id)
+                 .filter(db.text("messages_fts MATCH :match"))
+                 .params(match=fts5_query(term))
+                 .order_by(fts.c.rank, Message.id.desc()))
+    else:
+        vector = db.func.to_tsvector('english', Message.text)
+        tsquery = db.func.plainto_tsquery('english', term)
+        query = (Message.query
+                 .filter(vector.op('@@')(tsquery))
+                 .order_by(db.func.ts_rank(vector, tsquery).desc(),
+                           Message.id.desc()))
+
+    return query.options(db.joinedload(Message.user))
+
+
+def search_messages(term, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+    """Find messages whose text matches `term`, best matches first.
+
+    Returns (messages, has_more), with each message's author loaded.
+    """
+
+    term = term.strip()
+    if not term:
+        return [], False
+
+    offset, limit = page_bounds(page, per_page)
+    messages = (message_search_query(term)
+                .offset(offset)
+                .limit(limit)
+                .all())
+    return split_page(messages, per_page)
@@ -1,20 +1,303 @@
-"""Seed database with sample data from CSV Files."""
+"""Load sample data from CSV files into the database.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Each table's CSV (users.csv, messages.csv, follows.csv and likes.csv in
+--data-dir; missing files are skipped) is streamed in batches: through
+COPY on Postgres, executemany elsewhere (e.g. SQLite). Progress is
+reported in rows/sec.
 
+    python seed.py                      # generator/*.csv into DATABASE_URL
+    python seed.py --data-dir /data/big --batch-size 100000
+    python seed.py --resume             # carry on after an interrupted load
+    python seed.py --drop               # empty the database first
+    python seed.py --rebuild-derived    # rebuild timelines and counts too
 
-db.drop_all()
-db.create_all()
+Tables are never dropped unless --drop is given, so loading appends to
+what's there. Rows are taken from the CSV as they are: a file with an
+`id` column must not reuse ids already in the table, and one without
+relies on the ids the database hands out (e.g. messages.csv's user_id
+values assume users.csv was loaded into an empty users table).
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+A fresh load (--drop, or every table being loaded starts out empty)
+drops the indexes that aren't needed to keep the data valid and builds
+them once it's done, then rebuilds timelines and counters from the
+loaded rows. Appending to tables that already have rows leaves their
+indexes in place, since the app may be reading them, and leaves
+timelines and counters alone: rebuilding them rewrites every user's
+timeline, so that only happens with --rebuild-derived.
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+Every batch is committed together with a note of how far into its file
+the load got, so --resume skips what an interrupted run already loaded.
+A resumed fresh load no longer starts out empty, so pass it
+--rebuild-derived as well.
+"""
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+import argparse
+import csv
+import io
+import os
+import sys
+from time import perf_counter
 
-db.session.commit()
+TABLES = ('users', 'messages', 'follows', 'likes')
+
+PROGRESS_DDL = """
+    CREATE TABLE IF NOT EXISTS load_progress (
+        source VARCHAR PRIMARY KEY,
+        rows_loaded BIGINT NOT NULL
+    )
+"""
+
+
+def read_batches(path, batch_size, skip=0):
+    """Yield (columns, rows) for each batch of up to `batch_size` CSV rows.
+
+    The first `skip` data rows are passed over.
+    """
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+
+        for _ in range(skip):
+            if next(reader, None) is None:
+                return
+
+        batch = []
+        for row in reader:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield columns, batch
+                batch = []
+
+        if batch:
+            yield columns, batch
+
+
+class Loader:
+    """Writes batches of CSV rows straight through a DB-API connection."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.postgres = engine.dialect.name == 'postgresql'
+        self.param = '?' if engine.dialect.paramstyle == 'qmark' else '%s'
+        self.connection = engine.raw_connection()
+
+        cursor = self.connection.cursor()
+        cursor.execute(PROGRESS_DDL)
+        self.connection.commit()
+
+    def forget_progress(self):
+        """Forget every earlier run (e.g. once the tables are emptied)."""
+
+        self.connection.cursor().execute("DELETE FROM load_progress")
+        self.connection.commit()
+
+    def rows_loaded(self, source):
+        """How many of `source`'s rows earlier runs have loaded."""
+
+        cursor = self.connection.cursor()
+        cursor.execute(f"SELECT rows_loaded FROM load_progress "
+                       f"WHERE source = {self.param}", (source,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def load(self, table, path, batch_size, skip=0):
+        """Load `path` into `table`, after its first `skip` rows.
+
+        Yields the number of rows loaded so far after each batch.
+        """
+
+        source = os.path.abspath(path)
+        loaded = 0
+        columns = ()
+
+        for columns, rows in read_batches(path, batch_size, skip=skip):
+            cursor = self.connection.cursor()
+
+            if self.postgres:
+                self.copy(cursor, table, columns, rows)
+            else:
+                self.insert(cursor, table, columns, rows)
+
+            loaded += len(rows)
+            self.save_progress(cursor, source, skip + loaded)
+            self.connection.commit()
+            yield loaded
+
+        if self.postgres and 'id' in columns:
+            self.reset_sequence(table)
+
+    def copy(self, cursor, table, columns, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+
+    def insert(self, cursor, table, columns, rows):
+        # empty CSV fields are NULLs, as they are for COPY
+        values = ([value if value != '' else None for value in row]
+                  for row in rows)
+        placeholders = ', '.join([self.param] * len(columns))
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({placeholders})",
+            values)
+
+    def save_progress(self, cursor, source, loaded):
+        cursor.execute(
+            f"INSERT INTO load_progress (source, rows_loaded) "
+            f"VALUES ({self.param}, {self.param}) "
+            f"ON CONFLICT (source) DO UPDATE "
+            f"SET rows_loaded = excluded.rows_loaded",
+            (source, loaded))
+
+    def reset_sequence(self, table):
+        """Move `table`'s id sequence past ids loaded from the CSV."""
+
+        cursor = self.connection.cursor()
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT max(id) FROM {table}))")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def deferred_indexes(db, tables):
+    """Drop the indexes of `tables` that can wait until after a load."""
+
+    from models import drop_postgres_search_indexes, POSTGRES_SEARCH_DDL
+
+    with db.engine.begin() as connection:
+        for table in tables:
+            for index in table.indexes:
+                if not index.unique:
+                    connection.execute(f"DROP INDEX IF EXISTS {index.name}")
+
+            if table.name in POSTGRES_SEARCH_DDL:
+                drop_postgres_search_indexes(table, connection)
+
+
+def create_indexes(db, tables):
+    """Build the indexes `deferred_indexes` dropped."""
+
+    from models import create_postgres_search_indexes, POSTGRES_SEARCH_DDL
+
+    with db.engine.begin() as connection:
+        for table in tables:
+            existing = {index['name'] for index
+                        in db.inspect(connection).get_indexes(table.name)}
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+
+            if table.name in POSTGRES_SEARCH_DDL:
+                create_postgres_search_indexes(table, connection)
+
+
+def is_empty(db, table):
+    """Does `table` have no rows?"""
+
+    with db.engine.connect() as connection:
+        return connection.execute(
+            db.select([db.literal(1)]).select_from(table).limit(1)
+        ).first() is None
+
+
+def timed(label, func):
+    start = perf_counter()
+    func()
+    print(f"{label} in {perf_counter() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--resume', action='store_true',
+                        help="skip rows an interrupted run already loaded")
+    parser.add_argument('--drop', action='store_true',
+                        help="drop and recreate every table first")
+    parser.add_argument('--rebuild-derived', action='store_true',
+                        help="rebuild timelines and counters after "
+                             "appending (always done on a fresh load)")
+    parser.add_argument('tables', nargs='*',
+                        help="tables to load (default: all with a CSV)")
+    args = parser.parse_args()
+
+    unknown = set(args.tables) - set(TABLES)
+    if unknown:
+        parser.error(f"unknown tables: {', '.join(sorted(unknown))}")
+
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    from app import db
+    from models import User, TimelineEntry
+
+    if args.drop:
+        db.drop_all()
+    db.create_all()
+
+    names = [name for name in args.tables or TABLES
+             if os.path.exists(os.path.join(args.data_dir, f"{name}.csv"))]
+    tables = [db.metadata.tables[name] for name in names]
+    fresh = all(is_empty(db, table) for table in tables)
+    rebuild = fresh or args.rebuild_derived
+    derived = [TimelineEntry.__table__] if rebuild else []
+
+    # dropping indexes under a table the app is reading would turn the
+    # load into an outage, so only do it while nothing's there to read
+    if fresh:
+        deferred_indexes(db, tables + derived)
+
+    loader = Loader(db.engine)
+    if args.drop:
+        loader.forget_progress()
+
+    try:
+        for name in names:
+            path = os.path.join(args.data_dir, f"{name}.csv")
+            skip = (loader.rows_loaded(os.path.abspath(path))
+                    if args.resume else 0)
+            if skip:
+                print(f"{name}: skipping {skip:,} rows loaded earlier")
+
+            start = perf_counter()
+            loaded = 0
+
+            for loaded in loader.load(name, path, args.batch_size, skip):
+                rate = loaded / (perf_counter() - start)
+                print(f"\r{name}: {loaded:,} rows ({rate:,.0f} rows/sec)",
+                      end='', file=sys.stderr, flush=True)
+
+            elapsed = perf_counter() - start
+            print(f"\r{name}: {loaded:,} rows in {elapsed:.1f}s "
+                  f"({loaded / elapsed:,.0f} rows/sec)")
+    finally:
+        loader.close()
+
+    # the rebuild and reconcile read messages by user and follows by
+    # either side, so the loaded tables' indexes go back first (this also
+    # builds any an interrupted fresh load left dropped)
+    timed("Built indexes", lambda: create_indexes(db, tables))
+
+    # bulk loads skip the fan-out and counter updates done by the app's
+    # write paths, so build timelines and counts here
+    if rebuild:
+        timed("Rebuilt timelines", TimelineEntry.rebuild)
+        timed("Reconciled counts", User.reconcile_counts)
+        db.session.commit()
+        timed("Built timeline indexes", lambda: create_indexes(db, derived))
+    else:
+        print("Appended to existing rows: timelines and counts were not "
+              "updated (rerun with --rebuild-derived to rebuild them)")
+
+
+if __name__ == '__main__':
+    main()
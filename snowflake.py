@@ -0,0 +1,190 @@
+"""Time-ordered 64-bit ids ("snowflakes") for messages.
+
+An id is the milliseconds since EPOCH (41 bits), a worker id (10 bits)
+and a per-worker sequence number (12 bits), so ids sort by creation time
+and can be made in-process, without asking the database. Newest first is
+then just descending id order, and a timeline or profile page is a range
+read on an index ending in the message id.
+
+Each process making ids needs its own worker id, so it leases one: it
+holds a lock on a file named for the id (in the temp directory) for as
+long as it lives, and a process forked from it leases another. With
+SNOWFLAKE_WORKER_ID set, a host's processes lease ids from that one up,
+SNOWFLAKE_WORKER_IDS of them (say, one block per container); past that,
+making ids fails rather than repeating them. Without it, a process
+leases whichever id is free from a random starting point, which a
+process on another host could also be using, so set it in production.
+
+Within a process, ids never go backwards: if the clock does, or 4096 ids
+are wanted in one millisecond, ids carry on from the last millisecond
+used, running a little ahead of the clock until it catches up.
+"""
+
+import fcntl
+import logging
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+
+EPOCH = datetime(2000, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# how many worker ids a host's processes share by default
+DEFAULT_WORKER_IDS = 16
+
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+logger = logging.getLogger(__name__)
+
+
+def make_id(milliseconds, worker_id=0, sequence=0):
+    """The id for `milliseconds` after EPOCH, from `worker_id`."""
+
+    return ((milliseconds << TIMESTAMP_SHIFT)
+            | (worker_id << SEQUENCE_BITS)
+            | sequence)
+
+
+def timestamp_of(id):
+    """When the id was made (naive UTC, to the millisecond)."""
+
+    return EPOCH + timedelta(milliseconds=id >> TIMESTAMP_SHIFT)
+
+
+def first_id_at(when):
+    """The smallest id that could be made at `when` (naive UTC)."""
+
+    return make_id(max(0, (when - EPOCH) // timedelta(milliseconds=1)))
+
+
+class NoFreeWorkerId(RuntimeError):
+    """Every worker id this process may lease is held by another."""
+
+
+class SnowflakeIds:
+    """Makes unique, increasing ids for one process; thread safe."""
+
+    def __init__(self, worker_id=None, worker_ids=DEFAULT_WORKER_IDS,
+                 lease_dir=None):
+        self.first_worker_id = worker_id
+        self.worker_ids = worker_ids
+        self.lease_dir = lease_dir or tempfile.gettempdir()
+        self.lock = Lock()
+        self.lease = None
+        self.pid = None
+
+    def init_app(self, app):
+        """Take the worker ids from SNOWFLAKE_WORKER_ID(S).
+
+        Ids are made per process, not per app, so this configures the
+        process's ids for every app in it. Warns if a production app
+        leaves the worker id to chance.
+        """
+
+        worker_id = app.config.get('SNOWFLAKE_WORKER_ID')
+        worker_ids = app.config.get('SNOWFLAKE_WORKER_IDS',
+                                    DEFAULT_WORKER_IDS)
+
+        if worker_id is not None and not (
+                0 <= worker_id
+                and 0 < worker_ids
+                and worker_id + worker_ids - 1 <= MAX_WORKER_ID):
+            raise ValueError(f"SNOWFLAKE_WORKER_ID and SNOWFLAKE_WORKER_IDS "
+                             f"must give worker ids from 0 to "
+                             f"{MAX_WORKER_ID}, not {worker_id} and "
+                             f"{worker_ids} from there")
+
+        if worker_id is None and app.config.get('PROFILE') == 'production':
+            logger.warning("SNOWFLAKE_WORKER_ID isn't set; message ids use "
+                           "a random free worker id, which processes on "
+                           "other hosts may share")
+
+        with self.lock:
+            self.first_worker_id = worker_id
+            self.worker_ids = worker_ids
+            self.release()
+            # lease again when the next id is made
+            self.pid = None
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.worker_id = self.lease_worker_id()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def lease_worker_id(self):
+        """Lock the lease file of a free worker id and return the id.
+
+        The lock lasts until this process exits or `release` is called.
+        Raises NoFreeWorkerId if every id it may use is held.
+        """
+
+        self.release()
+
+        if self.first_worker_id is None:
+            start = random.randrange(MAX_WORKER_ID + 1)
+            candidates = [(start + n) % (MAX_WORKER_ID + 1)
+                          for n in range(MAX_WORKER_ID + 1)]
+        else:
+            candidates = range(self.first_worker_id,
+                               self.first_worker_id + self.worker_ids)
+
+        for worker_id in candidates:
+            path = os.path.join(self.lease_dir,
+                                f"warbler-snowflake-{worker_id}.lock")
+            lease = open(path, 'a')
+            try:
+                fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lease.close()
+                continue
+
+            self.lease = lease
+            return worker_id
+
+        raise NoFreeWorkerId(f"all worker ids {candidates[0]} to "
+                             f"{candidates[-1]} are leased; raise "
+                             f"SNOWFLAKE_WORKER_IDS")
+
+    def release(self):
+        """Give up this process's worker id lease, if it has one.
+
+        After a fork the lease is the parent's: closing the child's copy
+        of the file leaves the parent's lock in place.
+        """
+
+        if self.lease is not None:
+            self.lease.close()
+            self.lease = None
+
+    def next_id(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # first id, or forked: lease a worker id of our own, so
+                # as not to repeat the parent's (or a sibling's) ids
+                self.reset()
+
+            now = int(time() * 1000) - EPOCH_MS
+
+            if now > self.last_ms:
+                self.last_ms = now
+                self.sequence = 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self.last_ms += 1
+                self.sequence = 0
+
+            return make_id(self.last_ms, self.worker_id, self.sequence)
+
+
+message_ids = SnowflakeIds()
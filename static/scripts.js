@@ -7,39 +7,163 @@ $(function() {
 		await handleFollowOther(evt);
 	});
 
-	$(".like-form").on("click", ".like", async function(evt) {
+	// delegated, so messages added by infinite scroll are covered too
+	$("#messages").on("click", ".like-form .like", async function(evt) {
 		await handleLikes(evt);
 	});
+
+	$(".next-page").on("click", async function(evt) {
+		evt.preventDefault();
+		await loadMoreMessages();
+	});
+
+	$(window).on("scroll", async function() {
+		const nearBottom =
+			$(window).scrollTop() + $(window).height() > $(document).height() - 400;
+		if (nearBottom) await loadMoreMessages();
+	});
+
+	followTimeline();
 });
 
+// New timeline messages arrive by server-sent events, or by polling where
+// EventSource isn't supported or the server has no stream to spare, and
+// go at the top of the list.
+
+const POLL_RETRY_MS = 5000;
+
+function followTimeline() {
+	let after = $("#messages").attr("data-live-after");
+	if (!after) return;
+
+	if (!window.EventSource) {
+		pollTimeline(after);
+		return;
+	}
+
+	const source = new EventSource(`/timeline/stream?after=${after}`);
+	source.addEventListener("messages", (evt) => {
+		$("#messages").prepend(JSON.parse(evt.data).html);
+		after = evt.lastEventId;
+	});
+	source.addEventListener("error", () => {
+		// closed for good (e.g. refused with a 503), not reconnecting
+		if (source.readyState === EventSource.CLOSED) pollTimeline(after);
+	});
+}
+
+function sleep(ms) {
+	return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+async function pollTimeline(after) {
+	while (true) {
+		try {
+			const response = await axios.get(`/timeline/poll?after=${after}`);
+			if (response.data.html) $("#messages").prepend(response.data.html);
+			after = response.data.after;
+			// the server couldn't hold the poll open; ask again later
+			if (response.data.retry) await sleep(response.data.retry);
+		} catch (err) {
+			await sleep(POLL_RETRY_MS);
+		}
+	}
+}
+
+let loadingMessages = false;
+
+async function loadMoreMessages() {
+	const $messages = $("#messages");
+	const nextUrl = $messages.attr("data-next-url");
+	if (!nextUrl || loadingMessages) return;
+
+	loadingMessages = true;
+	try {
+		const response = await axios.get(nextUrl);
+		$messages.append(response.data.html);
+		if (response.data.next) {
+			const base = nextUrl.split("?")[0];
+			$messages.attr("data-next-url", `${base}?before=${response.data.next}`);
+		} else {
+			$messages.removeAttr("data-next-url");
+			$(".next-page").remove();
+		}
+	} finally {
+		loadingMessages = false;
+	}
+}
+
+// Like and follow clicks are applied to the page straight away and queued;
+// the queue is sent to /toggles in one request once clicking pauses. A
+// second click on the same star or button cancels the queued one.
+const FLUSH_DELAY_MS = 300;
+const FOLLOW_BUTTONS = {
+	true: '<button class="btn btn-primary btn-sm">Unfollow</button>',
+	false: '<button class="btn btn-outline-primary btn-sm">Follow</button>',
+};
+
+const pendingToggles = new Map();
+let flushTimer = null;
+
+function queueToggle(type, id, onResult) {
+	const key = `${type}:${id}`;
+	if (pendingToggles.has(key)) {
+		pendingToggles.delete(key);
+	} else {
+		pendingToggles.set(key, { type, id, onResult });
+	}
+
+	clearTimeout(flushTimer);
+	flushTimer = setTimeout(flushToggles, FLUSH_DELAY_MS);
+}
+
+async function flushToggles() {
+	const toggles = [...pendingToggles.values()];
+	pendingToggles.clear();
+	if (!toggles.length) return;
+
+	const response = await axios.post("/toggles", {
+		toggles: toggles.map(({ type, id }) => ({ type, id })),
+	});
+	response.data.results.forEach((result, i) => {
+		if (!result.error) toggles[i].onResult(result);
+	});
+}
+
+function followButton(form, following) {
+	form.innerHTML = FOLLOW_BUTTONS[following];
+}
+
 async function handleFollow(evt) {
 	evt.preventDefault();
 	const form = evt.target.parentElement;
-	const followUserId = form.dataset.userId;
-	const response = await axios.post(`/users/handlefollow/${followUserId}`);
-	form.innerHTML = response.data.html;
-	$("#following-count").empty().append(response.data.follow_count);
+	const following = !form.querySelector(".btn-outline-primary");
+	followButton(form, !following);
+	queueToggle("follow", Number(form.dataset.userId), (result) => {
+		followButton(form, result.following);
+		$("#following-count").empty().append(result.following_count);
+	});
 }
 
 async function handleFollowOther(evt) {
 	evt.preventDefault();
 	const form = evt.target.parentElement;
-	const followUserId = form.dataset.userId;
-	const response = await axios.post(`/users/handlefollow/${followUserId}`);
-	form.innerHTML = response.data.html;
-	console.log("FOLLOWER COUNT:!!!!!", response.data);
-	$("#follower-count").empty().append(response.data.follower_count);
+	const following = !form.querySelector(".btn-outline-primary");
+	followButton(form, !following);
+	queueToggle("follow", Number(form.dataset.userId), (result) => {
+		followButton(form, result.following);
+		$("#follower-count").empty().append(result.followers_count);
+	});
 }
 
 async function handleLikes(evt) {
 	evt.preventDefault();
-	const $star = $(evt.target.closest("i"));
-	const messageId = $(evt.target.closest("form")).data().messageId;
-	const response = await axios.post(`/messages/${messageId}/handle-like`);
-	if (response) {
-		$star.toggleClass("far fas");
-		if (response.data.count) {
-			$("#user-likes").empty().append(response.data.count);
-		}
-	}
+	const $star = $(evt.target.closest("form")).find("i");
+	// a string: message ids are too big to be exact as JavaScript numbers
+	const messageId = evt.target.closest("form").dataset.messageId;
+	$star.toggleClass("far fas");
+	queueToggle("like", messageId, (result) => {
+		$star.toggleClass("fas", result.liked).toggleClass("far", !result.liked);
+		$("#user-likes[data-viewer-likes]").empty().append(result.likes_count);
+	});
 }
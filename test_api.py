@@ -0,0 +1,193 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import json_api
+from app import app, CURR_USER_KEY
+from models import db, Follows, Like, Message, User
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['QUERY_BUDGET_STRICT'] = True
+
+
+class SerializationTestCase(TestCase):
+    """Encoding API responses."""
+
+    def test_json_fallback_matches_orjson(self):
+        """Without orjson, is the output the same?"""
+
+        data = {'data': [{'id': str(2 ** 60), 'text': "héllo",
+                          'liked': None, 'count': 3}],
+                'next': None}
+        fast = json_api.dumps(data)
+
+        orjson, json_api.orjson = json_api.orjson, None
+        try:
+            slow = json_api.dumps(data)
+        finally:
+            json_api.orjson = orjson
+
+        self.assertEqual(json.loads(fast), json.loads(slow))
+        self.assertNotIn(b' ', slow.replace(b'"', b''))
+
+    def test_timestamps(self):
+        """Are timestamps ISO 8601 UTC?"""
+
+        self.assertEqual(
+            json_api.timestamp_json(datetime(2020, 5, 17, 9, 30, 1, 250000)),
+            "2020-05-17T09:30:01.250Z")
+
+
+class APITestCase(TestCase):
+    """The /api/v1 routes."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        viewer = User.signup(username="viewer", email="v@test.com",
+                             password="password", image_url=None)
+        author = User.signup(username="author", email="a@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        Follows.toggle(self.viewer_id, self.author_id)
+        self.message_ids = [Message.post(self.author_id, f"warble {i}").id
+                            for i in range(3)]
+        Like.toggle(self.viewer_id, self.message_ids[0])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_timeline(self):
+        """Does the timeline list messages newest first, in full?"""
+
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/json')
+
+        data = resp.get_json()['data']
+        self.assertEqual([message['id'] for message in data],
+                         [str(id) for id in reversed(self.message_ids)])
+        self.assertEqual(data[0]['user']['username'], "author")
+        self.assertTrue(data[0]['user']['following'])
+        self.assertEqual([message['liked'] for message in data],
+                         [False, False, True])
+
+    def test_sparse_fieldsets(self):
+        """Are only the fields asked for sent?"""
+
+        resp = self.client.get(
+            "/api/v1/timeline?fields[message]=id,text,user"
+            "&fields[user]=username")
+
+        self.assertEqual(resp.get_json()['data'][0],
+                         {'id': str(self.message_ids[-1]),
+                          'text': "warble 2",
+                          'user': {'username': "author"}})
+
+        resp = self.client.get("/api/v1/users?fields[user]=id,password")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("password", resp.get_json()['error'])
+
+    def test_pagination(self):
+        """Are lists paged by cursor?"""
+
+        resp = self.client.get(
+            f"/api/v1/users/{self.author_id}/messages?fields[message]=id")
+        page = resp.get_json()
+        self.assertEqual(len(page['data']), 3)
+        self.assertIsNone(page['next'])
+
+        resp = self.client.get("/api/v1/users?fields[user]=username")
+        users = resp.get_json()['data']
+        self.assertEqual([user['username'] for user in users],
+                         ["author", "viewer"])
+
+        resp = self.client.get("/api/v1/users?before=bogus")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_user_and_message(self):
+        """Can a profile and a message be fetched, or a JSON 404?"""
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}")
+        user = resp.get_json()['data']
+        self.assertEqual(user['messages_count'], 3)
+        self.assertTrue(user['following'])
+
+        resp = self.client.get(f"/api/v1/messages/{self.message_ids[0]}")
+        self.assertEqual(resp.get_json()['data']['text'], "warble 0")
+
+        resp = self.client.get("/api/v1/messages/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('error', resp.get_json())
+
+    def test_likes_and_follows(self):
+        """Do the likes and follow lists show what's been liked/followed?"""
+
+        resp = self.client.get(f"/api/v1/users/{self.viewer_id}/likes")
+        messages = resp.get_json()['data']
+        self.assertEqual([message['id'] for message in messages],
+                         [str(self.message_ids[0])])
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/followers")
+        self.assertEqual([user['id'] for user in resp.get_json()['data']],
+                         [self.viewer_id])
+
+        resp = app.test_client().get(
+            f"/api/v1/users/{self.author_id}/followers")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_post_message(self):
+        """Can a message be posted as JSON, but not as a form?"""
+
+        resp = self.client.post("/api/v1/messages", json={"text": "via API"})
+        self.assertEqual(resp.status_code, 201)
+        message = resp.get_json()['data']
+        self.assertEqual(message['text'], "via API")
+        self.assertEqual(message['user']['id'], self.viewer_id)
+        self.assertTrue(Message.query.get(int(message['id'])))
+
+        resp = self.client.post("/api/v1/messages", json={"text": "x" * 141})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('text', resp.get_json()['fields'])
+
+        resp = self.client.post("/api/v1/messages", data={"text": "form"})
+        self.assertEqual(resp.status_code, 415)
+
+    def test_toggles(self):
+        """Do the like and follow toggles flip and report state?"""
+
+        resp = self.client.post(
+            f"/api/v1/messages/{self.message_ids[1]}/like", json={})
+        self.assertEqual(resp.get_json()['data'],
+                         {'liked': True, 'likes_count': 2})
+
+        resp = self.client.post(f"/api/v1/users/{self.author_id}/follow",
+                                json={})
+        self.assertEqual(resp.get_json()['data'],
+                         {'following': False, 'following_count': 0,
+                          'followers_count': 0})
+
+        resp = self.client.post(f"/api/v1/users/{self.viewer_id}/follow",
+                                json={})
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,136 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, create_app
+from cache import cache
+from config import load_config
+from live import live_updates
+from models import db
+from passwords import hasher
+from snowflake import message_ids, MAX_WORKER_ID, SEQUENCE_BITS
+
+db.create_all()
+
+
+class CreateAppTestCase(TestCase):
+    """Building apps from the config profiles."""
+
+    def test_testing_profile(self):
+        """Does the testing profile give a lean app for the test database?"""
+
+        test_app = create_app('testing')
+
+        self.assertTrue(test_app.testing)
+        self.assertFalse(test_app.config['WTF_CSRF_ENABLED'])
+        self.assertEqual(test_app.config['SQLALCHEMY_DATABASE_URI'],
+                         os.environ['DATABASE_URL'])
+        self.assertEqual(test_app.config['PASSWORD_HASH_WORKERS'], 0)
+
+        resp = test_app.test_client().get("/login")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_apps_keep_their_own_extensions(self):
+        """Does building an app leave the other apps' state alone?"""
+
+        with app.app_context():
+            backend, hub, rounds = (cache.backend, live_updates.backend,
+                                    hasher.rounds)
+
+        test_app = create_app('testing')
+
+        with test_app.app_context():
+            self.assertIsNot(cache.backend, backend)
+            self.assertIsNot(live_updates.backend, hub)
+            self.assertEqual(hasher.rounds, 4)
+
+        with app.app_context():
+            self.assertIs(cache.backend, backend)
+            self.assertIs(live_updates.backend, hub)
+            self.assertEqual(hasher.rounds, rounds)
+            self.assertIs(db.get_app(), app)
+
+    def test_testing_profile_database(self):
+        """Does the testing profile honour DATABASE_URL?"""
+
+        def database_url():
+            return load_config('testing')['SQLALCHEMY_DATABASE_URI']
+
+        url = os.environ['DATABASE_URL']
+        try:
+            os.environ['DATABASE_URL'] = "postgresql://ci-db/warbler-ci"
+            self.assertEqual(database_url(), "postgresql://ci-db/warbler-ci")
+
+            del os.environ['DATABASE_URL']
+            self.assertEqual(database_url(), "postgresql:///warbler-test")
+        finally:
+            os.environ['DATABASE_URL'] = url
+
+    def test_snowflake_worker_id(self):
+        """Do message ids carry SNOWFLAKE_WORKER_ID, or warn without it?"""
+
+        os.environ['SNOWFLAKE_WORKER_ID'] = '37'
+        try:
+            create_app('testing')
+            worker_id = message_ids.next_id() >> SEQUENCE_BITS & MAX_WORKER_ID
+            self.assertEqual(worker_id, 37)
+        finally:
+            del os.environ['SNOWFLAKE_WORKER_ID']
+            message_ids.init_app(app)
+
+        with self.assertLogs('snowflake', 'WARNING'):
+            create_app('production')
+
+    def test_only_development_gets_the_toolbar(self):
+        """Is the debug toolbar installed in development alone?"""
+
+        def has_toolbar(app):
+            return any('DebugToolbar' in func.__qualname__
+                       for func in app.before_request_funcs[None])
+
+        self.assertFalse(has_toolbar(create_app('production')))
+        self.assertTrue(has_toolbar(create_app('development')))
+
+    def test_overrides_and_unknown_profiles(self):
+        """Do mappings override settings, and bad profile names fail?"""
+
+        test_app = create_app({'LIVE_POLL_SECONDS': 3})
+        self.assertEqual(test_app.config['LIVE_POLL_SECONDS'], 3)
+        self.assertEqual(test_app.config['PROFILE'], 'production')
+
+        with self.assertRaises(ValueError):
+            create_app('staging')
+
+
+class ForkTestCase(TestCase):
+    """Connection pools across a fork."""
+
+    def test_child_gets_empty_pools(self):
+        """Does neither side of a fork keep the pooled connections?"""
+
+        with app.app_context():
+            db.session.execute("SELECT 1")
+            db.session.remove()
+            engine = db.engine
+            self.assertGreater(engine.pool.checkedin(), 0)
+
+            pid = os.fork()
+            if pid == 0:
+                # a child must not run the rest of the test suite
+                os._exit(0 if engine.pool.checkedin() == 0 else 1)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+            self.assertEqual(engine.pool.checkedin(), 0)
+
+            # and the parent carries on with new connections
+            self.assertEqual(db.session.execute("SELECT 1").scalar(), 1)
+            db.session.remove()
@@ -0,0 +1,181 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import socket
+from time import sleep
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, create_app
+from cache import (Cache, MemoryBackend, RedisBackend, StandInServer,
+                   cache, load_message)
+from metrics import CACHE_ERRORS
+
+db.create_all()
+
+
+class CacheBehavior:
+    """Tests every backend must pass; mixed into one TestCase per backend."""
+
+    def test_get_set_delete(self):
+        """Can values be stored, read back and forgotten?"""
+
+        self.cache.set('things', 1, {'name': 'one'})
+        self.cache.set_many('things', {2: [2], 3: 'three'})
+
+        self.assertEqual(self.cache.get('things', 1), {'name': 'one'})
+        self.assertEqual(self.cache.get_many('things', [1, 2, 3, 4]),
+                         {1: {'name': 'one'}, 2: [2], 3: 'three'})
+
+        self.cache.delete('things', 1, 2)
+        self.assertEqual(self.cache.get_many('things', [1, 2, 3]),
+                         {3: 'three'})
+
+    def test_namespaces_are_separate(self):
+        """Do the same keys in different namespaces hold different values?"""
+
+        self.cache.set('things', 1, 'one')
+        self.cache.set('others', 1, 'uno')
+        self.cache.delete('things', 1)
+
+        self.assertIsNone(self.cache.get('things', 1))
+        self.assertEqual(self.cache.get('others', 1), 'uno')
+
+    def test_ttl(self):
+        """Do entries expire?"""
+
+        self.cache.set('things', 1, 'fleeting', ttl=0.05)
+        self.cache.set('things', 2, 'lasting', ttl=60)
+        sleep(0.1)
+
+        self.assertIsNone(self.cache.get('things', 1))
+        self.assertEqual(self.cache.get('things', 2), 'lasting')
+
+
+class MemoryCacheTestCase(CacheBehavior, TestCase):
+    """Test the in-process backend."""
+
+    def setUp(self):
+        self.cache = Cache(MemoryBackend())
+
+
+class RedisCacheTestCase(CacheBehavior, TestCase):
+    """Test the Redis-protocol backend against the stand-in server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache = Cache(RedisBackend.from_url(self.server.url))
+        self.cache.backend.clear()
+
+
+def unreachable_url():
+    """A redis:// URL nothing is listening at."""
+
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return f"redis://localhost:{sock.getsockname()[1]}/0"
+
+
+class UnreachableBackendTestCase(TestCase):
+    """Going without a cache backend that can't be reached."""
+
+    def test_errors_are_misses(self):
+        """Do reads miss and writes do nothing, counting the errors?"""
+
+        cache = Cache(RedisBackend.from_url(unreachable_url()))
+        errors = CACHE_ERRORS.values.get(('get',), 0)
+
+        with self.assertLogs('cache', 'WARNING'):
+            cache.set('things', 1, 'one')
+            cache.delete('things', 1)
+            self.assertIsNone(cache.get('things', 1))
+
+        self.assertEqual(CACHE_ERRORS.values[('get',)], errors + 1)
+
+    def test_rows_come_from_the_database(self):
+        """Are cached rows read from the database instead?"""
+
+        Message.query.delete()
+        User.query.delete()
+        msg = Message(text="uncached", user=User(email="u@test.com",
+                                                  username="uncached",
+                                                  password="HASHED"))
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        outage = create_app({'CACHE_URL': unreachable_url()})
+        with outage.test_request_context(), self.assertLogs('cache'):
+            self.assertEqual(load_message(msg_id).user.username, "uncached")
+            db.session.remove()
+
+
+class CachedRowsTestCase(TestCase):
+    """Test rows cached for the read routes."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+        with app.app_context():
+            cache.backend.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cached_message_comes_with_author(self):
+        """Does a cached message come back, with its author, sans queries?"""
+
+        user = User(email="cached@test.com",
+                    username="cached",
+                    password="HASHED_PASSWORD")
+        msg = Message(text="cache me", user=user)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, user_id = msg.id, user.id
+
+        with app.test_request_context():
+            load_message(msg_id)
+            db.session.remove()
+
+            with self.assertNoQueries():
+                cached = load_message(msg_id)
+                self.assertEqual(cached.text, "cache me")
+                self.assertEqual(cached.user.id, user_id)
+                self.assertEqual(cached.user.username, "cached")
+
+    def assertNoQueries(self):
+        """Context manager failing if any SQL runs inside it."""
+
+        test = self
+
+        class NoQueries:
+            def __enter__(self):
+                self.engine = db.engine
+                db.event.listen(self.engine, 'before_cursor_execute',
+                                self.fail)
+
+            def fail(self, *args, **kwargs):
+                test.fail(f"unexpected query: {args[2]}")
+
+            def __exit__(self, *exc):
+                db.event.remove(self.engine, 'before_cursor_execute',
+                                self.fail)
+
+        return NoQueries()
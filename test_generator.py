@@ -0,0 +1,88 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import filecmp
+import os
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from statistics import median
+from unittest import TestCase
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'generator', 'create_csvs.py')
+
+CSVS = ('users.csv', 'messages.csv', 'follows.csv', 'likes.csv')
+
+
+def generate(out_dir, processes):
+    """Run the generator into `out_dir`, small enough to be quick but with
+    several shards per table."""
+
+    subprocess.run([sys.executable, SCRIPT,
+                    '--users', '2000', '--messages', '5000',
+                    '--seed', 'test', '--shard-size', '300',
+                    '--processes', str(processes), '--out-dir', out_dir],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def column_counts(path, column, total):
+    """How often each of the ids 1..`total` appears in `column` of `path`."""
+
+    with open(path, newline='') as file:
+        counts = Counter(row[column] for row in csv.DictReader(file))
+
+    return [counts[str(id)] for id in range(1, total + 1)]
+
+
+class GeneratorTestCase(TestCase):
+    """The sharded, seeded generator's output."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.one = os.path.join(cls.dir.name, 'one')
+        cls.many = os.path.join(cls.dir.name, 'many')
+
+        generate(cls.one, processes=1)
+        generate(cls.many, processes=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def test_same_output_for_any_processes(self):
+        """Does a seed give the same files however many processes run?"""
+
+        for name in CSVS:
+            with self.subTest(name):
+                self.assertTrue(filecmp.cmp(os.path.join(self.one, name),
+                                            os.path.join(self.many, name),
+                                            shallow=False))
+
+    def test_followers_are_heavy_tailed(self):
+        """Do a few users have far more followers than most?"""
+
+        followers = column_counts(os.path.join(self.one, 'follows.csv'),
+                                  'user_being_followed_id', 2000)
+
+        self.assertGreater(max(followers), 20 * max(1, median(followers)))
+
+    def test_likes_are_heavy_tailed(self):
+        """Do a few messages get far more likes than most?"""
+
+        with open(os.path.join(self.one, 'messages.csv'), newline='') as file:
+            message_ids = [row['id'] for row in csv.DictReader(file)]
+
+        with open(os.path.join(self.one, 'likes.csv'), newline='') as file:
+            likes = Counter(row['message_id'] for row in csv.DictReader(file))
+
+        counts = [likes[id] for id in message_ids]
+        self.assertGreater(max(counts), 20 * max(1, median(counts)))
@@ -0,0 +1,194 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import os
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from live import live_updates, LiveUpdates, MemoryBackend
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import encode_cursor
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SubscriptionTestCase(TestCase):
+    """Which notices wake a subscriber."""
+
+    def test_only_followed_authors_wake(self):
+        """Is a subscriber woken by its authors' messages, and no others?"""
+
+        live = LiveUpdates(MemoryBackend())
+        subscription = live.subscribe([1, 2])
+
+        live.publish(3, 100)
+        self.assertFalse(subscription.wait(0))
+
+        live.publish(2, 101)
+        self.assertTrue(subscription.wait(0))
+        # the notice is used up by waiting
+        self.assertFalse(subscription.wait(0))
+
+        live.unsubscribe(subscription)
+        live.publish(1, 102)
+        self.assertFalse(subscription.wait(0))
+
+
+class LiveTimelineTestCase(TestCase):
+    """Streaming and long polling the home timeline."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        viewer = User.signup(username="viewer", email="v@test.com",
+                             password="password", image_url=None)
+        author = User.signup(username="author", email="a@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.viewer_id))
+        old = self.post(self.author_id, "already seen")
+        db.session.commit()
+        self.after = encode_cursor(old)
+
+        self.client = self.logged_in(self.viewer_id)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def logged_in(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def post(self, user_id, text):
+        message = Message(text=text, user_id=user_id)
+        db.session.add(message)
+        db.session.flush()
+        TimelineEntry.fan_out(message)
+        return message.id
+
+    def test_poll_returns_newer_messages(self):
+        """Does a poll answer at once with only the unseen messages?"""
+
+        self.post(self.author_id, "brand new")
+        db.session.commit()
+
+        resp = self.client.get(f"/timeline/poll?after={self.after}")
+        data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("brand new", data['html'])
+        self.assertNotIn("already seen", data['html'])
+        self.assertNotEqual(data['after'], self.after)
+
+    def test_poll_wakes_on_new_message(self):
+        """Does a waiting poll answer when a followed user posts?"""
+
+        app.config['LIVE_POLL_SECONDS'] = 5
+        author = self.logged_in(self.author_id)
+
+        def post_soon():
+            sleep(0.2)
+            author.post("/messages/new", data={"text": "just posted"})
+
+        poster = Thread(target=post_soon)
+        poster.start()
+        try:
+            resp = self.client.get(f"/timeline/poll?after={self.after}")
+        finally:
+            poster.join()
+            app.config['LIVE_POLL_SECONDS'] = 25
+
+        self.assertIn("just posted", resp.get_json()['html'])
+
+    def test_poll_times_out_empty(self):
+        """Does a poll with nothing new end with no messages?"""
+
+        app.config['LIVE_POLL_SECONDS'] = 0.1
+        try:
+            resp = self.client.get(f"/timeline/poll?after={self.after}")
+        finally:
+            app.config['LIVE_POLL_SECONDS'] = 25
+
+        self.assertEqual(resp.get_json(),
+                         {'html': None, 'after': self.after})
+
+    def test_stream_sends_newer_messages(self):
+        """Does the stream send unseen messages as an event to resume after?"""
+
+        newest = self.post(self.author_id, "streamed")
+        db.session.commit()
+
+        app.config['LIVE_STREAM_SECONDS'] = 0.5
+        try:
+            resp = self.client.get("/timeline/stream",
+                                   headers={'Last-Event-ID': self.after})
+            body = resp.get_data(as_text=True)
+            resp.close()
+        finally:
+            app.config['LIVE_STREAM_SECONDS'] = 55
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertIn("event: messages", body)
+        self.assertIn(f"id: {encode_cursor(newest)}", body)
+        self.assertIn("streamed", body)
+        self.assertNotIn("already seen", body)
+
+    def test_waiting_requests_are_capped(self):
+        """Past LIVE_MAX_STREAMS, are streams refused and polls answered
+        at once?"""
+
+        app.config['LIVE_MAX_STREAMS'] = 0
+        try:
+            resp = self.client.get(f"/timeline/stream?after={self.after}")
+            self.assertEqual(resp.status_code, 503)
+
+            resp = self.client.get(f"/timeline/poll?after={self.after}")
+            self.assertEqual(resp.get_json(),
+                             {'html': None, 'after': self.after,
+                              'retry': 10000})
+        finally:
+            app.config['LIVE_MAX_STREAMS'] = 16
+
+        app.config['LIVE_STREAM_SECONDS'] = 0.1
+        app.config['LIVE_POLL_SECONDS'] = 0.1
+        try:
+            resp = self.client.get(f"/timeline/stream?after={self.after}")
+            resp.get_data()
+            resp.close()
+            self.client.get(f"/timeline/poll?after={self.after}")
+        finally:
+            app.config['LIVE_STREAM_SECONDS'] = 55
+            app.config['LIVE_POLL_SECONDS'] = 25
+
+        # and the slots were given back
+        with app.app_context():
+            self.assertEqual(live_updates.waiting, 0)
+
+    def test_bad_cursor(self):
+        """Is a garbled cursor refused?"""
+
+        resp = self.client.get("/timeline/poll?after=%%%")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_logged_out(self):
+        """Are logged-out clients refused?"""
+
+        resp = app.test_client().get(f"/timeline/stream?after={self.after}")
+        self.assertEqual(resp.status_code, 401)
@@ -6,11 +6,15 @@
 
 
 import os
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy.exc import IntegrityError, DataError
-from psycopg2.errors import StringDataRightTruncation
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
+from snowflake import (SnowflakeIds, timestamp_of, MAX_SEQUENCE,
+                       MAX_WORKER_ID, SEQUENCE_BITS)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -35,6 +39,42 @@ db.drop_all()
 db.create_all()
 
 
+def worker_id_of(id):
+    return id >> SEQUENCE_BITS & MAX_WORKER_ID
+
+
+def forked_worker_ids(ids, count):
+    """Worker ids `ids` gives in `count` processes forked from this one,
+    all alive at once."""
+
+    release, hold = os.pipe()
+    readers, pids = [], []
+
+    for _ in range(count):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # a child must not run the rest of the test suite
+            try:
+                os.close(hold)
+                os.write(write, str(worker_id_of(ids.next_id())).encode())
+                # keep the lease until every child has taken one
+                os.read(release, 1)
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        readers.append(read)
+        pids.append(pid)
+
+    worker_ids = [int(os.read(read, 16) or -1) for read in readers]
+    os.close(hold)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    return worker_ids
+
+
 class MessageModelTestCase(TestCase):
     """Test Message Model."""
 
@@ -63,9 +103,12 @@ class MessageModelTestCase(TestCase):
         db.session.add(message)
         db.session.commit()
 
+        self.lease_dir = tempfile.TemporaryDirectory()
+
     def tearDown(self):
         """Clean up fouled transactions"""
         db.session.rollback()
+        self.lease_dir.cleanup()
 
     def test_message_model(self):
         """Does basic model work as expected?"""
@@ -120,3 +163,69 @@ class MessageModelTestCase(TestCase):
 
 
 
+
+    def test_message_ids_are_time_ordered(self):
+        """Do later messages get larger ids, and timestamps from them?"""
+
+        user = User.query.filter_by(username="TESTUSERNAME").first()
+        first = Message(text="first", user_id=user.id)
+        second = Message(text="second", user_id=user.id)
+        db.session.add(first)
+        db.session.flush()
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertEqual(second.timestamp, timestamp_of(second.id))
+        self.assertLess(datetime.utcnow() - first.timestamp,
+                        timedelta(seconds=5))
+
+    def test_snowflake_ids_never_repeat(self):
+        """Are ids unique and increasing past a full millisecond, or the
+        clock going backwards?"""
+
+        ids = SnowflakeIds(worker_id=3, lease_dir=self.lease_dir.name)
+
+        with patch('snowflake.time', return_value=1600000000.0):
+            made = [ids.next_id() for _ in range(MAX_SEQUENCE + 10)]
+        with patch('snowflake.time', return_value=1599999999.0):
+            made.append(ids.next_id())
+
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual(made[0] >> 12 & 1023, 3)
+
+    def test_forked_processes_get_their_own_worker_ids(self):
+        """Do processes forked together lease different worker ids?"""
+
+        ids = SnowflakeIds(worker_id=5, worker_ids=3,
+                           lease_dir=self.lease_dir.name)
+        parent = worker_id_of(ids.next_id())
+        children = forked_worker_ids(ids, 2)
+
+        self.assertEqual(sorted([parent, *children]), [5, 6, 7])
+
+    def test_timelines_are_capped(self):
+        """Do rebuilt and trimmed timelines keep only the newest entries?"""
+
+        user = User.query.filter_by(username="TESTUSERNAME").first()
+        messages = [Message(text=f"message {i}", user_id=user.id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+        newest = sorted(message.id for message in messages)[-3:]
+
+        def timeline():
+            return sorted(entry.message_id for entry
+                          in TimelineEntry.query.filter_by(owner_id=user.id))
+
+        with patch.object(TimelineEntry, 'TIMELINE_LIMIT', 3):
+            TimelineEntry.rebuild()
+            self.assertEqual(timeline(), newest)
+
+        # and setUp's message
+        TimelineEntry.rebuild()
+        self.assertEqual(len(timeline()), 6)
+
+        with patch.object(TimelineEntry, 'TIMELINE_LIMIT', 3):
+            self.assertEqual(TimelineEntry.trim(owner_ids=[user.id]), 3)
+        self.assertEqual(timeline(), newest)
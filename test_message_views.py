@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from flask import g
+
+from models import db, connect_db, Message, User, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +22,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, homepage
+from fragments import fragment_cache
 
 # TURN OFF DEBUG TOOLBAR
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
@@ -36,6 +39,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL statements than its route allows
+
+app.config['QUERY_BUDGET_STRICT'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -146,3 +153,174 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized.", html)
             self.assertEqual(len(Message.query.all()), 1)
 
+
+    def test_message_fans_out_to_followers(self):
+        """Does a new message land in the author's and followers' timelines?"""
+
+        self.testuser2.following.append(self.testuser)
+        db.session.commit()
+        author_id, follower_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Fan me out"})
+            msg = Message.query.one()
+
+            owners = {e.owner_id for e in
+                      TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(owners, {author_id, follower_id})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            self.assertIn("Fan me out", resp.get_data(as_text=True))
+
+    def test_unfollow_prunes_timeline(self):
+        """Does unfollowing remove that user's messages from the timeline?"""
+
+        msg = Message(text="Soon gone", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        author_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            c.post(f"/users/handlefollow/{author_id}")
+            self.assertIn("Soon gone", c.get("/").get_data(as_text=True))
+
+            c.post(f"/users/handlefollow/{author_id}")
+            self.assertNotIn("Soon gone", c.get("/").get_data(as_text=True))
+
+    def test_timeline_within_query_budget(self):
+        """Does the home timeline stay in budget with many authors?"""
+
+        authors = [User(username=f"author{i}",
+                        email=f"author{i}@test.com",
+                        password="HASHED_PASSWORD")
+                   for i in range(10)]
+        self.testuser.following.extend(authors)
+        db.session.add_all(authors)
+        db.session.add_all([Message(text=f"by {author.username}", user=author)
+                            for author in authors])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLessEqual(g.query_count, homepage.query_budget)
+
+    def test_message_fragments_are_cached_per_message(self):
+        """Are rendered messages reused, with each viewer's own like star?"""
+
+        msg = Message(text="Cache me", user_id=self.testuser.id)
+        db.session.add(msg)
+        self.testuser2.likes.append(msg)
+        db.session.commit()
+        author_id, liker_id = self.testuser.id, self.testuser2.id
+        fragment_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            html = c.get(f"/users/{author_id}").get_data(as_text=True)
+            self.assertIn('fas fa-star', html)
+
+            c.get("/logout")
+            html = c.get(f"/users/{author_id}").get_data(as_text=True)
+            self.assertIn('far fa-star', html)
+
+        self.assertEqual((fragment_cache.misses, fragment_cache.hits), (1, 1))
+
+    def test_like_toggles_in_one_statement(self):
+        """Does liking and unliking keep the count right without loading likes?"""
+
+        msg = Message(text="Like me", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, liker_id = msg.id, self.testuser2.id
+        referer = {"Referer": f"http://localhost/users/{liker_id}/"}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            resp = c.post(f"/messages/{msg_id}/handle-like", headers=referer)
+            self.assertEqual(resp.json, {'count': 1, 'liked': True})
+            self.assertNotIn('current_user', g)
+
+            resp = c.post(f"/messages/{msg_id}/handle-like", headers=referer)
+            self.assertEqual(resp.json, {'count': 0, 'liked': False})
+
+            resp = c.post("/messages/0/handle-like", headers=referer)
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(User.reconcile_counts([liker_id]), 0)
+
+    def test_bulk_toggles(self):
+        """Are queued likes and follows applied in order, in one request?"""
+
+        msg = Message(text="Like me", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        user_id, author_id = self.testuser2.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post("/toggles", json={"toggles": [
+                {"type": "like", "id": msg_id},
+                {"type": "follow", "id": author_id},
+                {"type": "like", "id": 0},
+                {"type": "follow", "id": user_id},
+                {"type": "like", "id": msg_id},
+                {"type": "like", "id": msg_id},
+            ]})
+
+        results = resp.json['results']
+        self.assertEqual(results[0]['liked'], True)
+        self.assertEqual((results[1]['following'],
+                          results[1]['following_count'],
+                          results[1]['followers_count']), (True, 1, 1))
+        self.assertEqual(results[2]['error'], 'not found')
+        self.assertEqual(results[3]['error'], 'invalid')
+        self.assertEqual([r['likes_count'] for r in results[4:]], [0, 1])
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(owner_id=user_id).count(), 1)
+        self.assertEqual(User.reconcile_counts([user_id]), 0)
+        self.assertEqual(User.query.get(author_id).followers_count, 1)
+
+    def test_bulk_toggles_reject_boolean_ids(self):
+        """Are true and false refused as ids, rather than taken as 1 and 0?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/toggles", json={"toggles": [
+                {"type": "follow", "id": True},
+                {"type": "like", "id": False},
+            ]})
+
+        self.assertEqual([result['error'] for result in resp.json['results']],
+                         ['invalid', 'invalid'])
+
+    def test_bulk_toggles_requires_login(self):
+        """Are anonymous bulk toggles refused?"""
+
+        resp = self.client.post("/toggles", json={"toggles": []})
+        self.assertEqual(resp.status_code, 401)
@@ -0,0 +1,114 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from metrics import Histogram
+from models import db, Message, User
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def sample(text, line_start):
+    """The value of the first metric line starting with `line_start`."""
+
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+
+    return None
+
+
+class MetricsTestCase(TestCase):
+    """The /metrics endpoint and what's recorded for it."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        self.user = User.signup(username="metrics", email="m@test.com",
+                                password="password", image_url=None)
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_requests_sql_and_templates_are_recorded(self):
+        """Does a page view show up in requests, SQL and template metrics?"""
+
+        user_id = self.user.id
+        label = '{endpoint="views.users_show"}'
+
+        before = self.client.get("/metrics").get_data(as_text=True)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        self.assertEqual(self.client.get(f"/users/{user_id}").status_code, 200)
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.content_type,
+                         'text/plain; version=0.0.4; charset=utf-8')
+        text = resp.get_data(as_text=True)
+
+        requests_line = ('warbler_http_requests_total'
+                         '{endpoint="views.users_show",'
+                         'method="GET",status="200"}')
+        self.assertEqual((sample(text, requests_line) or 0)
+                         - (sample(before, requests_line) or 0), 1)
+        self.assertGreater(
+            sample(text, f'warbler_sql_statements_total{label}'), 0)
+        self.assertGreater(
+            sample(text, f'warbler_sql_duration_seconds_total{label}'), 0)
+        self.assertIsNotNone(sample(
+            text, 'warbler_http_request_duration_seconds_count'
+                  '{endpoint="views.users_show"}'))
+        self.assertIsNotNone(sample(
+            text, 'warbler_template_render_duration_seconds_count'
+                  '{template="users/show.html"}'))
+        self.assertIsNotNone(
+            sample(text, 'warbler_password_hash_seconds_total'))
+
+    def test_fragment_cache_is_exported(self):
+        """Do fragment cache hits and misses show up?"""
+
+        user_id = self.user.id
+        Message.post(user_id, "render me")
+        db.session.commit()
+
+        def counts():
+            text = self.client.get("/metrics").get_data(as_text=True)
+            return (sample(text, 'warbler_fragment_cache_misses_total'),
+                    sample(text, 'warbler_fragment_cache_hits_total'))
+
+        misses, hits = counts()
+        self.client.get(f"/users/{user_id}")
+        self.client.get(f"/users/{user_id}")
+
+        self.assertEqual(counts(), (misses + 1, hits + 1))
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Are histogram buckets cumulative, with matching sum and count?"""
+
+        histogram = Histogram('test_seconds', "Test.", ['route'],
+                              buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'home')
+
+        lines = [f"{name}{labels} {value}"
+                 for name, labels, value in histogram.samples()]
+        self.assertEqual(lines, [
+            'test_seconds_bucket{route="home",le="0.1"} 2',
+            'test_seconds_bucket{route="home",le="1"} 3',
+            'test_seconds_bucket{route="home",le="+Inf"} 4',
+            'test_seconds_sum{route="home"} 3.65',
+            'test_seconds_count{route="home"} 4',
+        ])
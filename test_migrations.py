@@ -0,0 +1,153 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+import psycopg2
+from sqlalchemy import create_engine
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import migrate
+from app import create_app, CURR_USER_KEY
+from models import db, TimelineEntry, User
+
+# a database of its own, as the tests rebuild its schema from scratch
+UPGRADE_DATABASE = "warbler-test-upgrade"
+UPGRADE_URL = f"postgresql:///{UPGRADE_DATABASE}"
+
+# the schema `db.create_all()` made before migrations existed
+BASELINE_DDL = """
+    CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL
+    );
+    CREATE TABLE follows (
+        user_being_followed_id INTEGER REFERENCES users ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    );
+    CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE
+    );
+    CREATE TABLE likes (
+        user_id INTEGER REFERENCES users ON DELETE CASCADE,
+        message_id INTEGER REFERENCES messages ON DELETE CASCADE,
+        PRIMARY KEY (user_id, message_id)
+    );
+"""
+
+BASELINE_ROWS = """
+    INSERT INTO users (id, email, username, bio, password) VALUES
+        (1, 'reader@test.com', 'reader', 'reads a lot', 'HASHED'),
+        (2, 'writer@test.com', 'writer', 'writes a lot', 'HASHED');
+    INSERT INTO follows VALUES (2, 1);
+    INSERT INTO messages (id, text, timestamp, user_id) VALUES
+        (1, 'first warble', %(now)s, 2),
+        (2, 'second warble', %(now)s, 2);
+    INSERT INTO likes VALUES (1, 1);
+"""
+
+
+def reset_upgrade_database():
+    """Create the upgrade test database if need be, and empty it."""
+
+    server = psycopg2.connect(dbname='postgres')
+    server.autocommit = True
+    with server.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                       [UPGRADE_DATABASE])
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{UPGRADE_DATABASE}"')
+    server.close()
+
+    connection = psycopg2.connect(dbname=UPGRADE_DATABASE)
+    with connection, connection.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    connection.close()
+
+
+class BaselineUpgradeTestCase(TestCase):
+    """Upgrading a database made before migrations existed."""
+
+    def setUp(self):
+        reset_upgrade_database()
+
+        connection = psycopg2.connect(dbname=UPGRADE_DATABASE)
+        with connection, connection.cursor() as cursor:
+            cursor.execute(BASELINE_DDL)
+            cursor.execute(BASELINE_ROWS, {'now': datetime.utcnow()})
+        connection.close()
+
+        self.engine = create_engine(UPGRADE_URL)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_upgrade_then_serve(self):
+        """Does an upgraded baseline database serve the home page?"""
+
+        migrate.upgrade(self.engine, log=lambda message: None)
+        self.assertEqual(migrate.pending(self.engine), [])
+
+        users = self.engine.execute(
+            "SELECT id, messages_count, following_count, followers_count, "
+            "likes_count, profile_version FROM users ORDER BY id").fetchall()
+        self.assertEqual([tuple(user) for user in users],
+                         [(1, 0, 1, 0, 1, 0), (2, 2, 0, 1, 0, 0)])
+
+        timelines = self.engine.execute(
+            "SELECT owner_id, message_id FROM timeline_entries "
+            "ORDER BY owner_id, message_id").fetchall()
+        self.assertEqual([tuple(entry) for entry in timelines],
+                         [(1, 1), (1, 2), (2, 1), (2, 2)])
+
+        indexes = {name for (name,) in self.engine.execute(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = 'public'")}
+        self.assertIn('ix_messages_text_tsv', indexes)
+        self.assertIn('ix_messages_user_id', indexes)
+        if self.engine.execute("SELECT 1 FROM pg_extension "
+                               "WHERE extname = 'pg_trgm'").first():
+            self.assertIn('ix_users_username_trgm', indexes)
+
+        upgraded = create_app({'SQLALCHEMY_DATABASE_URI': UPGRADE_URL})
+        client = upgraded.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        resp = client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("second warble", resp.get_data(as_text=True))
+
+        with upgraded.app_context():
+            self.assertEqual(User.reconcile_counts(), 0)
+            self.assertEqual(TimelineEntry.query.count(), 4)
+            db.session.remove()
+            db.get_engine(upgraded).dispose()
+
+    def test_upgrade_is_idempotent(self):
+        """Does a re-run of the new migrations change nothing?"""
+
+        migrate.upgrade(self.engine, log=lambda message: None)
+        self.engine.execute("DELETE FROM schema_migrations WHERE version IN "
+                            "('0005_user_counters', '0006_search_indexes')")
+
+        migrate.upgrade(self.engine, log=lambda message: None)
+        self.assertEqual(
+            self.engine.execute(
+                "SELECT count(*) FROM timeline_entries").scalar(), 4)
@@ -0,0 +1,80 @@
+"""Query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from benchmarks.explain_check import check, typical_ids
+from models import db, Follows, Like, Message, TimelineEntry, User
+from snowflake import message_ids
+import migrate
+
+db.create_all()
+
+FIXTURE_USERS = 500
+
+
+class QueryPlanTestCase(TestCase):
+    """Do the app's hot queries all have an index to use?"""
+
+    @classmethod
+    def setUpClass(cls):
+        migrate.upgrade(db.engine, log=lambda message: None)
+        cls.create_fixture()
+
+    def test_migrations_are_applied(self):
+        """Is every migration recorded as applied?"""
+
+        self.assertEqual(migrate.pending(db.engine), [])
+
+    @classmethod
+    def create_fixture(cls):
+        """Users who each follow a few others, with messages and likes.
+
+        Enough rows that, once ANALYZEd, reading a whole table or index
+        costs more than using the right index, as in production.
+        """
+
+        User.query.delete()
+        db.session.execute(
+            User.__table__.insert(),
+            [{'username': f"planner{i}", 'email': f"planner{i}@test.com",
+              'password': "HASHED"} for i in range(FIXTURE_USERS)])
+        user_ids = [id for (id,) in
+                    db.session.query(User.id).order_by(User.id)]
+
+        db.session.execute(
+            Follows.__table__.insert(),
+            [{'user_following_id': user_id,
+              'user_being_followed_id': user_ids[(i + step) % len(user_ids)]}
+             for i, user_id in enumerate(user_ids) for step in range(1, 6)])
+
+        messages = [{'id': message_ids.next_id(), 'text': "planned",
+                     'timestamp': datetime.utcnow(), 'user_id': user_id}
+                    for user_id in user_ids for _ in range(10)]
+        db.session.execute(Message.__table__.insert(), messages)
+
+        db.session.execute(
+            Like.__table__.insert(),
+            [{'user_id': user_ids[i % len(user_ids)],
+              'message_id': message['id'], 'timestamp': datetime.utcnow()}
+             for i, message in enumerate(messages[::2])])
+
+        TimelineEntry.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+
+    def test_hot_queries_use_indexes(self):
+        """With seq scans disabled, does any hot query still need one?"""
+
+        with app.app_context():
+            self.assertEqual(check(force_index=True, analyze_first=True,
+                                   **typical_ids()), {})
@@ -0,0 +1,96 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+from time import time
+from unittest import TestCase
+
+from sqlalchemy import event
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from models import db, User
+from replicas import PRIMARY_UNTIL_KEY, pool_options
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# the test database again, under another name, standing in for a replica
+REPLICA_URL = "postgresql:///warbler-test?application_name=replica"
+
+
+class ReplicaTestCase(TestCase):
+    """Which database requests read from."""
+
+    def setUp(self):
+        User.query.delete()
+        self.user = User.signup(username="reader", email="r@test.com",
+                                password="password", image_url=None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = {**self.binds,
+                                          'replica0': REPLICA_URL}
+        self.replica = db.get_engine(app, bind='replica0')
+        self.replica_statements = 0
+        event.listen(self.replica, 'before_cursor_execute', self.count)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        event.remove(self.replica, 'before_cursor_execute', self.count)
+        app.config['SQLALCHEMY_BINDS'] = self.binds
+        db.session.rollback()
+
+    def count(self, *args):
+        self.replica_statements += 1
+
+    def test_get_reads_from_replica(self):
+        """Are a GET request's queries sent to the replica?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(self.replica_statements, 0)
+
+    def test_post_sticks_to_primary(self):
+        """Does a POST, and reading soon after it, use only the primary?"""
+
+        resp = self.client.post("/messages/new", data={"text": "fresh"})
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertIn("fresh", resp.get_data(as_text=True))
+        self.assertEqual(self.replica_statements, 0)
+
+        # once the window's over, reads go back to the replica
+        with self.client.session_transaction() as sess:
+            sess[PRIMARY_UNTIL_KEY] = time() - 1
+
+        self.client.get(f"/users/{self.user_id}")
+        self.assertGreater(self.replica_statements, 0)
+
+    def test_pool_metrics(self):
+        """Are the pools of engines in use reported?"""
+
+        self.client.get(f"/users/{self.user_id}")
+        text = self.client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_db_pool_checked_out{bind="primary"}', text)
+        self.assertIn('warbler_db_pool_size{bind="replica0"} 5', text)
+
+    def test_sqlite_gets_no_pool_sizes(self):
+        """Are pool sizes left out where the pool can't take them?"""
+
+        config = {**app.config, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'}
+        self.assertEqual(pool_options(config), {})
+        self.assertEqual(pool_options(app.config)['pool_size'], 5)
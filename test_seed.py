@@ -0,0 +1,89 @@
+"""CSV loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Follows
+from seed import is_empty, Loader, read_batches
+
+
+class LoaderTestCase(TestCase):
+    """Loading CSVs through COPY (Postgres) in batches."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+
+        db.create_all()
+        Follows.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'follows.csv')
+
+        with open(self.path, 'w') as file:
+            file.write("user_being_followed_id,user_following_id\n")
+            file.write("".join(f"{i},{i}\n" for i in range(1, 8)))
+
+        self.loader = Loader(db.engine)
+        self.loader.forget_progress()
+
+    def tearDown(self):
+        self.loader.close()
+        self.dir.cleanup()
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+        self.context.pop()
+
+    def test_read_batches(self):
+        """Are rows split into batches, after any skipped ones?"""
+
+        batches = [rows for _, rows in read_batches(self.path, 3, skip=2)]
+        self.assertEqual([len(rows) for rows in batches], [3, 2])
+        self.assertEqual(batches[0][0], ['3', '3'])
+
+    def test_load_and_resume(self):
+        """Is progress recorded per batch, so a rerun can skip loaded rows?"""
+
+        User.query.delete()
+        db.session.add_all([User(id=i, username=f"u{i}", email=f"u{i}@x.com",
+                                 password="x") for i in range(1, 8)])
+        db.session.commit()
+
+        batches = self.loader.load('follows', self.path, 3)
+        self.assertEqual(next(batches), 3)
+        batches.close()
+
+        source = os.path.abspath(self.path)
+        self.assertEqual(self.loader.rows_loaded(source), 3)
+
+        skip = self.loader.rows_loaded(source)
+        self.assertEqual(list(self.loader.load('follows', self.path, 3, skip)),
+                         [3, 4])
+        self.assertEqual(Follows.query.count(), 7)
+        self.assertEqual(self.loader.rows_loaded(source), 7)
+
+    def test_is_empty(self):
+        """Is a table with rows told apart from an empty one (a fresh load)?"""
+
+        self.assertTrue(is_empty(db, Follows.__table__))
+
+        list(self.loader.load('users', self.users_path(), 10))
+        self.assertFalse(is_empty(db, User.__table__))
+
+    def users_path(self):
+        path = os.path.join(self.dir.name, 'users.csv')
+        with open(path, 'w') as file:
+            file.write("email,username,password\n")
+            file.write("u1@x.com,u1,x\n")
+        return path
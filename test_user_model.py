@@ -6,10 +6,13 @@
 
 
 import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Like
+from passwords import hasher, hash_password, hash_rounds, PasswordHasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,7 +24,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 
-from app import app
+from app import app, create_app
 app.config['TESTING'] = True
 app.config['SQLALCHEMY_ECHO'] = False
 
@@ -138,7 +141,7 @@ class UserModelTestCase(TestCase):
 
     def test_authenticate_success(self):
 
-        user = User.signup("liz", "liz@liz.com", "password", None)
+        User.signup("liz", "liz@liz.com", "password", None)
         db.session.commit()
 
         test_auth = User.authenticate("liz", "password")
@@ -159,3 +162,131 @@ class UserModelTestCase(TestCase):
         self.assertNotIsInstance(test_auth2, User)
 
 
+
+    def test_reconcile_counts(self):
+        """Does reconciling repair drifted counters?"""
+
+        user1 = User.query.filter_by(username="TESTUSERNAME").first()
+        user2 = User(email="test@count.com",
+                     username="counted",
+                     password="HASHED_PASSWORD")
+        user2.following.append(user1)
+        db.session.add(user2)
+        db.session.add(Message(text="counted", user=user1))
+        db.session.commit()
+
+        self.assertEqual(user1.followers_count, 0)
+
+        fixed = User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(fixed, 2)
+        self.assertEqual(user1.followers_count, 1)
+        self.assertEqual(user1.messages_count, 1)
+        self.assertEqual(user2.following_count, 1)
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_load_relationships(self):
+        """Do prefetched relationships answer has_liked/is_following?"""
+
+        user1 = User.query.filter_by(username="TESTUSERNAME").first()
+        user2 = User(email="test@viewer.com",
+                     username="viewer",
+                     password="HASHED_PASSWORD")
+        liked = Message(text="liked", user=user1)
+        unliked = Message(text="unliked", user=user1)
+        user2.following.append(user1)
+        user2.likes.append(liked)
+        db.session.add_all([user2, liked, unliked])
+        db.session.commit()
+
+        user2.load_relationships(messages=[liked, unliked])
+
+        self.assertEqual(user2._prefetched('liked', liked.id), True)
+        self.assertEqual(user2._prefetched('liked', unliked.id), False)
+        self.assertEqual(user2._prefetched('following', user1.id), True)
+        self.assertTrue(user2.has_liked(liked))
+        self.assertFalse(user2.has_liked(unliked))
+        self.assertTrue(user2.is_following(user1))
+        self.assertFalse(user2.is_followed_by(user1))
+
+    def test_authenticate_rehashes_old_work_factor(self):
+        """Is a hash made at a different work factor replaced on login?"""
+
+        user = User.query.filter_by(username="TESTUSERNAME").first()
+        user.password = hash_password("password", 4)
+        db.session.commit()
+
+        self.assertEqual(hash_rounds(user.password), 4)
+        self.assertTrue(hasher.needs_rehash(user.password))
+
+        self.assertIs(User.authenticate("TESTUSERNAME", "password"), user)
+        self.assertEqual(hash_rounds(user.password), hasher.rounds)
+        self.assertIs(User.authenticate("TESTUSERNAME", "password"), user)
+
+    def test_hasher_pool(self):
+        """Are passwords hashed and checked on the pool's processes?"""
+
+        pool_hasher = PasswordHasher(rounds=4, workers=1)
+        try:
+            hashed = pool_hasher.hash("password")
+            self.assertTrue(pool_hasher.check(hashed, "password"))
+            self.assertFalse(pool_hasher.check(hashed, "wrong"))
+            self.assertEqual(pool_hasher.stats()['completed'], 3)
+        finally:
+            pool_hasher.shutdown()
+
+    def test_hasher_replaces_a_broken_pool(self):
+        """Does hashing carry on after one of the pool's processes dies?"""
+
+        pool_hasher = PasswordHasher(rounds=4, workers=1)
+        try:
+            broken = pool_hasher._get_pool()
+            with self.assertRaises(BrokenProcessPool):
+                broken.submit(os._exit, 1).result()
+
+            hashed = pool_hasher.hash("password")
+            self.assertTrue(pool_hasher.check(hashed, "password"))
+            self.assertIsNot(pool_hasher._get_pool(), broken)
+        finally:
+            pool_hasher.shutdown()
+
+
+class SQLiteToggleTestCase(TestCase):
+    """The portable toggles, on a database that isn't Postgres."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI':
+                               f"sqlite:///{self.dir.name}/warbler.db"})
+
+        # sessions belong to the app they were opened for
+        db.session.remove()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        user = User(email="lite@test.com", username="lite",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.dir.cleanup()
+
+    def test_toggling_missing_rows(self):
+        """Are follows of missing users and likes of missing messages refused?"""
+
+        with self.assertRaises(IntegrityError):
+            Follows.toggle(self.user_id, 999)
+        db.session.rollback()
+
+        with self.assertRaises(IntegrityError):
+            Like.toggle(self.user_id, 999)
+        db.session.rollback()
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
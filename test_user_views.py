@@ -1,7 +1,11 @@
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from flask import g
+
+from models import db, connect_db, Message, User, Like, Follows
+from pagination import MESSAGES_PER_PAGE, USERS_PER_PAGE
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -29,6 +33,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL statements than its route allows
+
+app.config['QUERY_BUDGET_STRICT'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for messages."""
@@ -87,6 +95,69 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<div class="row">', html)
 
+    def test_followers_paginate_with_viewer_state(self):
+        """Do followers come a page at a time, showing who the viewer
+        follows?"""
+
+        user_id, other_id = self.testuser.id, self.testuser2.id
+        fans = [User(username=f"fan{i}", email=f"fan{i}@test.com",
+                     password="not-a-hash")
+                for i in range(USERS_PER_PAGE + 1)]
+        db.session.add_all(fans)
+        db.session.flush()
+        db.session.add_all([Follows(user_being_followed_id=other_id,
+                                    user_following_id=fan.id)
+                            for fan in fans])
+        db.session.add(Follows(user_being_followed_id=fans[-1].id,
+                               user_following_id=user_id))
+        newest, oldest = fans[-1].id, fans[0].id
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/users/{other_id}/followers")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(f'href="/users/{oldest}"', html)
+            card = html.split(f'data-user-id="{newest}"')[1]
+            self.assertIn("Unfollow", card.split("</form>")[0])
+            self.assertEqual(html.count("Unfollow"), 1)
+
+            before = html.split("?before=")[1].split('"')[0]
+            resp = c.get(f"/users/{other_id}/followers?before={before}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f'href="/users/{oldest}"', html)
+            self.assertNotIn("?before=", html)
+
+    def test_users_directory_paginates(self):
+        """Is the directory a page of cards at a time, newest first?"""
+
+        db.session.add_all([User(username=f"member{i}",
+                                 email=f"member{i}@test.com",
+                                 password="not-a-hash")
+                            for i in range(USERS_PER_PAGE)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@member0", html)
+            self.assertNotIn("@testuser<", html)
+
+            before = html.split("?before=")[1].split('"')[0]
+            html = c.get(f"/users?before={before}").get_data(as_text=True)
+            self.assertIn("@testuser<", html)
+            self.assertNotIn("@member0", html)
+
+            resp = c.get("/users?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
 # ##################
 # logged out tests
 
@@ -127,4 +198,220 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('<h4 id="sidebar-username">', html)
\ No newline at end of file
+            self.assertIn('<h4 id="sidebar-username">', html)
+
+    def test_user_messages_paginate_by_cursor(self):
+        """Do older messages come back a page at a time via the cursor?"""
+
+        user_id = self.testuser.id
+        db.session.add_all([Message(text=f"warble {i}", user_id=user_id)
+                            for i in range(MESSAGES_PER_PAGE + 1)])
+        db.session.commit()
+        oldest = Message.query.order_by(Message.id).first()
+
+        with self.client as c:
+            resp = c.get(f"/users/{user_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Older warbles", html)
+            self.assertNotIn(f'href="/messages/{oldest.id}"', html)
+
+            before = html.split("?before=")[1].split('"')[0]
+            resp = c.get(f"/users/{user_id}/timeline?before={before}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'href="/messages/{oldest.id}"', resp.json['html'])
+            self.assertIsNone(resp.json['next'])
+
+    def test_likes_page_newest_like_first(self):
+        """Are likes listed by when they were made, a page at a time?"""
+
+        user_id, other_id = self.testuser.id, self.testuser2.id
+        messages = [Message(text=f"liked {i}", user_id=other_id)
+                    for i in range(MESSAGES_PER_PAGE + 1)]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        # liked in the reverse of the order they were posted
+        start = datetime(2020, 1, 1)
+        db.session.add_all([Like(user_id=user_id, message_id=message.id,
+                                 timestamp=start - timedelta(minutes=i))
+                            for i, message in enumerate(messages)])
+        ids = [message.id for message in messages]
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{user_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index(f'href="/messages/{ids[0]}"'),
+                            html.index(f'href="/messages/{ids[1]}"'))
+            self.assertNotIn(f'href="/messages/{ids[-1]}"', html)
+
+            before = html.split("?before=")[1].split('"')[0]
+            resp = c.get(f"/users/{user_id}/likes/timeline?before={before}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'href="/messages/{ids[-1]}"', resp.json['html'])
+            self.assertNotIn(f'href="/messages/{ids[0]}"', resp.json['html'])
+            self.assertIsNone(resp.json['next'])
+
+    def test_user_messages_bad_cursor(self):
+        """Is a cursor we didn't issue rejected?"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}?before=nonsense")
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_counts_follow_write_paths(self):
+        """Do following, posting and liking keep the counters current?"""
+
+        user_id, other_id = self.testuser.id, self.testuser2.id
+        msg = Message(text="likeable", user_id=other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post(f"/users/handlefollow/{other_id}")
+            self.assertEqual(resp.json['follow_count'], 1)
+            self.assertEqual(resp.json['follower_count'], 1)
+
+            c.post("/messages/new", data={"text": "counted"})
+            c.post(f"/messages/{msg_id}/handle-like",
+                   headers={"Referer": f"http://localhost/users/{user_id}/"})
+
+        user = User.query.get(user_id)
+        self.assertEqual((user.following_count, user.messages_count,
+                          user.likes_count), (1, 1, 1))
+        self.assertEqual(User.reconcile_counts([user_id]), 0)
+
+    def test_delete_user_fixes_others_counts(self):
+        """Does deleting a user fix the counts of those it touched?"""
+
+        user_id, other_id = self.testuser.id, self.testuser2.id
+        Follows.toggle(user_id, other_id)
+        Follows.toggle(other_id, user_id)
+        msg_id = Message.post(user_id, "going soon").id
+        Like.toggle(other_id, msg_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNone(User.query.get(user_id))
+        other = User.query.get(other_id)
+        self.assertEqual((other.following_count, other.followers_count,
+                          other.likes_count), (0, 0, 0))
+
+    def test_search_users_by_bio(self):
+        """Does user search match bios as well as usernames?"""
+
+        self.testuser2.bio = "Birdwatching in Oakland"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=birdwatch")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+    def test_search_messages(self):
+        """Does message search find warbles by their words?"""
+
+        db.session.add_all([
+            Message(text="The owls are hooting", user_id=self.testuser.id),
+            Message(text="Sparrows at dawn", user_id=self.testuser.id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=owl")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("The owls are hooting", html)
+            self.assertNotIn("Sparrows at dawn", html)
+
+    def test_logged_in_user_is_cached(self):
+        """Is the logged-in user loaded from the cache after the first hit?"""
+
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/")
+            first = g.query_count
+            c.get("/")
+
+            self.assertEqual(g.query_count, first - 1)
+
+    def test_profile_update_invalidates_cached_user(self):
+        """Does a profile change show up despite the user cache?"""
+
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/")
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("@renamed", html)
+
+    def test_profile_conditional_get(self):
+        """Is an unchanged profile answered with 304 on revalidation?"""
+
+        user_id = self.testuser.id
+
+        with self.client as c:
+            resp = c.get(f"/users/{user_id}")
+            etag = resp.headers["ETag"]
+
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get(f"/users/{user_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            db.session.add(Message(text="news", user_id=user_id))
+            db.session.commit()
+
+            resp = c.get(f"/users/{user_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_static_caching_policy(self):
+        """Are fingerprinted assets immutable and forms never stored?"""
+
+        with self.client as c:
+            html = c.get("/login").get_data(as_text=True)
+            self.assertEqual(c.get("/login").headers["Cache-Control"],
+                             "no-store")
+
+            css_url = ("/static/stylesheets/style.css"
+                       + html.split("/static/stylesheets/style.css")[1]
+                       .split('"')[0])
+            self.assertIn("/static/stylesheets/style.css?v=", css_url)
+
+            resp = c.get(css_url)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            resp.close()